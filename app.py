@@ -1,8 +1,9 @@
 import eventlet
 eventlet.monkey_patch()
+from eventlet import tpool
 
-from flask import Flask, render_template, jsonify, session
-from flask_socketio import SocketIO, emit
+from flask import Flask, render_template, jsonify, session, g, request, abort, Response, stream_with_context
+from flask_socketio import SocketIO, emit as socketio_emit, join_room
 import time
 import random
 import re
@@ -11,13 +12,569 @@ import ipaddress
 import html
 import os
 import copy
+import bisect
+import signal
+import pickle
+import sqlite3
+import uuid
+import hashlib
+import hmac
+import json
+import csv
+import io
+import itertools
+import shlex
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from collections import Counter, OrderedDict, deque
+from functools import lru_cache
+from contextlib import contextmanager
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'firewall-simulator-secret-key'
+# Every worker behind a load balancer must share the same key
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'firewall-simulator-secret-key')
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=45)
-socketio = SocketIO(app, cors_allowed_origins="*")
+app.config['STATE_BACKEND'] = os.environ.get('STATE_BACKEND', 'memory')
+app.config['STATE_DB_PATH'] = os.environ.get('STATE_DB_PATH', 'simulator_state.db')
+app.config['STATE_MAX_SESSIONS'] = int(os.environ.get('STATE_MAX_SESSIONS', 1000))
+app.config['STATE_REDIS_URL'] = os.environ.get('STATE_REDIS_URL', 'redis://localhost:6379/0')
+# Message queue shared by all workers, e.g. redis://host:6379/0 (or local:// in tests)
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+# Merge all new_log events produced while handling one event into a single message
+app.config['BATCH_LOG_EMITS'] = os.environ.get('BATCH_LOG_EMITS', '0') == '1'
+# Multiplier for simulated network delays (0 disables them, e.g. for load testing)
+app.config['SIM_TIME_SCALE'] = float(os.environ.get('SIM_TIME_SCALE', 1.0))
+# Token required by the /debug/profiler routes; they are disabled when unset
+app.config['PROFILER_TOKEN'] = os.environ.get('PROFILER_TOKEN')
+# Maximum tracked connections per session
+app.config['CONNTRACK_MAX'] = int(os.environ.get('CONNTRACK_MAX', 4096))
+# Token required to publish shared rulesets; publishing is disabled when unset
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN')
+# Published ruleset new sessions start with (none when unset)
+app.config['DEFAULT_RULESET'] = os.environ.get('DEFAULT_RULESET')
+# SQLite file keeping every session's full log history (disabled when unset)
+app.config['LOG_ARCHIVE_PATH'] = os.environ.get('LOG_ARCHIVE_PATH')
+# Days archived log entries are kept
+app.config['LOG_ARCHIVE_DAYS'] = float(os.environ.get('LOG_ARCHIVE_DAYS', 7))
+# SQLite file holding session snapshots (kept in memory when unset)
+app.config['SNAPSHOT_PATH'] = os.environ.get('SNAPSHOT_PATH', ':memory:')
+
+def message_queue_options(config):
+    """SocketIO keyword arguments for the configured SOCKETIO_MESSAGE_QUEUE."""
+    url = config['SOCKETIO_MESSAGE_QUEUE']
+    if not url:
+        return {}
+    return {'message_queue': url}
+
+socketio = SocketIO(app, cors_allowed_origins="*", **message_queue_options(app.config))
+
+class MetricCounter:
+    """Monotonic counter with optional labels, rendered in Prometheus text format."""
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, dict(zip(self.labels, key)), value
+
+class MetricGauge(MetricCounter):
+    """Gauge that is either set directly or computed by a callback at scrape time."""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labels=(), callback=None):
+        super().__init__(name, help_text, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        self._values[key] = value
+
+    def samples(self):
+        if self.callback is None:
+            yield from super().samples()
+            return
+        # A callback returns None when the value is not available
+        value = self.callback()
+        if value is not None:
+            yield self.name, {}, value
+
+class MetricHistogram:
+    """Histogram with fixed cumulative buckets, rendered in Prometheus text format."""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        position = bisect.bisect_left(self.buckets, value)
+        if position < len(self.buckets):
+            entry[0][position] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in self._values.items():
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", {**labels, 'le': repr(float(bound))}, cumulative
+            yield f"{self.name}_bucket", {**labels, 'le': '+Inf'}, count
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                    lines.append(f"{name}{{{label_text}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+COMMAND_DURATION = metrics.register(MetricHistogram(
+    'simulator_command_duration_seconds', 'Time spent handling a terminal command.', ('command',)))
+PACKETS_EVALUATED = metrics.register(MetricCounter(
+    'simulator_packets_evaluated_total', 'Packets evaluated against a chain.', ('chain',)))
+RULE_MATCHES = metrics.register(MetricCounter(
+    'simulator_rule_matches_total', 'Packets matched per chain and verdict.', ('chain', 'target')))
+EMITS = metrics.register(MetricCounter(
+    'simulator_emits_total', 'Socket.IO messages sent to clients.', ('event',)))
+CONNTRACK_FAST_PATH = metrics.register(MetricCounter(
+    'simulator_conntrack_fast_path_total', 'Established packets accepted without walking the chain.', ('chain',)))
+VERDICT_CACHE_LOOKUPS = metrics.register(MetricCounter(
+    'simulator_verdict_cache_lookups_total', 'Verdict cache lookups by result.', ('result',)))
+CONNECTED_CLIENTS = metrics.register(MetricGauge(
+    'simulator_connected_clients', 'Currently connected Socket.IO clients.'))
+STATE_SIZE = metrics.register(MetricHistogram(
+    'simulator_state_size_bytes', 'Serialized session state size written to the store.',
+    buckets=(1024, 4096, 16384, 65536, 262144, 1048576, 4194304)))
+
+def emit(event, *args, **kwargs):
+    """Flask-SocketIO ``emit`` that also counts the message."""
+    EMITS.inc(event=event)
+    return socketio_emit(event, *args, **kwargs)
+
+class SamplingProfiler:
+    """Statistical profiler that can be switched on at runtime.
+
+    A SIGPROF interval timer interrupts whatever greenlet is running and
+    records its stack, so the overhead is one stack walk per interval and
+    nothing at all while stopped. Results are collapsed stacks
+    (``file:function;...;file:function count``), the input format of
+    flamegraph tools.
+    """
+
+    def __init__(self):
+        self.stacks = Counter()
+        self.running = False
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self, interval=0.005):
+        """Start sampling every ``interval`` seconds of CPU time (main thread only)."""
+        self.stacks.clear()
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, interval, interval)
+        self.running = True
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        self.running = False
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+profiler = SamplingProfiler()
 
 MAX_LOGS = 1000
+STREAM_FLUSH_INTERVAL = 0.1
+MAX_BATCH_FLOWS = 10000
+LOG_PAGE_SIZE = 200
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+class LogRecord:
+    """A single firewall log entry.
+
+    Fields hold raw values and the time as epoch seconds. The formatted
+    timestamp, the ``details`` text and HTML escaping are only produced
+    when the entry is read, so entries nobody looks at cost no formatting.
+    """
+    __slots__ = ('created', 'action', 'source', 'destination', 'protocol',
+                 'port', 'rule', 'category', 'warning', 'count', 'seq')
+    _ESCAPED = ('source', 'destination', 'protocol', 'port', 'rule', 'warning')
+
+    def __init__(self, created, action, source, destination, protocol, port,
+                 rule, category, warning, count=1, seq=0):
+        self.created = created
+        self.action = action
+        self.source = source
+        self.destination = destination
+        self.protocol = protocol
+        self.port = port
+        self.rule = rule
+        self.category = category
+        self.warning = warning
+        self.count = count
+        self.seq = seq
+
+    @property
+    def timestamp(self):
+        return datetime.fromtimestamp(self.created).strftime("%Y-%m-%d %H:%M:%S")
+
+    @property
+    def details(self):
+        return (f"{self.action} traffic from {self.source} to {self.destination} ({self.protocol}"
+                + (f":{self.port}" if self.port else "") + ")")
+
+    def to_dict(self):
+        """The entry as sent to clients, with every text field HTML-escaped."""
+        entry = {
+            'timestamp': self.timestamp,
+            'action': self.action,
+            'category': self.category,
+            'details': html.escape(self.details),
+            'count': self.count,
+            'seq': self.seq,
+        }
+        for name in self._ESCAPED:
+            value = getattr(self, name)
+            entry[name] = html.escape(str(value)) if value is not None else None
+        return entry
+
+class LogBuffer:
+    """Bounded ring buffer of LogRecords with running totals.
+
+    Appending evicts the oldest record once ``capacity`` is reached, and the
+    per-action and per-category totals are adjusted on both append and
+    eviction so statistics never require a scan. Totals are weighted by each
+    record's packet count, so grouped entries count every packet.
+
+    Every appended record gets the next sequence number. Numbers keep
+    increasing across evictions and clears, so a client can use the last
+    one it has seen as a cursor.
+    """
+
+    def __init__(self, capacity=MAX_LOGS):
+        self._records = deque(maxlen=capacity)
+        self.next_seq = 1
+        self.total = 0
+        self.action_counts = Counter()
+        self.category_counts = Counter()
+
+    def append(self, record):
+        if len(self._records) == self._records.maxlen:
+            evicted = self._records[0]
+            self.total -= evicted.count
+            self.action_counts[evicted.action] -= evicted.count
+            self.category_counts[evicted.category] -= evicted.count
+        record.seq = self.next_seq
+        self.next_seq += 1
+        self._records.append(record)
+        self.total += record.count
+        self.action_counts[record.action] += record.count
+        self.category_counts[record.category] += record.count
+
+    def clear(self):
+        self._records.clear()
+        self.total = 0
+        self.action_counts.clear()
+        self.category_counts.clear()
+
+    def stats(self):
+        """Return total, blocked, allowed and warning counts for the buffer."""
+        return {
+            'total': self.total,
+            'blocked': self.action_counts['DROP'] + self.action_counts['REJECT'],
+            'allowed': self.action_counts['ACCEPT'],
+            'warnings': self.category_counts['warning']
+        }
+
+    def to_list(self):
+        return [record.to_dict() for record in self._records]
+
+    def since(self, cursor):
+        """Records with a sequence number above ``cursor``, oldest first.
+
+        Walks back from the newest record, so the cost is proportional to
+        the number of new records rather than the buffer size.
+        """
+        newer = []
+        for record in reversed(self._records):
+            if record.seq <= cursor:
+                break
+            newer.append(record)
+        newer.reverse()
+        return newer
+
+    @property
+    def oldest_seq(self):
+        """Sequence number of the oldest record still held (next_seq if empty)."""
+        return self._records[0].seq if self._records else self.next_seq
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+# iptables -m limit units, in seconds
+LIMIT_UNITS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+DEFAULT_LIMIT_BURST = 5
+
+def parse_limit(spec):
+    """Parse an iptables-style rate such as '10/second' or '3/min' into entries per second."""
+    count, _, unit = spec.partition('/')
+    seconds = next((s for name, s in LIMIT_UNITS.items() if name.startswith(unit or 'second')), None)
+    try:
+        rate = float(count)
+    except ValueError:
+        rate = 0
+    if seconds is None or rate <= 0:
+        raise ValueError(f"invalid rate {spec}")
+    return rate / seconds
+
+class LogPolicy:
+    """Per-session controls on the volume of packet log entries.
+
+    With a ``window`` (seconds), identical (action, source, destination,
+    protocol, rule) events are folded into one pending entry whose count
+    grows until the window closes; it is logged then. Entries leaving
+    aggregation pass a per-rule token bucket (``limit`` entries per second
+    with ``burst``, like ``-m limit``) and 1-in-``sample`` sampling. Packets
+    behind dropped entries are counted in ``suppressed``. The defaults log
+    every entry. Info and warning entries are never throttled.
+    """
+
+    def __init__(self):
+        self.window = 0
+        self.sample = 1
+        self.limit = None
+        self.limit_spec = None
+        self.burst = DEFAULT_LIMIT_BURST
+        self.suppressed = 0
+        self._pending = {}
+        # Raw ports of each pending entry, formatted when its window closes
+        self._ports = {}
+        self._buckets = {}
+        self._seen = 0
+
+    def set_limit(self, spec, burst=DEFAULT_LIMIT_BURST):
+        """Set the per-rule rate from a spec like '10/second', or None to remove it."""
+        self.limit = parse_limit(spec) if spec else None
+        self.limit_spec = spec
+        self.burst = burst
+        self._buckets.clear()
+
+    def aggregate(self, record):
+        """Fold ``record`` into its open window; False if aggregation is off."""
+        if not self.window:
+            return False
+        key = (record.action, record.source, record.destination, record.protocol, record.rule)
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = record
+            self._ports[key] = {record.port}
+        else:
+            pending.count += record.count
+            self._ports[key].add(record.port)
+        return True
+
+    def expired(self, now, everything=False):
+        """Pop the pending entries whose window has closed, oldest first."""
+        closed = []
+        # Windows are the same length, so insertion order is closing order
+        for key, record in self._pending.items():
+            if not everything and now - record.created < self.window:
+                break
+            closed.append(key)
+        records = []
+        for key in closed:
+            record = self._pending.pop(key)
+            ports = [port for port in self._ports.pop(key) if port is not None]
+            if len(ports) > 1 or record.port is None:
+                record.port = format_port_list(ports) if ports else None
+            records.append(record)
+        return records
+
+    def admit(self, record, now):
+        """Apply the rate limit and sampling; False if the entry is dropped."""
+        if self.limit is not None:
+            bucket = self._buckets.setdefault(record.rule, [self.burst, now])
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.limit)
+            bucket[1] = now
+            if bucket[0] < 1:
+                self.suppressed += record.count
+                return False
+            bucket[0] -= 1
+        if self.sample > 1:
+            self._seen += 1
+            if self._seen % self.sample:
+                self.suppressed += record.count
+                return False
+        return True
+
+    def clear(self):
+        """Forget pending entries and the suppressed count, keeping the settings."""
+        self._pending.clear()
+        self._ports.clear()
+        self.suppressed = 0
+
+    def next_close(self):
+        """Time the oldest open window closes, or None if none is open."""
+        for record in self._pending.values():
+            return record.created + self.window
+        return None
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+# Seconds a tracked connection stays alive without traffic, per protocol
+CONNTRACK_TIMEOUTS = {'tcp': 600, 'udp': 120, 'icmp': 30}
+CONNTRACK_DEFAULT_TIMEOUT = 60
+CONNTRACK_STATES = {'NEW', 'ESTABLISHED', 'RELATED', 'INVALID'}
+
+class ConntrackTable:
+    """Bounded connection tracking table keyed by 5-tuple.
+
+    Entries are ``[expires, packets, bytes]`` in an OrderedDict kept in
+    last-seen order: expired entries are dropped when looked up or when they
+    reach the front, and the least recently seen entry is evicted once
+    ``max_entries`` is reached. Flows carry no source port, so the source
+    port of every tuple is None.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def lookup(self, key, now):
+        """Return the live entry for ``key``, or None."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._entries[key]
+            return None
+        return entry
+
+    def track(self, key, now, packets=1):
+        """Create or refresh the entry for an accepted flow."""
+        timeout = CONNTRACK_TIMEOUTS.get(key[0], CONNTRACK_DEFAULT_TIMEOUT)
+        entry = self._entries.get(key)
+        if entry is None:
+            self._expire(now)
+            if len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+            entry = self._entries[key] = [0, 0, 0]
+        else:
+            self._entries.move_to_end(key)
+        entry[0] = now + timeout
+        entry[1] += packets
+        entry[2] += sum(random.randint(40, 1500) for _ in range(packets))
+
+    def _expire(self, now):
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry[0] > now:
+                break
+            del self._entries[key]
+
+    def flush(self):
+        self._entries.clear()
+
+    def items(self, now):
+        """Live (key, entry) pairs, least recently seen first."""
+        self._expire(now)
+        return [(key, entry) for key, entry in self._entries.items() if entry[0] > now]
+
+    def __len__(self):
+        return len(self._entries)
+
+VERDICT_CACHE_SIZE = 4096
+
+class VerdictCache:
+    """Per-session LRU cache of flow evaluation results.
+
+    Entries are keyed by (chain, source, destination, protocol, port,
+    conntrack state) and belong to one ruleset generation: a lookup with a
+    newer generation empties the cache first. Entries are not persisted
+    with the session, only the hit and miss counts are.
+    """
+
+    def __init__(self, max_entries=VERDICT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, generation):
+        if generation != self.generation:
+            self._entries.clear()
+            self.generation = generation
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        self._entries[key] = entry
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_entries'] = OrderedDict()
+        return state
+
+    def __len__(self):
+        return len(self._entries)
 
 def get_default_state():
     """Returns a deep copy of the default simulation state."""
@@ -30,19 +587,510 @@ def get_default_state():
         },
         'iptables_rules': { 'INPUT': [], 'OUTPUT': [], 'FORWARD': [] },
         'rule_counters': { 'INPUT': [], 'OUTPUT': [], 'FORWARD': [] },
-        'firewall_logs': []
+        'chain_keys': { 'INPUT': None, 'OUTPUT': None, 'FORWARD': None },
+        'chain_policies': { 'INPUT': 'DROP', 'OUTPUT': 'DROP', 'FORWARD': 'DROP' },
+        'policy_counters': {
+            'INPUT': {'packets': 0, 'bytes': 0},
+            'OUTPUT': {'packets': 0, 'bytes': 0},
+            'FORWARD': {'packets': 0, 'bytes': 0}
+        },
+        'ipsets': {},
+        'set_keys': {},
+        'conntrack': ConntrackTable(app.config['CONNTRACK_MAX']),
+        'ruleset_generation': 0,
+        'verdict_cache': VerdictCache(),
+        'firewall_logs': LogBuffer(MAX_LOGS),
+        'log_policy': LogPolicy(),
+        'topology': Topology(),
+        'ruleset': None
     })
 
-def log_firewall_event(action, source, destination, protocol, port, rule_info="", category="normal"):
-    """Log firewall events with enhanced details to the current session."""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+class StateStore:
+    """Server-side storage for per-session simulation state.
+
+    The Flask session cookie only carries the session id; the state itself
+    lives in a backend that expires entries after ``lifetime`` seconds of
+    inactivity.
+    """
+
+    def __init__(self, lifetime):
+        self.lifetime = lifetime
+
+    def load(self, sid, touch=True):
+        """Return the state stored for ``sid``, or None if missing or expired.
+
+        Loading counts as activity and refreshes the expiry unless ``touch``
+        is False (background work must not keep a session alive).
+        """
+        raise NotImplementedError
+
+    def save(self, sid, state, touch=True):
+        """Store ``state`` for ``sid`` and refresh its expiry.
+
+        With ``touch`` False the expiry is kept, and nothing is written if
+        the session has already expired.
+        """
+        raise NotImplementedError
+
+    def delete(self, sid):
+        raise NotImplementedError
+
+    def save_ruleset(self, published):
+        """Store a published ruleset under its name; rulesets do not expire."""
+        raise NotImplementedError
+
+    def load_ruleset(self, name):
+        """Return the latest PublishedRuleset stored under ``name``, or None."""
+        raise NotImplementedError
+
+    def ruleset_version(self, name):
+        """Version of the ruleset stored under ``name`` (None if there is none), without loading it."""
+        raise NotImplementedError
+
+    def ruleset_names(self):
+        raise NotImplementedError
+
+    def log_buffer_entries(self):
+        """Total buffered log entries, or None if the backend cannot count them cheaply."""
+        return None
+
+class MemoryStateStore(StateStore):
+    """In-process LRU store; the least recently used session is evicted first."""
+
+    def __init__(self, lifetime, max_sessions=1000):
+        super().__init__(lifetime)
+        self.max_sessions = max_sessions
+        self._entries = OrderedDict()
+        self._rulesets = {}
+
+    def _purge_expired(self, now):
+        # Entries are kept in access order with a fixed lifetime, so the
+        # oldest entries are always the first to expire.
+        while self._entries:
+            sid, (expires, _) = next(iter(self._entries.items()))
+            if expires > now:
+                break
+            del self._entries[sid]
+
+    def load(self, sid, touch=True):
+        now = time.time()
+        self._purge_expired(now)
+        entry = self._entries.get(sid)
+        if entry is None:
+            return None
+        if touch:
+            self._entries[sid] = (now + self.lifetime, entry[1])
+            self._entries.move_to_end(sid)
+        return entry[1]
+
+    def save(self, sid, state, touch=True):
+        if not touch:
+            entry = self._entries.get(sid)
+            if entry is not None and entry[0] > time.time():
+                self._entries[sid] = (entry[0], state)
+            return
+        self._entries[sid] = (time.time() + self.lifetime, state)
+        self._entries.move_to_end(sid)
+        while len(self._entries) > self.max_sessions:
+            self._entries.popitem(last=False)
+
+    def delete(self, sid):
+        self._entries.pop(sid, None)
+
+    def save_ruleset(self, published):
+        self._rulesets[published.name] = published
+
+    def load_ruleset(self, name):
+        return self._rulesets.get(name)
+
+    def ruleset_version(self, name):
+        published = self._rulesets.get(name)
+        return published.version if published is not None else None
+
+    def ruleset_names(self):
+        return list(self._rulesets)
+
+    def log_buffer_entries(self):
+        return sum(len(state['firewall_logs']) for _, state in self._entries.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+class SQLiteStateStore(StateStore):
+    """File-backed store, so state survives restarts and can be shared by workers on one host."""
+
+    PURGE_INTERVAL = 60
+
+    def __init__(self, lifetime, path):
+        super().__init__(lifetime)
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS sim_state ('
+            ' sid TEXT PRIMARY KEY, expires REAL NOT NULL, data BLOB NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS sim_state_expires ON sim_state (expires)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS published_rulesets ('
+            ' name TEXT PRIMARY KEY, version INTEGER NOT NULL, data BLOB NOT NULL)'
+        )
+        self._last_purge = 0
+
+    def _purge_expired(self, now):
+        if now - self._last_purge >= self.PURGE_INTERVAL:
+            self._conn.execute('DELETE FROM sim_state WHERE expires <= ?', (now,))
+            self._last_purge = now
+
+    def load(self, sid, touch=True):
+        now = time.time()
+        self._purge_expired(now)
+        row = self._conn.execute(
+            'SELECT data FROM sim_state WHERE sid = ? AND expires > ?', (sid, now)
+        ).fetchone()
+        if row is None:
+            return None
+        if touch:
+            self._conn.execute('UPDATE sim_state SET expires = ? WHERE sid = ?', (now + self.lifetime, sid))
+        return pickle.loads(row[0])
+
+    def save(self, sid, state, touch=True):
+        data = pickle.dumps(storable_state(state), pickle.HIGHEST_PROTOCOL)
+        STATE_SIZE.observe(len(data))
+        if not touch:
+            self._conn.execute('UPDATE sim_state SET data = ? WHERE sid = ? AND expires > ?',
+                               (data, sid, time.time()))
+            return
+        self._conn.execute(
+            'INSERT OR REPLACE INTO sim_state (sid, expires, data) VALUES (?, ?, ?)',
+            (sid, time.time() + self.lifetime, data)
+        )
+
+    def delete(self, sid):
+        self._conn.execute('DELETE FROM sim_state WHERE sid = ?', (sid,))
+
+    def save_ruleset(self, published):
+        self._conn.execute('INSERT OR REPLACE INTO published_rulesets (name, version, data) VALUES (?, ?, ?)',
+                           (published.name, published.version, pickle.dumps(published, pickle.HIGHEST_PROTOCOL)))
+
+    def load_ruleset(self, name):
+        row = self._conn.execute('SELECT data FROM published_rulesets WHERE name = ?', (name,)).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def ruleset_version(self, name):
+        row = self._conn.execute('SELECT version FROM published_rulesets WHERE name = ?', (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def ruleset_names(self):
+        return [row[0] for row in self._conn.execute('SELECT name FROM published_rulesets ORDER BY name')]
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM sim_state').fetchone()[0]
+
+class RedisStateStore(StateStore):
+    """Redis-backed store shared by every worker and container."""
+
+    def __init__(self, lifetime, url):
+        super().__init__(lifetime)
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('Redis package is not installed '
+                               '(Run "pip install redis" in your virtualenv).')
+        self._redis = redis.Redis.from_url(url)
+
+    @staticmethod
+    def _key(sid):
+        return f"sim_state:{sid}"
+
+    def load(self, sid, touch=True):
+        if not touch:
+            data = self._redis.get(self._key(sid))
+            return pickle.loads(data) if data is not None else None
+        pipe = self._redis.pipeline()
+        pipe.get(self._key(sid))
+        pipe.expire(self._key(sid), int(self.lifetime))
+        data, _ = pipe.execute()
+        return pickle.loads(data) if data is not None else None
+
+    def save(self, sid, state, touch=True):
+        data = pickle.dumps(storable_state(state), pickle.HIGHEST_PROTOCOL)
+        STATE_SIZE.observe(len(data))
+        if not touch:
+            # Only overwrite a live key, keeping its remaining lifetime
+            self._redis.set(self._key(sid), data, xx=True, keepttl=True)
+            return
+        self._redis.set(self._key(sid), data, ex=int(self.lifetime))
+
+    def delete(self, sid):
+        self._redis.delete(self._key(sid))
+
+    def save_ruleset(self, published):
+        pipe = self._redis.pipeline()
+        pipe.set(f"ruleset:{published.name}", pickle.dumps(published, pickle.HIGHEST_PROTOCOL))
+        pipe.set(f"ruleset_version:{published.name}", published.version)
+        pipe.sadd('rulesets', published.name)
+        pipe.execute()
+
+    def load_ruleset(self, name):
+        data = self._redis.get(f"ruleset:{name}")
+        return pickle.loads(data) if data is not None else None
+
+    def ruleset_version(self, name):
+        version = self._redis.get(f"ruleset_version:{name}")
+        return int(version) if version is not None else None
+
+    def ruleset_names(self):
+        return sorted(name.decode() for name in self._redis.smembers('rulesets'))
+
+    def __len__(self):
+        return sum(1 for _ in self._redis.scan_iter(self._key('*')))
+
+def create_state_store(config):
+    """Build the state backend selected by ``STATE_BACKEND``."""
+    lifetime = config['PERMANENT_SESSION_LIFETIME'].total_seconds()
+    backend = config['STATE_BACKEND']
+    if backend == 'memory':
+        return MemoryStateStore(lifetime, config['STATE_MAX_SESSIONS'])
+    if backend == 'sqlite':
+        return SQLiteStateStore(lifetime, config['STATE_DB_PATH'])
+    if backend == 'redis':
+        return RedisStateStore(lifetime, config['STATE_REDIS_URL'])
+    raise ValueError(f"Unknown STATE_BACKEND: {backend}")
+
+state_store = create_state_store(app.config)
+
+class SessionLocks:
+    """One lock per session id, held from loading a session's state until it is saved.
+
+    Socket events, HTTP requests and background jobs of the same session
+    each work on their own copy of the state with the sqlite and redis
+    stores; holding the lock keeps one from overwriting the other's
+    changes. Locks are per process, which is enough because the sticky
+    load balancer sends all of a session's connections to one instance.
+    """
+
+    def __init__(self):
+        self._locks = {}
+
+    def acquire(self, sid):
+        entry = self._locks.setdefault(sid, [threading.Lock(), 0])
+        entry[1] += 1
+        entry[0].acquire()
+
+    def release(self, sid):
+        entry = self._locks[sid]
+        entry[0].release()
+        entry[1] -= 1
+        if not entry[1]:
+            del self._locks[sid]
+
+    @contextmanager
+    def hold(self, sid):
+        self.acquire(sid)
+        try:
+            yield
+        finally:
+            self.release(sid)
+
+session_locks = SessionLocks()
+
+ARCHIVE_COLUMNS = ('sid', 'seq', 'created', 'action', 'source', 'destination', 'protocol',
+                   'port', 'rule', 'category', 'warning', 'count')
+
+class LogArchive:
+    """Append-only SQLite archive of every session's log entries.
+
+    append() only queues a row; a background task writes the queue in one
+    transaction every ``FLUSH_INTERVAL`` seconds, or sooner once
+    ``FLUSH_SIZE`` rows are waiting. Writes use their own connection in a
+    native thread (eventlet.tpool), so sqlite never blocks the event loop,
+    and WAL lets reads go on meanwhile. Reads flush first, so they see every
+    entry logged so far. Entries keep their buffer sequence numbers and
+    are indexed by session with time, action, source and rule, and read
+    back in pages of ``page_size`` rows. Entries older than
+    ``retention`` seconds are purged.
+    """
+
+    FLUSH_INTERVAL = 0.5
+    FLUSH_SIZE = 1000
+    PURGE_INTERVAL = 3600
+
+    def __init__(self, path, retention):
+        self.path = path
+        self.retention = retention
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS log_archive ('
+            ' sid TEXT NOT NULL, seq INTEGER NOT NULL, created REAL NOT NULL,'
+            ' action TEXT, source TEXT, destination TEXT, protocol TEXT, port TEXT,'
+            ' rule TEXT, category TEXT, warning TEXT, count INTEGER NOT NULL,'
+            ' PRIMARY KEY (sid, seq))'
+        )
+        for column in ('created', 'action', 'source', 'rule'):
+            self._conn.execute(f'CREATE INDEX IF NOT EXISTS log_archive_{column} ON log_archive (sid, {column}, seq)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS log_archive_purge ON log_archive (created)')
+        self._write_conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._queue = []
+        self._writer = None
+        self._last_purge = 0
+
+    def append(self, sid, record):
+        self._queue.append((sid, record.seq, record.created, record.action, record.source,
+                            record.destination, record.protocol, record.port, record.rule,
+                            record.category, record.warning, record.count))
+        if self._writer is None:
+            self._writer = socketio.start_background_task(self._write_loop)
+        if len(self._queue) >= self.FLUSH_SIZE:
+            self._wake.set()
+
+    def _write_loop(self):
+        while True:
+            self._wake.wait(self.FLUSH_INTERVAL)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write queued rows in one transaction, waiting for it without blocking other greenlets."""
+        with self._write_lock:
+            rows, self._queue = self._queue, []
+            now = time.time()
+            purge = now - self._last_purge >= self.PURGE_INTERVAL
+            if not rows and not purge:
+                return
+            tpool.execute(self._write, rows, now - self.retention if purge else None)
+            if purge:
+                self._last_purge = now
+
+    def _write(self, rows, purge_before=None, delete_sid=None):
+        """Run in a native thread: insert ``rows`` and purge or delete entries, in one transaction."""
+        conn = self._write_conn
+        conn.execute('BEGIN')
+        try:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO log_archive VALUES ({', '.join('?' * len(ARCHIVE_COLUMNS))})", rows
+            )
+            if purge_before is not None:
+                conn.execute('DELETE FROM log_archive WHERE created < ?', (purge_before,))
+            if delete_sid is not None:
+                conn.execute('DELETE FROM log_archive WHERE sid = ?', (delete_sid,))
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def records(self, sid, since=0, conditions=((), ()), page_size=LOG_PAGE_SIZE):
+        """Yield a session's LogRecords after ``since``, oldest first.
 
-    # Sanitize all inputs to prevent XSS
-    source = html.escape(str(source))
-    destination = html.escape(str(destination))
-    protocol = html.escape(str(protocol))
-    port = html.escape(str(port)) if port is not None else None
-    rule_info = html.escape(rule_info)
+        ``conditions`` is a (clauses, arguments) pair from archive_conditions.
+        Rows are fetched ``page_size`` at a time, so memory stays bounded
+        however long the history is.
+        """
+        self.flush()
+        clauses, arguments = conditions
+        where = ' AND '.join(('sid = ?', 'seq > ?') + tuple(clauses))
+        query = f"SELECT {', '.join(ARCHIVE_COLUMNS[1:])} FROM log_archive WHERE {where} ORDER BY seq LIMIT ?"
+        while True:
+            rows = self._conn.execute(query, (sid, since, *arguments, page_size)).fetchall()
+            for row in rows:
+                seq = row[0]
+                yield LogRecord(*row[1:], seq=seq)
+            if len(rows) < page_size:
+                return
+            since = rows[-1][0]
+
+    def stats(self, sid):
+        """Return the same totals as LogBuffer.stats over the session's whole archive."""
+        self.flush()
+        total, blocked, allowed, warnings = self._conn.execute(
+            "SELECT COALESCE(SUM(count), 0),"
+            " COALESCE(SUM(CASE WHEN action IN ('DROP', 'REJECT') THEN count END), 0),"
+            " COALESCE(SUM(CASE WHEN action = 'ACCEPT' THEN count END), 0),"
+            " COALESCE(SUM(CASE WHEN category = 'warning' THEN count END), 0)"
+            " FROM log_archive WHERE sid = ?", (sid,)
+        ).fetchone()
+        return {'total': total, 'blocked': blocked, 'allowed': allowed, 'warnings': warnings}
+
+    def last_seq(self, sid):
+        self.flush()
+        return self._conn.execute('SELECT MAX(seq) FROM log_archive WHERE sid = ?', (sid,)).fetchone()[0] or 0
+
+    def oldest_seq(self, sid):
+        self.flush()
+        return self._conn.execute('SELECT MIN(seq) FROM log_archive WHERE sid = ?', (sid,)).fetchone()[0]
+
+    def delete(self, sid):
+        with self._write_lock:
+            rows, self._queue = self._queue, []
+            tpool.execute(self._write, [row for row in rows if row[0] != sid], delete_sid=sid)
+
+log_archive = (LogArchive(app.config['LOG_ARCHIVE_PATH'], app.config['LOG_ARCHIVE_DAYS'] * 86400)
+               if app.config['LOG_ARCHIVE_PATH'] else None)
+
+metrics.register(MetricGauge('simulator_active_sessions', 'Sessions held by the state store.',
+                             callback=lambda: len(state_store)))
+metrics.register(MetricGauge('simulator_log_buffer_entries', 'Log entries buffered across all sessions.',
+                             callback=lambda: state_store.log_buffer_entries()))
+
+def ensure_session_id():
+    """Return the id stored in the session cookie, assigning a new one if needed."""
+    if 'sid' not in session:
+        session.permanent = True
+        session['sid'] = uuid.uuid4().hex
+    return session['sid']
+
+def current_sid():
+    """Id of the session being served: the request's, or the one a background job works for."""
+    sid = g.get('sid')
+    return sid if sid is not None else session['sid']
+
+def get_state():
+    """Return the simulation state for the current session."""
+    state = g.get('sim_state')
+    if state is None:
+        init_session_if_needed()
+        state = g.sim_state
+    return state
+
+def session_room(sid=None):
+    """Name of the Socket.IO room shared by all connections of a session."""
+    return f"session:{sid or current_sid()}"
+
+def emit_to_session(event, data, sid=None):
+    """Emit a server-initiated event to the current session's clients only."""
+    EMITS.inc(event=event)
+    socketio.emit(event, data, to=session_room(sid))
+
+def flush_pending_logs():
+    """Send logs queued in batched emit mode as a single new_logs message."""
+    pending = g.pop('pending_logs', None)
+    if pending:
+        emit_to_session('new_logs', {'logs': [record.to_dict() for record in pending]})
+
+def mark_state_modified():
+    """Flag the current state to be written back to the store at teardown."""
+    g.sim_state_dirty = True
+
+def _port_out_of_range(port):
+    """True if any port in a (possibly grouped) port spec exceeds 65535."""
+    return any(int(p) > 65535 for p in re.findall(r'\d+', port))
+
+def log_firewall_event(action, source, destination, protocol, port, rule_info="", category="normal", count=1):
+    """Log firewall events with enhanced details to the current session.
+
+    ``count`` is the number of packets a grouped entry stands for. Packet
+    entries go through the session's LogPolicy first and may be aggregated,
+    rate limited or sampled away.
+    """
+    state = get_state()
+    now = time.time()
+    source = str(source)
+    destination = str(destination)
+    protocol = str(protocol)
+    port = str(port) if port is not None else None
     
     # Detect potential misconfigurations
     warning = None
@@ -51,544 +1099,3551 @@ def log_firewall_event(action, source, destination, protocol, port, rule_info=""
         if source == destination:
             warning = "MISCONFIGURATION: Source and destination are the same"
             category = "warning"
-        elif port and int(port) > 65535:
+        elif port and _port_out_of_range(port):
             warning = "MISCONFIGURATION: Invalid port number"
             category = "warning"
     
-    log_entry = {
-        'timestamp': timestamp,
-        'action': action,
-        'source': source,
-        'destination': destination,
-        'protocol': protocol,
-        'port': port,
-        'rule': rule_info,
-        'category': category,
-        'warning': html.escape(warning) if warning else None,
-        'details': f"{action} traffic from {source} to {destination} ({protocol}" + (f":{port}" if port else "") + ")"
-    }
-    session['firewall_logs'].append(log_entry)
-    
-    # Keep only last MAX_LOGS entries
-    if len(session['firewall_logs']) > MAX_LOGS:
-        session['firewall_logs'] = session['firewall_logs'][-MAX_LOGS:]
-    session.modified = True
-    
-    # Broadcast log to the current client
-    socketio.emit('new_log', log_entry)
+    record = LogRecord(now, action, source, destination, protocol, port,
+                       rule_info, category, warning, count=count)
+    policy = state['log_policy']
+    flush_log_windows(state, now)
+    if category != "normal":
+        append_log(state, record)
+    elif policy.aggregate(record):
+        schedule_log_flush(current_sid(), policy.window)
+    elif policy.admit(record, now):
+        append_log(state, record)
+    mark_state_modified()
 
-def detect_rule_conflicts():
-    """Detect potential rule conflicts and misconfigurations from the session."""
-    warnings = []
+def append_log(state, record):
+    """Add an entry to the session's buffer and send it to its clients."""
+    # The buffer evicts the oldest entry once MAX_LOGS is reached
+    state['firewall_logs'].append(record)
+    if log_archive is not None:
+        log_archive.append(current_sid(), record)
     
-    for chain in ['INPUT', 'OUTPUT', 'FORWARD']:
-        rules = session['iptables_rules'][chain]
-        
-        # Check for conflicting rules
-        for i, rule1 in enumerate(rules):
-            for j, rule2 in enumerate(rules[i+1:], i+1):
-                # Check if rules overlap but have different targets
-                if (rule1['source'] == rule2['source'] and 
-                    rule1['destination'] == rule2['destination'] and
-                    rule1['protocol'] == rule2['protocol'] and
-                    rule1['dport'] == rule2['dport'] and
-                    rule1['target'] != rule2['target']):
-                    warnings.append({
-                        'type': 'CONFLICT',
-                        'chain': chain,
-                        'rules': [i+1, j+1],
-                        'message': f"Rules {i+1} and {j+1} in {chain} chain conflict"
-                    })
-        
-        # Check for unreachable rules (rules after DROP/REJECT ALL)
-        for i, rule in enumerate(rules):
-            if (rule['target'] in ['DROP', 'REJECT'] and 
-                rule['source'] == '0.0.0.0/0' and 
-                rule['destination'] == '0.0.0.0/0' and
-                i < len(rules) - 1):
-                warnings.append({
-                    'type': 'UNREACHABLE',
-                    'chain': chain,
-                    'rule': i+1,
-                    'message': f"Rules after rule {i+1} in {chain} are unreachable (DROP/REJECT ALL)"
-                })
+    # Send log to the clients of the current session only
+    if app.config['BATCH_LOG_EMITS'] or g.get('batch_logs'):
+        g.setdefault('pending_logs', []).append(record)
+    else:
+        emit_to_session('new_log', record.to_dict())
+
+def flush_log_windows(state, now=None, everything=False):
+    """Log the aggregated entries whose window has closed (all with ``everything``)."""
+    policy = state['log_policy']
+    if not policy.pending:
+        return
+    now = time.time() if now is None else now
+    for record in policy.expired(now, everything):
+        if policy.admit(record, now):
+            append_log(state, record)
+    mark_state_modified()
+
+# Sessions with a timer waiting for their next aggregation window to close
+_log_flush_timers = set()
+
+def schedule_log_flush(sid, delay):
+    """Make sure the session's open windows are logged when they close, even if nothing else happens."""
+    if sid not in _log_flush_timers:
+        _log_flush_timers.add(sid)
+        socketio.start_background_task(run_log_flush, sid, delay)
+
+def run_log_flush(sid, delay):
+    """Background task: log a session's aggregated entries as their windows close."""
+    while True:
+        socketio.sleep(delay)
+        with session_context(sid) as state:
+            due = None
+            if state is not None:
+                flush_log_windows(state)
+                due = state['log_policy'].next_close()
+            if due is None:
+                # Still under the session lock, so a new window schedules a new timer
+                _log_flush_timers.discard(sid)
                 break
-    
-    return warnings
+            delay = max(0, due - time.time())
 
-def ip_in_network(ip, network):
-    """Check if IP is in network range"""
-    try:
-        return ipaddress.ip_address(ip) in ipaddress.ip_network(network, strict=False)
-    except:
-        return False
+# Compiled chains are shared between sessions with identical rules, keyed by
+# a fingerprint of the rule list, so each distinct ruleset is compiled once.
+COMPILED_CHAIN_CACHE_SIZE = 256
+_compiled_chains = OrderedDict()
+# Chains of published rulesets stay compiled for as long as they are published
+_pinned_chains = {}
 
-def check_iptables_rule(chain, source_ip, dest_ip, protocol, port):
-    """Check if traffic matches iptables rules in the current session."""
-    rules = session['iptables_rules'].get(chain, [])
-    
-    for idx, rule in enumerate(rules):
-        # Check source
-        if rule['source'] and rule['source'] != '0.0.0.0/0':
-            if '/' in rule['source']:
-                if not ip_in_network(source_ip, rule['source']):
-                    continue
-            elif source_ip != rule['source']:
-                continue
-        
-        # Check destination
-        if rule['destination'] and rule['destination'] != '0.0.0.0/0':
-            if '/' in rule['destination']:
-                if not ip_in_network(dest_ip, rule['destination']):
-                    continue
-            elif dest_ip != rule['destination']:
-                continue
-        
-        # Check protocol
-        if rule['protocol'] and rule['protocol'] != 'all':
-            if protocol.lower() != rule['protocol'].lower():
-                continue
-        
-        # Check port
-        if rule['dport'] and port:
-            if str(port) != str(rule['dport']):
+# Sentinel address spec for rules whose CIDR failed to parse (never matches)
+_NEVER_MATCH = (0, 0, 0)
+# Sentinel index keys for protocols/ports that no rule in the chain mentions
+_OTHER = object()
+_ANY_PORT = object()
+
+class CompiledRule:
+    """A single iptables rule reduced to integer and normalized fields.
+
+    ``dport`` is None (any port) or a tuple of merged (low, high) intervals;
+    ``sets`` is None or a tuple of (set name, 'src' | 'dst') matches;
+    ``ctstates`` is None or the conntrack states the rule accepts.
+    """
+    __slots__ = ('index', 'source', 'destination', 'protocol', 'dport', 'sets', 'ctstates', 'target')
+
+    def __init__(self, index, rule):
+        self.index = index
+        self.source = _compile_address(rule['source'])
+        self.destination = _compile_address(rule['destination'])
+        protocol = (rule['protocol'] or 'all').lower()
+        self.protocol = None if protocol == 'all' else protocol
+        self.dport = _compile_ports(rule['dport'])
+        self.sets = tuple((rule[key], direction)
+                          for key, direction in (('src_set', 'src'), ('dst_set', 'dst'))
+                          if rule.get(key)) or None
+        ctstate = rule.get('ctstate')
+        self.ctstates = frozenset(ctstate.upper().split(',')) if ctstate else None
+        self.target = rule['target']
+
+class CompiledChain:
+    """Rules of one chain indexed by protocol and destination port.
+
+    The port space is cut into segments at every rule's interval bounds, so
+    all ports of a segment match the same rules. Candidate lists are built
+    lazily per (protocol, segment) bucket and keep chain order, so
+    first-match semantics are preserved.
+
+    ``established_accept`` is the index of an unconditional
+    ``--state ESTABLISHED -j ACCEPT`` rule that is the first rule able to
+    match established packets; such packets are accepted by it directly.
+    ``jumps`` names the user-defined chains the rules jump to.
+    """
+    __slots__ = ('rules', 'set_names', 'jumps', 'uses_ctstate', 'established_accept',
+                 '_protocols', '_bounds', '_candidates', '_findings')
+
+    def __init__(self, rules):
+        self.rules = [CompiledRule(idx, rule) for idx, rule in enumerate(rules)]
+        self.set_names = {name for r in self.rules if r.sets for name, _ in r.sets}
+        self.jumps = {r.target for r in self.rules if r.target not in RULE_TARGETS}
+        self._protocols = {r.protocol for r in self.rules if r.protocol is not None}
+        bounds = {0}
+        for r in self.rules:
+            for low, high in r.dport or ():
+                bounds.add(low)
+                bounds.add(high + 1)
+        self._bounds = sorted(bounds)
+        self._candidates = {}
+        self._findings = None
+
+        self.uses_ctstate = any(r.ctstates is not None for r in self.rules)
+        self.established_accept = None
+        for r in self.rules:
+            if r.ctstates is not None and 'ESTABLISHED' not in r.ctstates:
                 continue
-        
-        # Rule matched - increment counter
-        if idx < len(session['rule_counters'][chain]):
-            session['rule_counters'][chain][idx]['packets'] += 1
-            session['rule_counters'][chain][idx]['bytes'] += random.randint(40, 1500)
-            session.modified = True
-        
-        # Log if LOG action
-        if rule['target'] == 'LOG':
-            log_firewall_event('LOG', source_ip, dest_ip, protocol, port, f"{chain} rule {idx+1}")
-            continue  # LOG doesn't stop processing
-        
-        # Return action
-        if rule['target'] == 'ACCEPT':
-            log_firewall_event('ACCEPT', source_ip, dest_ip, protocol, port, f"{chain} rule {idx+1}")
-            return True, f"ACCEPT by {chain} rule {idx+1}"
-        elif rule['target'] == 'DROP':
-            log_firewall_event('DROP', source_ip, dest_ip, protocol, port, f"{chain} rule {idx+1}")
-            return False, f"DROP by {chain} rule {idx+1}"
-        elif rule['target'] == 'REJECT':
-            log_firewall_event('REJECT', source_ip, dest_ip, protocol, port, f"{chain} rule {idx+1}")
-            return False, f"REJECT by {chain} rule {idx+1}"
-    
-    # Default policy - DROP
-    log_firewall_event('DROP', source_ip, dest_ip, protocol, port, "Default policy")
-    return False, "DROP by default policy"
+            if (r.target == 'ACCEPT' and r.ctstates is not None and r.source is None
+                    and r.destination is None and r.protocol is None and r.dport is None and r.sets is None):
+                self.established_accept = r.index
+            break
 
-def calculate_network(ip_address):
-    """Calculate network address from IP"""
-    try:
-        ip = ipaddress.ip_address(ip_address)
-        # Create network with /24 mask
-        network = ipaddress.ip_network(f"{ip_address}/24", strict=False)
-        gateway = str(network.network_address + 1)  # .1 is typically gateway
-        return str(network), gateway
-    except:
-        return None, None
+    def findings(self):
+        """Return the cached rule-set analysis for this chain (see analyze_chain)."""
+        if self._findings is None:
+            self._findings = analyze_chain(self)
+        return self._findings
 
-def handle_ifconfig_command(terminal, parts):
-    """Handle ifconfig commands within the current session."""
-    if len(parts) == 1:
-        # Show current configuration
-        config = session['network_config'][terminal]
-        if config['ip']:
-            output = f"eth0: flags=4163<UP,BROADCAST,RUNNING,MULTICAST>  mtu 1500\n"
-            output += f"        inet {config['ip']}  netmask {config['netmask']}  broadcast {config['gateway']}\n"
-            output += f"        ether 02:42:ac:11:00:{random.randint(10,99)}  txqueuelen 0  (Ethernet)\n"
-            output += f"        RX packets 1234  bytes 567890 (567.8 KB)\n"
-            output += f"        TX packets 987  bytes 123456 (123.4 KB)\n\n"
-            output += f"Zone: {config['zone']}\n"
-            output += f"Network: {config['network']}\n"
-            return output
+    def candidates(self, protocol, port):
+        """Return the rules that can match a packet, in chain order."""
+        proto_key = protocol if protocol in self._protocols else _OTHER
+        if port is None:
+            port_key = _ANY_PORT
+        elif port.__class__ is int:
+            port_key = bisect.bisect_right(self._bounds, port) - 1
         else:
-            return f"eth0: No IP address configured\nUse: ifconfig set ip <ip_address>\n"
-    
-    elif len(parts) >= 4 and parts[1] == 'set' and parts[2] == 'ip':
-        # Set IP address
-        ip = parts[3]
-        try:
-            # Validate IP
-            ipaddress.ip_address(ip)
-            
-            # Calculate network and gateway
-            network, gateway = calculate_network(ip)
-            
-            # Update configuration in session
-            session['network_config'][terminal]['ip'] = ip
-            session['network_config'][terminal]['network'] = network
-            session['network_config'][terminal]['gateway'] = gateway
-            session.modified = True
-            
-            # Update display
-            socketio.emit('update_ip_display', {
-                'terminal': terminal,
+            port_key = _OTHER
+
+        key = (proto_key, port_key)
+        bucket = self._candidates.get(key)
+        if bucket is None:
+            # Any port of the segment decides membership for the whole bucket
+            bucket = [
+                r for r in self.rules
+                if (r.protocol is None or r.protocol == proto_key)
+                and (port_key is _ANY_PORT or r.dport is None
+                     or port_key is not _OTHER and _ports_contain(r.dport, port))
+            ]
+            self._candidates[key] = bucket
+        return bucket
+
+def parse_port_spec(spec):
+    """Parse '80', '1024:65535' or a multiport list like '22,80,8000:8080'.
+
+    Returns sorted, merged inclusive (low, high) intervals. An open end
+    (':1023', '1024:') extends to 0 or 65535. Raises ValueError.
+    """
+    intervals = []
+    for item in str(spec).split(','):
+        low, sep, high = item.partition(':')
+        low = int(low) if low or not sep else 0
+        high = (int(high) if high else 65535) if sep else low
+        if not 0 <= low <= high <= 65535:
+            raise ValueError(f"invalid port range: {item}")
+        intervals.append((low, high))
+    intervals.sort()
+    merged = [list(intervals[0])]
+    for low, high in intervals[1:]:
+        if low <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], high)
+        else:
+            merged.append([low, high])
+    return tuple(map(tuple, merged))
+
+def _compile_ports(spec):
+    """Compile a rule port spec into None (any) or intervals; () never matches."""
+    if not spec:
+        return None
+    try:
+        return parse_port_spec(spec)
+    except ValueError:
+        return ()
+
+def _ports_contain(intervals, port):
+    """Binary search for ``port`` in sorted, disjoint intervals."""
+    i = bisect.bisect_right(intervals, (port, 65536)) - 1
+    return i >= 0 and intervals[i][1] >= port
+
+def _compile_address(value):
+    """Compile a rule address into None (any), an exact string, or (version, net, mask)."""
+    if not value or value == '0.0.0.0/0':
+        return None
+    if '/' not in value:
+        return value
+    try:
+        network = ipaddress.ip_network(value, strict=False)
+    except ValueError:
+        return _NEVER_MATCH
+    return (network.version, int(network.network_address), int(network.netmask))
+
+@lru_cache(maxsize=4096)
+def _parse_ip(ip):
+    """Parse a packet address once into (version, int), or None if not an IP."""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    return address.version, int(address)
+
+def _address_matches(spec, ip, parsed):
+    if spec is None:
+        return True
+    if spec.__class__ is str:
+        return ip == spec
+    if parsed is None:
+        return False
+    version, network, mask = spec
+    return parsed[0] == version and parsed[1] & mask == network
+
+def normalize_port(port):
+    """Normalize a port value to an int where possible (None when unset)."""
+    if not port:
+        return None
+    try:
+        return int(port)
+    except (TypeError, ValueError):
+        return str(port)
+
+def invalidate_chain(chain):
+    """Mark a chain's compiled form stale after its rules change."""
+    get_state()['chain_keys'][chain] = None
+    invalidate_verdicts()
+
+def invalidate_verdicts():
+    """Start a new ruleset generation so cached verdicts are not reused."""
+    get_state()['ruleset_generation'] += 1
+    mark_state_modified()
+
+def get_compiled_chain(chain):
+    """Return the compiled form of a chain in the current session, compiling if needed."""
+    state = get_state()
+    chain_keys = state['chain_keys']
+    key = chain_keys.get(chain)
+    compiled = _compiled_chains.get(key) if key else None
+    if compiled is not None:
+        _compiled_chains.move_to_end(key)
+        return compiled
+    if key in _pinned_chains:
+        return _pinned_chains[key]
+
+    rules = state['iptables_rules'].get(chain, [])
+    key = hashlib.sha1(json.dumps(rules, sort_keys=True).encode()).hexdigest()
+    compiled = _compiled_chains.get(key)
+    if compiled is None:
+        compiled = CompiledChain(rules)
+        _compiled_chains[key] = compiled
+        if len(_compiled_chains) > COMPILED_CHAIN_CACHE_SIZE:
+            _compiled_chains.popitem(last=False)
+    chain_keys[chain] = key
+    mark_state_modified()
+    return compiled
+
+def get_compiled_chains(chain):
+    """Return ``chain`` and every user-defined chain reachable from it, compiled, by name."""
+    rules = get_state()['iptables_rules']
+    chains = {}
+    pending = [chain]
+    while pending:
+        name = pending.pop()
+        if name in chains or name not in rules:
+            continue
+        chains[name] = get_compiled_chain(name)
+        pending.extend(chains[name].jumps)
+    return chains
+
+IPSET_TYPES = ('hash:ip', 'hash:net', 'bitmap:port')
+_compiled_sets = OrderedDict()
+
+class CompiledSet:
+    """Membership test for one ipset.
+
+    Address sets are hashed per (IP version, prefix length), so a lookup
+    costs one hash probe per distinct prefix length in the set. Port sets
+    are merged intervals searched with bisect.
+    """
+    __slots__ = ('ports', '_networks')
+
+    def __init__(self, set_type, members):
+        self.ports = None
+        self._networks = {}
+        if set_type == 'bitmap:port':
+            self.ports = parse_port_spec(','.join(m.replace('-', ':') for m in members)) if members else ()
+            return
+        for member in members:
+            network = ipaddress.ip_network(member, strict=False)
+            width = network.max_prefixlen
+            self._networks.setdefault((network.version, network.prefixlen, width), set()).add(
+                int(network.network_address) >> (width - network.prefixlen))
+
+    def contains_address(self, parsed):
+        version, address = parsed
+        for (net_version, prefixlen, width), networks in self._networks.items():
+            if net_version == version and address >> (width - prefixlen) in networks:
+                return True
+        return False
+
+    def contains_port(self, port):
+        return self.ports is not None and _ports_contain(self.ports, port)
+
+def get_compiled_set(name):
+    """Return the compiled form of a session's ipset, or None if it does not exist."""
+    state = get_state()
+    ipset = state['ipsets'].get(name)
+    if ipset is None:
+        return None
+    key = state['set_keys'].get(name)
+    compiled = _compiled_sets.get(key) if key else None
+    if compiled is not None:
+        _compiled_sets.move_to_end(key)
+        return compiled
+
+    members = sorted(ipset['members'])
+    key = hashlib.sha1(json.dumps([ipset['type'], members]).encode()).hexdigest()
+    compiled = _compiled_sets.get(key)
+    if compiled is None:
+        compiled = CompiledSet(ipset['type'], members)
+        _compiled_sets[key] = compiled
+        if len(_compiled_sets) > COMPILED_CHAIN_CACHE_SIZE:
+            _compiled_sets.popitem(last=False)
+    state['set_keys'][name] = key
+    mark_state_modified()
+    return compiled
+
+def _sets_match(rule_sets, sets, source_parsed, dest_parsed, port):
+    """Check a rule's --match-set conditions against compiled sets."""
+    for name, direction in rule_sets:
+        ipset = sets.get(name)
+        if ipset is None:
+            return False
+        if ipset.ports is not None:
+            # Port sets match the destination port only; flows carry no source port
+            if direction != 'dst' or port.__class__ is not int or not ipset.contains_port(port):
+                return False
+            continue
+        parsed = source_parsed if direction == 'src' else dest_parsed
+        if parsed is None or not ipset.contains_address(parsed):
+            return False
+    return True
+
+TERMINAL_TARGETS = ('ACCEPT', 'DROP', 'REJECT')
+
+def _analysis_address(spec):
+    """Convert a compiled address into None (any), (version, network, prefixlen) or a host name."""
+    if spec is None or spec.__class__ is str and _parse_ip(spec) is None:
+        return spec
+    if spec.__class__ is str:
+        version, address = _parse_ip(spec)
+        return (version, address, 32 if version == 4 else 128)
+    version, network, mask = spec
+    return (version, network, bin(mask).count('1'))
+
+def _prefix_contains(outer, inner):
+    if outer is None:
+        return True
+    if inner is None or outer.__class__ is str or inner.__class__ is str:
+        return outer == inner
+    version, network, prefixlen = outer
+    if version != inner[0] or prefixlen > inner[2]:
+        return False
+    shift = (32 if version == 4 else 128) - prefixlen
+    return inner[1] >> shift == network >> shift
+
+def _prefix_overlaps(a, b):
+    return _prefix_contains(a, b) or _prefix_contains(b, a)
+
+def _interval_contains(outer, inner):
+    """True if every interval of ``inner`` lies inside one of ``outer`` (None is any port)."""
+    if outer is None:
+        return True
+    if inner is None:
+        return False
+    return all(any(low <= a and b <= high for low, high in outer) for a, b in inner)
+
+def _interval_overlaps(a, b):
+    if a is None or b is None:
+        return True
+    return any(low <= d and c <= high for low, high in a for c, d in b)
+
+class _PrefixTrie:
+    """Binary trie over CIDR prefixes, one root per IP version.
+
+    Each node is ``[child0, child1, rules_here, rules_in_subtree]``, so the
+    rules whose prefix contains a query prefix are found along its path, and
+    the rules nested inside it are read from a single node.
+    """
+
+    def __init__(self):
+        self._roots = {4: [None, None, [], []], 6: [None, None, [], []]}
+        self._names = {}
+
+    def insert(self, prefix, index):
+        if prefix.__class__ is str:
+            self._names.setdefault(prefix, []).append(index)
+            return
+        version, network, prefixlen = prefix
+        width = 32 if version == 4 else 128
+        node = self._roots[version]
+        node[3].append(index)
+        for bit in range(prefixlen):
+            branch = (network >> (width - 1 - bit)) & 1
+            if node[branch] is None:
+                node[branch] = [None, None, [], []]
+            node = node[branch]
+            node[3].append(index)
+        node[2].append(index)
+
+    def overlapping(self, prefix):
+        """Rules whose prefix contains or is contained in ``prefix``."""
+        if prefix.__class__ is str:
+            return self._roots[4][2] + self._roots[6][2] + self._names.get(prefix, [])
+        version, network, prefixlen = prefix
+        width = 32 if version == 4 else 128
+        node = self._roots[version]
+        found = []
+        for bit in range(prefixlen):
+            found.extend(node[2])
+            node = node[(network >> (width - 1 - bit)) & 1]
+            if node is None:
+                return found
+        return found + node[3]
+
+class _PortIndex:
+    """Rules bucketed by destination port, with wildcard and range rules kept apart."""
+
+    def __init__(self):
+        self._exact = {}
+        self._ranges = []
+        self._wildcard = []
+
+    def insert(self, intervals, index):
+        if intervals is None:
+            self._wildcard.append(index)
+        elif len(intervals) == 1 and intervals[0][0] == intervals[0][1]:
+            self._exact.setdefault(intervals[0][0], []).append(index)
+        else:
+            self._ranges.append((intervals, index))
+
+    def overlapping(self, intervals):
+        """Rules whose ports overlap ``intervals``, or None if that means every rule."""
+        if intervals is None or len(intervals) != 1 or intervals[0][0] != intervals[0][1]:
+            return None
+        found = self._wildcard + self._exact.get(intervals[0][0], [])
+        return found + [idx for other, idx in self._ranges if _interval_overlaps(other, intervals)]
+
+class _AnalysisRule:
+    __slots__ = ('index', 'source', 'destination', 'protocol', 'ports', 'target')
+
+    def __init__(self, rule):
+        self.index = rule.index
+        self.source = _analysis_address(rule.source)
+        self.destination = _analysis_address(rule.destination)
+        self.protocol = rule.protocol
+        self.ports = rule.dport
+        self.target = rule.target
+
+    def contains(self, other):
+        return (_prefix_contains(self.source, other.source)
+                and _prefix_contains(self.destination, other.destination)
+                and (self.protocol is None or self.protocol == other.protocol)
+                and _interval_contains(self.ports, other.ports))
+
+    def overlaps(self, other):
+        return (_prefix_overlaps(self.source, other.source)
+                and _prefix_overlaps(self.destination, other.destination)
+                and (self.protocol is None or other.protocol is None or self.protocol == other.protocol)
+                and _interval_overlaps(self.ports, other.ports))
+
+def analyze_chain(compiled):
+    """Find shadowed, redundant, conflicting and unreachable rules in a compiled chain.
+
+    Earlier terminal rules are looked up through prefix tries on source and
+    destination and a port index; the smallest candidate set is then checked
+    exactly. Returns (kind, earlier_index, rule_index) tuples; for UNREACHABLE
+    the catch-all rule is ``earlier_index`` and ``rule_index`` is None.
+    """
+    findings = []
+    sources, destinations, ports = _PrefixTrie(), _PrefixTrie(), _PortIndex()
+    terminal = []
+    by_index = {}
+
+    for compiled_rule in compiled.rules:
+        if (compiled_rule.source is _NEVER_MATCH or compiled_rule.destination is _NEVER_MATCH
+                or compiled_rule.dport == ()):
+            continue
+        rule = _AnalysisRule(compiled_rule)
+        by_index[rule.index] = rule
+
+        lookups = []
+        if rule.source is not None:
+            lookups.append(sources.overlapping(rule.source))
+        if rule.destination is not None:
+            lookups.append(destinations.overlapping(rule.destination))
+        port_candidates = ports.overlapping(rule.ports)
+        if port_candidates is not None:
+            lookups.append(port_candidates)
+        candidates = sorted(set(min(lookups, key=len))) if lookups else terminal
+
+        covering = next((idx for idx in candidates if by_index[idx].contains(rule)), None)
+        if covering is not None:
+            kind = 'REDUNDANT' if by_index[covering].target == rule.target else 'SHADOWED'
+            findings.append((kind, covering, rule.index))
+        elif rule.target in TERMINAL_TARGETS:
+            conflicting = next((idx for idx in candidates
+                                if by_index[idx].target != rule.target and by_index[idx].overlaps(rule)), None)
+            if conflicting is not None:
+                findings.append(('CONFLICT', conflicting, rule.index))
+
+        # Set and state matches narrow a rule by things the analysis does not
+        # see, so such rules are checked against earlier ones but never cover later ones
+        if rule.target not in TERMINAL_TARGETS or compiled_rule.sets or compiled_rule.ctstates:
+            continue
+        if rule.source is None and rule.destination is None and rule.protocol is None and rule.ports is None:
+            # Catch-all terminal rule: nothing after it can match
+            if rule.index < len(compiled.rules) - 1:
+                findings.append(('UNREACHABLE', rule.index, None))
+            break
+        terminal.append(rule.index)
+        sources.insert(rule.source if rule.source is not None else (4, 0, 0), rule.index)
+        if rule.source is None:
+            sources.insert((6, 0, 0), rule.index)
+        destinations.insert(rule.destination if rule.destination is not None else (4, 0, 0), rule.index)
+        if rule.destination is None:
+            destinations.insert((6, 0, 0), rule.index)
+        ports.insert(rule.ports, rule.index)
+
+    return findings
+
+def detect_rule_conflicts():
+    """Detect potential rule conflicts and misconfigurations from the session.
+
+    Analysis results are cached on each compiled chain, so they are only
+    recomputed after the chain's rules change.
+    """
+    warnings = []
+    
+    for chain in list(get_state()['iptables_rules']):
+        for kind, earlier, idx in get_compiled_chain(chain).findings():
+            if kind == 'UNREACHABLE':
+                warnings.append({
+                    'type': 'UNREACHABLE',
+                    'chain': chain,
+                    'rule': earlier+1,
+                    'message': f"Rules after rule {earlier+1} in {chain} are unreachable (catch-all rule)"
+                })
+                continue
+            if kind == 'CONFLICT':
+                message = f"Rules {earlier+1} and {idx+1} in {chain} chain conflict (overlapping matches, different targets)"
+            elif kind == 'SHADOWED':
+                message = f"Rule {idx+1} in {chain} chain is shadowed by rule {earlier+1} and never matches"
+            else:
+                message = f"Rule {idx+1} in {chain} chain is redundant (rule {earlier+1} already matches it)"
+            warnings.append({
+                'type': kind,
+                'chain': chain,
+                'rules': [earlier+1, idx+1],
+                'message': message
+            })
+    
+    return warnings
+
+def format_port_list(ports):
+    """Compact the ports of grouped packets into a spec like '20-23,80,443'."""
+    if len(ports) == 1:
+        return ports[0]
+    numbers = sorted({p for p in map(normalize_port, ports) if isinstance(p, int)})
+    names = sorted({str(p) for p in ports if p is not None and not isinstance(normalize_port(p), int)})
+    ranges = []
+    for port in numbers:
+        if ranges and port == ranges[-1][1] + 1:
+            ranges[-1][1] = port
+        else:
+            ranges.append([port, port])
+    specs = [str(a) if a == b else f"{a}-{b}" for a, b in ranges] + names
+    return ','.join(specs) or None
+
+def match_flow(chains, chain, policy, sets, source_ip, dest_ip, protocol, port, ctstate):
+    """Walk the compiled chains for one flow, starting at built-in ``chain``.
+
+    A jump to a user-defined chain saves the current position on a stack;
+    RETURN or the end of a user-defined chain resumes the calling chain,
+    and the end of the built-in chain applies its policy. Returns
+    ``(matched, logged, verdict, target)``: the (chain, index) pairs of the
+    rules that matched (LOG and jump rules included), the (action,
+    rule_info) log entries, the (allowed, message) verdict and the metrics
+    target label.
+    """
+    source_parsed = _parse_ip(str(source_ip))
+    dest_parsed = _parse_ip(str(dest_ip))
+    protocol = protocol.lower()
+    matched = []
+    logged = []
+    stack = []
+    name, rules, position = chain, chains[chain].candidates(protocol, port), 0
+
+    while True:
+        if position == len(rules):
+            if not stack:
+                break
+            name, rules, position = stack.pop()
+            continue
+        rule = rules[position]
+        position += 1
+
+        if not _address_matches(rule.source, source_ip, source_parsed):
+            continue
+        if not _address_matches(rule.destination, dest_ip, dest_parsed):
+            continue
+        if rule.sets is not None and not _sets_match(rule.sets, sets, source_parsed, dest_parsed, port):
+            continue
+        if rule.ctstates is not None and ctstate not in rule.ctstates:
+            continue
+
+        matched.append((name, rule.index))
+        rule_info = f"{name} rule {rule.index+1}"
+        target = rule.target
+
+        # LOG doesn't stop processing
+        if target == 'LOG':
+            logged.append(('LOG', rule_info))
+            continue
+
+        if target in TERMINAL_TARGETS:
+            logged.append((target, rule_info))
+            return (tuple(matched), tuple(logged),
+                    (target == 'ACCEPT', f"{target} by {rule_info}"), target)
+
+        if target == 'RETURN':
+            position = len(rules)
+            continue
+
+        subchain = chains.get(target)
+        if subchain is not None:
+            stack.append((name, rules, position))
+            name, rules, position = target, subchain.candidates(protocol, port), 0
+
+    # Chain policy (DROP unless changed with -P)
+    logged.append((policy, "Default policy"))
+    return tuple(matched), tuple(logged), (policy == 'ACCEPT', f"{policy} by default policy"), 'policy'
+
+def evaluate_packets(chain, flows):
+    """Evaluate many (source, destination, protocol, port) flows against a chain in one pass.
+
+    Rule counters are updated once at the end, and packets sharing an action,
+    endpoints, protocol and rule are logged as a single grouped entry.
+    Results of match_flow are cached per session, and a cache hit updates
+    counters and logs exactly like a fresh evaluation. Packets follow jumps
+    into user-defined chains.
+    Returns a list of (allowed, message) tuples in flow order.
+    """
+    state = get_state()
+    chains = get_compiled_chains(chain)
+    compiled = chains[chain]
+    sets = {name: get_compiled_set(name) for subchain in chains.values() for name in subchain.set_names}
+    uses_ctstate = any(subchain.uses_ctstate for subchain in chains.values())
+    policy = state['chain_policies'][chain]
+    conntrack = state['conntrack']
+    cache = state['verdict_cache']
+    generation = state['ruleset_generation']
+    now = time.time()
+    hits = Counter()
+    log_groups = {}
+    verdicts = []
+    targets = Counter()
+    fast_path = 0
+    hits_before, misses_before = cache.hits, cache.misses
+
+    for source_ip, dest_ip, protocol, port in flows:
+        port_value = normalize_port(port)
+        conn_key = (protocol.lower(), source_ip, None, dest_ip, port_value)
+
+        ctstate = 'NEW'
+        if uses_ctstate and conntrack.lookup(conn_key, now) is not None:
+            ctstate = 'ESTABLISHED'
+            if compiled.established_accept is not None:
+                # Fast path: accepted by the ESTABLISHED rule without walking the chain
+                idx = compiled.established_accept
+                hits[(chain, idx)] += 1
+                rule_info = f"{chain} rule {idx+1}"
+                log_groups.setdefault(('ACCEPT', source_ip, dest_ip, protocol, rule_info), []).append(port)
+                verdict = (True, f"ACCEPT by {rule_info} (established)")
+                targets['ACCEPT'] += 1
+                fast_path += 1
+                conntrack.track(conn_key, now)
+                verdicts.append(verdict)
+                continue
+
+        cache_key = (chain, source_ip, dest_ip, protocol, port_value, ctstate)
+        cached = cache.get(cache_key, generation)
+        if cached is None:
+            cached = match_flow(chains, chain, policy, sets, source_ip, dest_ip, protocol, port_value, ctstate)
+            cache.put(cache_key, cached)
+        matched, logged, verdict, target = cached
+
+        for hit in matched:
+            hits[hit] += 1
+        for action, rule_info in logged:
+            log_groups.setdefault((action, source_ip, dest_ip, protocol, rule_info), []).append(port)
+        targets[target] += 1
+        if verdict[0]:
+            conntrack.track(conn_key, now)
+        verdicts.append(verdict)
+
+    PACKETS_EVALUATED.inc(len(verdicts), chain=chain)
+    VERDICT_CACHE_LOOKUPS.inc(cache.hits - hits_before, result='hit')
+    VERDICT_CACHE_LOOKUPS.inc(cache.misses - misses_before, result='miss')
+    if fast_path:
+        CONNTRACK_FAST_PATH.inc(fast_path, chain=chain)
+    for target, packets in targets.items():
+        RULE_MATCHES.inc(packets, chain=chain, target=target)
+
+    for (name, idx), packets in hits.items():
+        counters = state['rule_counters'][name]
+        if idx < len(counters):
+            counters[idx]['packets'] += packets
+            counters[idx]['bytes'] += sum(random.randint(40, 1500) for _ in range(packets))
+    if targets['policy']:
+        policy_counter = state['policy_counters'][chain]
+        policy_counter['packets'] += targets['policy']
+        policy_counter['bytes'] += sum(random.randint(40, 1500) for _ in range(targets['policy']))
+    # Counters, conntrack entries and cache statistics changed
+    if verdicts:
+        mark_state_modified()
+
+    for (action, source_ip, dest_ip, protocol, rule_info), ports in log_groups.items():
+        log_firewall_event(action, source_ip, dest_ip, protocol, format_port_list(ports), rule_info, count=len(ports))
+
+    return verdicts
+
+def check_iptables_rule(chain, source_ip, dest_ip, protocol, port):
+    """Check if traffic matches iptables rules in the current session."""
+    return evaluate_packets(chain, [(source_ip, dest_ip, protocol, port)])[0]
+
+def calculate_network(ip_address):
+    """Calculate network address from IP"""
+    try:
+        ip = ipaddress.ip_address(ip_address)
+        # Create network with /24 mask
+        network = ipaddress.ip_network(f"{ip_address}/24", strict=False)
+        gateway = str(network.network_address + 1)  # .1 is typically gateway
+        return str(network), gateway
+    except:
+        return None, None
+
+class Topology:
+    """Routing view of the session's network, rebuilt whenever an address changes.
+
+    Routes are the configured networks sorted longest prefix first, so the
+    first matching route is the longest-prefix match. The firewall owns
+    its own address and the gateway of every network. resolve() picks the
+    chain a packet traverses and caches the answer per (source,
+    destination) until the next rebuild.
+    """
+
+    CACHE_SIZE = 4096
+
+    def __init__(self):
+        self.routes = []
+        self.local = {'FIREWALL'}
+        self.firewall_zone = 'FIREWALL-ADMIN'
+        self._paths = {}
+
+    def rebuild(self, network_config):
+        routes = []
+        local = {'FIREWALL'}
+        for terminal, config in network_config.items():
+            if terminal == 'firewall':
+                self.firewall_zone = config['zone']
+                if config['ip']:
+                    local.add(config['ip'])
+            if not config['network']:
+                continue
+            network = ipaddress.ip_network(config['network'], strict=False)
+            routes.append((network.prefixlen, network.version, int(network.network_address),
+                           int(network.netmask), config['zone'], config['network']))
+            if config['gateway']:
+                local.add(config['gateway'])
+        routes.sort(key=lambda route: -route[0])
+        self.routes = routes
+        self.local = local
+        self._paths.clear()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_paths'] = {}
+        return state
+
+    def zone_of(self, address):
+        """Zone owning ``address`` by longest-prefix match, or None if no route covers it."""
+        if address in self.local:
+            return self.firewall_zone
+        parsed = _parse_ip(str(address))
+        if parsed is None:
+            return None
+        for _, version, network, mask, zone, _ in self.routes:
+            if version == parsed[0] and parsed[1] & mask == network:
+                return zone
+        return None
+
+    def resolve(self, source, destination):
+        """Return ``(chain, source_zone, destination_zone)`` for a packet.
+
+        The chain is OUTPUT for packets the firewall sends, INPUT for packets
+        addressed to it, FORWARD for packets routed between networks, and
+        None for packets that stay within one network.
+        """
+        key = (source, destination)
+        path = self._paths.get(key)
+        if path is None:
+            source_zone = self.zone_of(source)
+            destination_zone = self.zone_of(destination)
+            if source in self.local:
+                chain = 'OUTPUT'
+            elif destination in self.local:
+                chain = 'INPUT'
+            elif source_zone is not None and source_zone == destination_zone:
+                chain = None
+            else:
+                chain = 'FORWARD'
+            if len(self._paths) >= self.CACHE_SIZE:
+                self._paths.clear()
+            path = self._paths[key] = (chain, source_zone, destination_zone)
+        return path
+
+def evaluate_routed(flows):
+    """Evaluate flows along the path each one takes through the firewall.
+
+    Flows are grouped by the chain the session's topology assigns them and
+    each group is evaluated in one evaluate_packets pass. Flows that stay
+    within one network never reach the firewall and are allowed.
+    Returns a list of (allowed, message) tuples in flow order.
+    """
+    topology = get_state()['topology']
+    paths = [topology.resolve(flow[0], flow[1]) for flow in flows]
+    groups = {}
+    for flow, (chain, _, _) in zip(flows, paths):
+        if chain is not None:
+            groups.setdefault(chain, []).append(flow)
+    verdicts = {chain: iter(evaluate_packets(chain, group)) for chain, group in groups.items()}
+    return [
+        next(verdicts[chain]) if chain is not None
+        else (True, f"Delivered within {zone} (not routed through the firewall)")
+        for chain, zone, _ in paths
+    ]
+
+def check_routed(source_ip, dest_ip, protocol, port):
+    """Check a single flow along its routed path in the current session."""
+    return evaluate_routed([(source_ip, dest_ip, protocol, port)])[0]
+
+def handle_route_command(terminal, parts):
+    """Show the session's routing table, longest prefix first."""
+    topology = get_state()['topology']
+    output = "Kernel IP routing table\n"
+    output += f"{'Destination':<20} {'Genmask':<18} {'Zone'}\n"
+    for *_, zone, network in topology.routes:
+        genmask = str(ipaddress.ip_network(network, strict=False).netmask)
+        output += f"{html.escape(network.split('/')[0]):<20} {genmask:<18} {html.escape(zone)}\n"
+    output += f"Firewall addresses: {html.escape(', '.join(sorted(topology.local)))}\n"
+    return output
+
+def handle_ifconfig_command(terminal, parts):
+    """Handle ifconfig commands within the current session."""
+    state = get_state()
+    if len(parts) == 1:
+        # Show current configuration
+        config = state['network_config'][terminal]
+        if config['ip']:
+            output = f"eth0: flags=4163<UP,BROADCAST,RUNNING,MULTICAST>  mtu 1500\n"
+            output += f"        inet {config['ip']}  netmask {config['netmask']}  broadcast {config['gateway']}\n"
+            output += f"        ether 02:42:ac:11:00:{random.randint(10,99)}  txqueuelen 0  (Ethernet)\n"
+            output += f"        RX packets 1234  bytes 567890 (567.8 KB)\n"
+            output += f"        TX packets 987  bytes 123456 (123.4 KB)\n\n"
+            output += f"Zone: {config['zone']}\n"
+            output += f"Network: {config['network']}\n"
+            return output
+        else:
+            return f"eth0: No IP address configured\nUse: ifconfig set ip <ip_address>\n"
+    
+    elif len(parts) >= 4 and parts[1] == 'set' and parts[2] == 'ip':
+        # Set IP address
+        ip = parts[3]
+        try:
+            # Validate IP
+            ipaddress.ip_address(ip)
+            
+            # Calculate network and gateway
+            network, gateway = calculate_network(ip)
+            
+            # Update configuration in state
+            state['network_config'][terminal]['ip'] = ip
+            state['network_config'][terminal]['network'] = network
+            state['network_config'][terminal]['gateway'] = gateway
+            state['topology'].rebuild(state['network_config'])
+            mark_state_modified()
+            
+            # Update display
+            emit_to_session('update_ip_display', {
+                'terminal': terminal,
                 'ip': html.escape(ip),
                 'network': html.escape(network) if network else None
             })
             return f"IP address set to {html.escape(ip)}\nNetwork: {html.escape(network)}\nGateway: {html.escape(gateway)}\n"
         except:
-            return f"Invalid IP address: {html.escape(ip)}\n"
+            raise CommandError(f"Invalid IP address: {html.escape(ip)}\n")
+    
+    else:
+        raise CommandError("Usage: ifconfig [set ip <ip_address>]\n")
+
+RULE_OPTIONS = {
+    '-s': 'source', '-d': 'destination', '-p': 'protocol',
+    '--sport': 'sport', '--dport': 'dport', '-j': 'target',
+    '--source': 'source', '--destination': 'destination', '--protocol': 'protocol',
+    '--source-port': 'sport', '--destination-port': 'dport', '--jump': 'target',
+    '--sports': 'sport', '--dports': 'dport',
+    '--state': 'ctstate', '--ctstate': 'ctstate',
+}
+# Match modules whose options are understood directly (--dports, --match-set, ...)
+MATCH_MODULES = {'tcp', 'udp', 'icmp', 'multiport', 'set', 'state', 'conntrack'}
+CHAIN_POLICIES = ('ACCEPT', 'DROP')
+BUILTIN_CHAINS = ('INPUT', 'OUTPUT', 'FORWARD')
+# Targets that are not user-defined chains
+RULE_TARGETS = ('ACCEPT', 'DROP', 'REJECT', 'LOG', 'RETURN')
+MAX_CHAIN_NAME = 28
+CHAIN_NAME = re.compile(r'[A-Za-z0-9_.][A-Za-z0-9_.-]*')
+
+def chain_name_error(name, rules_by_chain):
+    """Error message for creating a chain called ``name``, or None."""
+    if name in rules_by_chain:
+        return "Chain already exists"
+    if name in RULE_TARGETS or len(name) > MAX_CHAIN_NAME or not CHAIN_NAME.fullmatch(name):
+        return f"Invalid chain name {name}"
+    return None
+
+def chain_references(rules_by_chain, name):
+    """Number of rules jumping to chain ``name``."""
+    return sum(1 for rules in rules_by_chain.values() for rule in rules if rule['target'] == name)
+
+def jump_error(rules_by_chain, chain, target):
+    """Error message for a rule in ``chain`` with ``target``, or None.
+
+    The target must be a standard target or an existing user-defined chain,
+    and jumping there must not lead packets back into ``chain``.
+    """
+    if target in RULE_TARGETS:
+        return None
+    if target in BUILTIN_CHAINS or target not in rules_by_chain:
+        return f"Unknown target {target} (not a standard target or user-defined chain)"
+    # Depth-first search for a path of jumps from the target back to the chain
+    pending, seen = [target], set()
+    while pending:
+        name = pending.pop()
+        if name == chain:
+            return f"Jump from {chain} to {target} would create a loop"
+        if name not in seen:
+            seen.add(name)
+            pending.extend(rule['target'] for rule in rules_by_chain.get(name, ())
+                           if rule['target'] not in RULE_TARGETS)
+    return None
+
+def find_chain_loop(rules_by_chain):
+    """Name of a chain that can reach itself through jumps, or None."""
+    for chain, rules in rules_by_chain.items():
+        for rule in rules:
+            if rule['target'] not in RULE_TARGETS and rule['target'] in rules_by_chain:
+                if jump_error(rules_by_chain, chain, rule['target']):
+                    return chain
+    return None
+
+def new_rule():
+    return {
+        'source': '0.0.0.0/0', 'destination': '0.0.0.0/0', 'protocol': 'all',
+        'sport': None, 'dport': None, 'src_set': None, 'dst_set': None, 'ctstate': None,
+        'target': 'DROP'
+    }
+
+def parse_rule_spec(parts, start):
+    """Parse rule options from ``parts[start:]`` into a rule dict.
+
+    Returns the rule and the list of tokens that were not understood.
+    """
+    rule = new_rule()
+    unknown = []
+    i = start
+    while i < len(parts):
+        key = RULE_OPTIONS.get(parts[i])
+        if key and i + 1 < len(parts):
+            rule[key] = parts[i + 1]
+            i += 2
+        elif parts[i] == '-m' and i + 1 < len(parts) and parts[i + 1] in MATCH_MODULES:
+            i += 2
+        elif parts[i] == '--match-set' and i + 2 < len(parts) and parts[i + 2] in ('src', 'dst'):
+            rule[f"{parts[i + 2]}_set"] = parts[i + 1]
+            i += 3
+        else:
+            unknown.append(parts[i])
+            i += 1
+    return rule, unknown
+
+def format_port_match(direction, spec):
+    """Describe a port spec the way iptables -L does (dpt:80, dpts:1024:65535, multiport dports 22,80)."""
+    spec = html.escape(spec)
+    if ',' in spec:
+        return f" multiport {direction}ports {spec}"
+    if ':' in spec:
+        return f" {direction}pts:{spec}"
+    return f" {direction}pt:{spec}"
+
+def format_rule_matches(rule):
+    """The options column of iptables -L for a rule."""
+    output = ""
+    if rule['dport']:
+        output += format_port_match('d', rule['dport'])
+    if rule['sport']:
+        output += format_port_match('s', rule['sport'])
+    for key, direction in (('src_set', 'src'), ('dst_set', 'dst')):
+        if rule.get(key):
+            output += f" match-set {html.escape(rule[key])} {direction}"
+    if rule.get('ctstate'):
+        output += f" state {html.escape(rule['ctstate'])}"
+    return output
+
+def prepare_rule(state, chain, parts, start):
+    """Parse and check the rule of an -A, -I or -R command; returns (rule, error)."""
+    # Unknown options are ignored at the prompt
+    rule, _ = parse_rule_spec(parts, start)
+    error = rule_port_error(rule)
+    if error:
+        return None, f"iptables: {html.escape(error)}.\n"
+    for key in ('src_set', 'dst_set'):
+        if rule[key] and rule[key] not in state['ipsets']:
+            return None, f"iptables: Set {html.escape(rule[key])} doesn't exist.\n"
+    error = jump_error(state['iptables_rules'], chain, rule['target'])
+    if error:
+        return None, f"iptables: {html.escape(error)}.\n"
+    return rule, None
+
+def format_chain_listing(state, chain, verbose):
+    """One chain of iptables -L output."""
+    if chain in BUILTIN_CHAINS:
+        policy = state['chain_policies'][chain]
+        if verbose:
+            policy_counter = state['policy_counters'][chain]
+            output = f"Chain {chain} (policy {policy} {policy_counter['packets']} packets, {policy_counter['bytes']} bytes)\n"
+        else:
+            output = f"Chain {chain} (policy {policy})\n"
+    else:
+        output = f"Chain {html.escape(chain)} ({chain_references(state['iptables_rules'], chain)} references)\n"
+    if verbose:
+        output += f"{'pkts':<8} {'bytes':<10} {'target':<12} {'prot':<6} {'source':<20} {'destination':<20} {'options'}\n"
+    else:
+        output += f"{'target':<12} {'prot':<6} {'source':<20} {'destination':<20}\n"
+    
+    for idx, rule in enumerate(state['iptables_rules'][chain]):
+        if verbose and idx < len(state['rule_counters'][chain]):
+            pkts = state['rule_counters'][chain][idx]['packets']
+            bytes_count = state['rule_counters'][chain][idx]['bytes']
+            output += f"{pkts:<8} {bytes_count:<10} "
+        
+        # Sanitize rule components for display
+        target = html.escape(rule['target'])
+        protocol = html.escape(rule['protocol'])
+        source = html.escape(rule['source'])
+        destination = html.escape(rule['destination'])
+        
+        output += f"{target:<12} {protocol:<6} {source:<20} {destination:<20}"
+        
+        output += format_rule_matches(rule)
+        
+        output += "\n"
+    return output + "\n"
+
+def handle_iptables_command(terminal, parts):
+    """Handle iptables commands within the current session."""
+    state = get_state()
+    rules = state['iptables_rules']
+    if len(parts) < 2:
+        raise CommandError("Usage: iptables [-A|-I|-R|-D|-L|-F|-P|-N|-X] [chain] [options]\n")
+    
+    option = parts[1]
+    if option in ('-L', '-F', '-X'):
+        # Flags such as -v or -n may come before or after the chain
+        chain = next((part for part in parts[2:] if not part.startswith('-')), None)
+    else:
+        chain = parts[2] if len(parts) > 2 and not parts[2].startswith('-') else None
+    if chain is not None and option in ('-L', '-F', '-A', '-I', '-R', '-D') and chain not in rules:
+        raise CommandError(f"Invalid chain: {html.escape(chain)}. Use INPUT, OUTPUT, FORWARD or a chain created with -N\n")
+    
+    # List rules
+    if option == '-L':
+        verbose = '-v' in parts
+        output = "\n"
+        for name in ([chain] if chain else list(rules)):
+            output += format_chain_listing(state, name, verbose)
+        
+        if verbose:
+            cache = state['verdict_cache']
+            lookups = cache.hits + cache.misses
+            rate = f"{cache.hits / lookups:.0%}" if lookups else "n/a"
+            output += (f"Verdict cache: {cache.hits} hits, {cache.misses} misses "
+                       f"(hit rate {rate}), {len(cache)} entries\n")
+        return output
+    
+    # Flush rules
+    elif option == '-F':
+        rules = ensure_private_rules(state)
+        for name in ([chain] if chain else list(rules)):
+            rules[name] = []
+            state['rule_counters'][name] = []
+            invalidate_chain(name)
+        return f"Flushed {html.escape(chain)} chain\n" if chain else "Flushed all chains\n"
+    
+    # Append, insert or replace a rule
+    elif option in ('-A', '-I', '-R'):
+        if chain is None:
+            raise CommandError(f"Usage: iptables {option} <chain> {'<rule_number> ' if option == '-R' else ''}[options]\n")
+        
+        start, position = 3, len(rules[chain])
+        if option != '-A':
+            position = 0
+            if len(parts) > 3 and parts[3].isdigit():
+                start, position = 4, int(parts[3]) - 1
+            elif option == '-R':
+                raise CommandError("Usage: iptables -R <chain> <rule_number> [options]\n")
+            limit = len(rules[chain]) - 1 if option == '-R' else len(rules[chain])
+            if not 0 <= position <= limit:
+                raise CommandError("iptables: Index of insertion too big.\n" if option == '-I' else "Invalid rule number\n")
+        
+        rule, error = prepare_rule(state, chain, parts, start)
+        if error:
+            raise CommandError(error)
+        
+        # Prevent duplicate rules
+        others = rules[chain][:position] + rules[chain][position + 1:] if option == '-R' else rules[chain]
+        if rule in others:
+            raise CommandError("iptables: Rule already exists.\n")
+        
+        rules = ensure_private_rules(state)
+        if option == '-R':
+            # The replacement starts with fresh counters
+            rules[chain][position] = rule
+            state['rule_counters'][chain][position] = {'packets': 0, 'bytes': 0}
+            message = f"Replaced rule {position + 1} in {chain} chain\n"
+        else:
+            rules[chain].insert(position, rule)
+            state['rule_counters'][chain].insert(position, {'packets': 0, 'bytes': 0})
+            message = f"Rule added to {chain} chain\n" if option == '-A' else f"Rule inserted at position {position + 1} in {chain} chain\n"
+        invalidate_chain(chain)
+        return html.escape(message)
+    
+    # Set chain policy
+    elif option == '-P':
+        if len(parts) < 4:
+            raise CommandError("Usage: iptables -P <chain> <ACCEPT|DROP>\n")
+        chain, policy = parts[2], parts[3].upper()
+        if chain not in state['chain_policies']:
+            raise CommandError(f"iptables: Bad built-in chain name: {html.escape(chain)}. Use INPUT, OUTPUT, or FORWARD\n")
+        if policy not in CHAIN_POLICIES:
+            raise CommandError("Policy must be ACCEPT or DROP\n")
+        ensure_private_rules(state)
+        state['chain_policies'][chain] = policy
+        invalidate_verdicts()
+        return f"Policy of {chain} chain set to {policy}\n"
+    
+    # Delete rule
+    elif option == '-D':
+        if chain is None or len(parts) < 4:
+            raise CommandError("Usage: iptables -D <chain> <rule_number>\n")
+        
+        try:
+            rule_num = int(parts[3]) - 1
+            if 0 <= rule_num < len(rules[chain]):
+                rules = ensure_private_rules(state)
+                del rules[chain][rule_num]
+                del state['rule_counters'][chain][rule_num]
+                invalidate_chain(chain)
+                return f"Deleted rule {rule_num + 1} from {html.escape(chain)} chain\n"
+            else:
+                raise CommandError(f"Invalid rule number\n")
+        except ValueError:
+            raise CommandError("Rule number must be an integer\n")
+    
+    # Create a user-defined chain
+    elif option == '-N':
+        if chain is None:
+            raise CommandError("Usage: iptables -N <chain>\n")
+        error = chain_name_error(chain, rules)
+        if error:
+            raise CommandError(f"iptables: {html.escape(error)}.\n")
+        rules = ensure_private_rules(state)
+        rules[chain] = []
+        state['rule_counters'][chain] = []
+        state['chain_keys'][chain] = None
+        mark_state_modified()
+        return f"Created chain {html.escape(chain)}\n"
+    
+    # Delete one or all user-defined chains
+    elif option == '-X':
+        names = [chain] if chain else [name for name in rules if name not in BUILTIN_CHAINS]
+        for name in names:
+            if name in BUILTIN_CHAINS or name not in rules:
+                raise CommandError(f"iptables: No chain/target/match by that name: {html.escape(name)}.\n")
+            if rules[name]:
+                raise CommandError(f"iptables: Chain {html.escape(name)} is not empty (flush it with -F first).\n")
+            references = chain_references(rules, name)
+            if references:
+                raise CommandError(f"iptables: Chain {html.escape(name)} is still referenced by {references} rule(s).\n")
+        rules = ensure_private_rules(state)
+        for name in names:
+            del rules[name]
+            del state['rule_counters'][name]
+            state['chain_keys'].pop(name, None)
+        invalidate_verdicts()
+        return f"Deleted chain {html.escape(chain)}\n" if chain else f"Deleted {len(names)} user-defined chains\n"
+    
+    else:
+        raise CommandError(f"Unknown option: {html.escape(option)}\n")
+
+def normalize_set_entry(set_type, entry):
+    """Validate an ipset entry and return its canonical form. Raises ValueError."""
+    if set_type == 'hash:ip':
+        return str(ipaddress.ip_address(entry))
+    if set_type == 'hash:net':
+        return str(ipaddress.ip_network(entry, strict=False))
+    ((low, high),) = parse_port_spec(entry.replace('-', ':'))
+    return str(low) if low == high else f"{low}-{high}"
+
+def handle_ipset_command(terminal, parts):
+    """Handle ipset commands (named address and port sets) within the current session."""
+    state = get_state()
+    sets = state['ipsets']
+    if len(parts) < 2:
+        raise CommandError("Usage: ipset [create|add|del|list|flush|destroy] [set] [options]\n")
+    
+    option = parts[1]
+    name = parts[2] if len(parts) > 2 else None
+    if name is not None and option != 'create' and name not in sets:
+        raise CommandError(f"ipset: The set with the given name does not exist: {html.escape(name)}\n")
+    
+    if option == 'list':
+        output = ""
+        for set_name in ([name] if name else sorted(sets)):
+            ipset = sets[set_name]
+            output += f"Name: {html.escape(set_name)}\nType: {ipset['type']}\n"
+            output += f"Number of entries: {len(ipset['members'])}\nMembers:\n"
+            output += ''.join(f"{member}\n" for member in sorted(ipset['members']))
+            output += "\n"
+        return output or "No sets defined\n"
+    
+    if name is None:
+        raise CommandError(f"Usage: ipset {html.escape(option)} <set> ...\n")
+    
+    if option == 'create':
+        if len(parts) < 4 or parts[3] not in IPSET_TYPES:
+            raise CommandError(f"Usage: ipset create <set> <{'|'.join(IPSET_TYPES)}>\n")
+        if name in sets:
+            raise CommandError("ipset: Set cannot be created: set with the same name already exists\n")
+        sets[name] = {'type': parts[3], 'members': set()}
+    
+    elif option in ('add', 'del'):
+        if len(parts) < 4:
+            raise CommandError(f"Usage: ipset {option} <set> <entry>\n")
+        try:
+            entry = normalize_set_entry(sets[name]['type'], parts[3])
+        except ValueError:
+            raise CommandError(f"ipset: Syntax error: '{html.escape(parts[3])}' is invalid for {sets[name]['type']}\n")
+        members = sets[name]['members']
+        if option == 'add':
+            if entry in members:
+                raise CommandError("ipset: Element cannot be added to the set: it's already added\n")
+            members.add(entry)
+        else:
+            if entry not in members:
+                raise CommandError("ipset: Element cannot be deleted from the set: it's not added\n")
+            members.discard(entry)
+        state['set_keys'][name] = None
+        invalidate_verdicts()
+    
+    elif option == 'flush':
+        sets[name]['members'] = set()
+        state['set_keys'][name] = None
+        invalidate_verdicts()
     
+    elif option == 'destroy':
+        in_use = any(name in (rule.get('src_set'), rule.get('dst_set'))
+                     for rules in state['iptables_rules'].values() for rule in rules)
+        if in_use:
+            raise CommandError("ipset: Set cannot be destroyed: it is in use by a kernel component\n")
+        del sets[name]
+        state['set_keys'].pop(name, None)
+    
+    else:
+        raise CommandError(f"Unknown option: {html.escape(option)}\n")
+    
+    keep_session_sets(state)
+    mark_state_modified()
+    return ""
+
+CONNTRACK_PROTOCOL_NUMBERS = {'tcp': 6, 'udp': 17, 'icmp': 1}
+
+def handle_conntrack_command(terminal, parts):
+    """Handle conntrack commands (inspect or flush the session's connection table)."""
+    state = get_state()
+    conntrack = state['conntrack']
+    option = parts[1] if len(parts) > 1 else '-L'
+    now = time.time()
+    
+    if option == '-L':
+        entries = conntrack.items(now)
+        output = ""
+        for (protocol, source, _, destination, port), (expires, packets, bytes_count) in entries:
+            number = CONNTRACK_PROTOCOL_NUMBERS.get(protocol, 0)
+            dport = f" dport={port}" if port is not None else ""
+            output += (f"{html.escape(protocol):<8} {number:<2} {int(expires - now):<6} ESTABLISHED "
+                       f"src={html.escape(str(source))} dst={html.escape(str(destination))}{dport} "
+                       f"packets={packets} bytes={bytes_count} [ASSURED]\n")
+        return output + f"conntrack v1.4.6 (conntrack-tools): {len(entries)} flow entries have been shown.\n"
+    
+    elif option == '-C':
+        return f"{len(conntrack.items(now))}\n"
+    
+    elif option == '-F':
+        conntrack.flush()
+        mark_state_modified()
+        return "conntrack v1.4.6 (conntrack-tools): connection tracking table has been emptied.\n"
+    
+    else:
+        raise CommandError("Usage: conntrack [-L|-C|-F]\n")
+
+def handle_logging_command(terminal, parts):
+    """Handle log volume settings: aggregation window, sampling and per-rule rate limit."""
+    state = get_state()
+    policy = state['log_policy']
+    option = parts[1] if len(parts) > 1 else 'show'
+    value = parts[2] if len(parts) > 2 else None
+
+    try:
+        if option == 'show':
+            limit = f"{policy.limit_spec} burst {policy.burst}" if policy.limit_spec else "off"
+            return (f"Aggregation window: {f'{policy.window:g}s' if policy.window else 'off'}\n"
+                    f"Sampling: {f'1 in {policy.sample}' if policy.sample > 1 else 'off'}\n"
+                    f"Rate limit per rule: {html.escape(limit)}\n"
+                    f"Suppressed packets: {policy.suppressed}, open aggregates: {policy.pending}\n")
+
+        elif option == 'window' and value:
+            window = 0 if value == 'off' else float(value)
+            if window < 0:
+                raise ValueError("window must not be negative")
+            if not window:
+                flush_log_windows(state, everything=True)
+            policy.window = window
+            result = f"Aggregation window set to {window:g}s\n" if window else "Aggregation disabled\n"
+
+        elif option == 'sample' and value:
+            sample = 1 if value == 'off' else int(value)
+            if sample < 1:
+                raise ValueError("sample must be at least 1")
+            policy.sample = sample
+            result = f"Logging 1 in {sample} entries\n" if sample > 1 else "Sampling disabled\n"
+
+        elif option == 'limit' and value:
+            burst = int(parts[3]) if len(parts) > 3 else DEFAULT_LIMIT_BURST
+            if burst < 1:
+                raise ValueError("burst must be at least 1")
+            policy.set_limit(None if value == 'off' else value, burst)
+            result = f"Rate limit set to {value} per rule, burst {burst}\n" if policy.limit else "Rate limit disabled\n"
+
+        else:
+            raise CommandError("Usage: logging [show|window <seconds>|sample <N>|limit <rate>[/second|minute|hour|day] [burst]] (off disables)\n")
+    except ValueError as e:
+        raise CommandError(f"logging: {html.escape(str(e))}\n")
+
+    mark_state_modified()
+    return html.escape(result)
+
+def simulate_latency(seconds):
+    """Cooperatively wait for a simulated network delay, scaled by SIM_TIME_SCALE."""
+    socketio.sleep(seconds * app.config['SIM_TIME_SCALE'])
+
+def stream_output(terminal, chunks):
+    """Send a command's output chunks to the client as they are produced.
+
+    Chunks produced within STREAM_FLUSH_INTERVAL of each other are sent
+    together. The session lock is released after the first chunk. Returns
+    the unsent remainder, which becomes the final output.
+    """
+    pending = []
+    last_flush = time.monotonic()
+    for chunk in commit_after_first(chunks):
+        pending.append(chunk)
+        now = time.monotonic()
+        if now - last_flush >= STREAM_FLUSH_INTERVAL:
+            emit('output', {'terminal': terminal, 'output': ''.join(pending), 'partial': True})
+            pending = []
+            last_flush = now
+    return ''.join(pending)
+
+def handle_nmap_command(terminal, parts):
+    """Handle nmap port scanning within the current session, yielding output as it is produced."""
+    state = get_state()
+    if len(parts) < 2:
+        raise CommandError("Usage: nmap [-p <ports>] <target>\n")
+    
+    ports_to_scan = [80, 443, 22, 21, 23, 25, 53, 3306]
+    target = None
+    
+    i = 1
+    while i < len(parts):
+        if parts[i] == '-p' and i + 1 < len(parts):
+            port_spec = parts[i + 1]; i += 2
+            if ',' in port_spec: ports_to_scan = [int(p) for p in port_spec.split(',')]
+            elif '-' in port_spec: start, end = map(int, port_spec.split('-')); ports_to_scan = list(range(start, end + 1))
+            else: ports_to_scan = [int(port_spec)]
+        else: target = parts[i]; i += 1
+    
+    if not target:
+        raise CommandError("Error: No target specified\n")
+    
+    source_ip = state['network_config'][terminal]['ip']
+    if not source_ip:
+        raise CommandError("Error: No IP address configured. Use 'ifconfig set ip <ip>'\n")
+    
+    # Every verdict is decided before the first line, so the rest streams
+    # without the session lock
+    verdicts = evaluate_routed([(source_ip, target, 'tcp', port) for port in ports_to_scan])
+    
+    safe_target = html.escape(target)
+    output = f"\nStarting Nmap scan on {safe_target}\n"
+    output += f"Nmap scan report for {safe_target}\n"
+    output += f"Host is up (0.0010s latency).\n\n"
+    output += f"{'PORT':<10} {'STATE':<12} {'SERVICE'}\n"
+    yield output
+    
+    for port, (allowed, message) in zip(ports_to_scan, verdicts):
+        if allowed:
+            port_state = random.choice(['open', 'open', 'open', 'closed'])
+            service = { 80: 'http', 443: 'https', 22: 'ssh', 21: 'ftp', 23: 'telnet', 25: 'smtp', 53: 'dns', 3306: 'mysql' }.get(port, 'unknown')
+            yield f"{port}/tcp{'':<3} {port_state:<12} {service}\n"
+        else:
+            yield f"{port}/tcp{'':<3} {'filtered':<12} (blocked by firewall)\n"
+        
+        simulate_latency(0.05)
+    
+    yield f"\nNmap done: 1 IP address scanned\n"
+
+def handle_ping_command(terminal, target):
+    """Handle ping command with firewall checking within the current session, yielding each reply."""
+    state = get_state()
+    source_ip = state['network_config'][terminal]['ip']
+    if not source_ip:
+        raise CommandError("Error: No IP address configured. Use 'ifconfig set ip <ip>'\n")
+    
+    safe_target = html.escape(target)
+    allowed, message = check_routed(source_ip, target, 'icmp', None)
+    
+    if not allowed:
+        raise CommandError(f"ping: {safe_target}: {html.escape(message)}\n")
+    
+    yield f"PING {safe_target} 56(84) bytes of data.\n"
+    for i in range(4):
+        ttl = random.randint(50, 64)
+        latency = random.uniform(0.5, 50.0)
+        yield f"64 bytes from {safe_target}: icmp_seq={i+1} ttl={ttl} time={latency:.1f} ms\n"
+        simulate_latency(0.1)
+    
+    output = f"\n--- {safe_target} ping statistics ---\n"
+    output += f"4 packets transmitted, 4 received, 0% packet loss\n"
+    yield output
+
+def handle_traceroute_command(terminal, target):
+    """Handle traceroute with simulated hops, yielding each hop as it is reached."""
+    safe_target = html.escape(target)
+    yield f"traceroute to {safe_target}, 30 hops max, 60 byte packets\n"
+    for i in range(1, random.randint(5, 12) + 1):
+        ip = f"{random.randint(1,255)}.{random.randint(1,255)}.{random.randint(1,255)}.{random.randint(1,255)}"
+        latency = random.uniform(1.0, 50.0) * i
+        yield f" {i}  {ip}  {latency:.3f} ms\n"
+        simulate_latency(0.05)
+
+def init_session_if_needed():
+    """Initializes the simulation state if none is stored for this session."""
+    if g.get('sim_state') is not None:
+        return
+    sid = ensure_session_id()
+    # Released by commit_state once the state has been written back
+    session_locks.acquire(sid)
+    g.locked_sid = sid
+    state = load_session_state(sid)
+    if state is None:
+        state = get_default_state()
+        if log_archive is not None:
+            # Keep numbering after the archived history of an expired session
+            state['firewall_logs'].next_seq = log_archive.last_seq(sid) + 1
+        default = get_published_ruleset(app.config['DEFAULT_RULESET'])
+        if default is not None:
+            attach_ruleset(state, default, sid)
+        state_store.save(sid, state)
+        lifetime = app.config['PERMANENT_SESSION_LIFETIME'].total_seconds()
+        emit_to_session('session_initialized', {'lifetime': lifetime})
+    g.sim_state = state
+
+def commit_session_state():
+    """Flush batched logs, write modified state back and release the session lock.
+
+    Runs at teardown, or earlier once a streaming command or export has
+    done its work on the state. Later changes to the state are not saved.
+    """
+    sid = g.pop('locked_sid', None)
+    if sid is None:
+        return
+    try:
+        flush_pending_logs()
+        if g.pop('sim_state_dirty', False):
+            state_store.save(sid, g.sim_state)
+    finally:
+        session_locks.release(sid)
+
+def commit_after_first(pieces):
+    """Yield ``pieces``, committing the session state once the first one is produced.
+
+    Streaming commands and exports only read and change the state before
+    producing their first piece, so the rest is sent without holding up
+    the session's other events.
+    """
+    pieces = iter(pieces)
+    first = next(pieces, None)
+    commit_session_state()
+    if first is not None:
+        yield first
+    yield from pieces
+
+@app.teardown_request
+def commit_state(exc):
+    """Flush batched logs and write modified state back after each request or event."""
+    commit_session_state()
+
+@app.route('/')
+def index():
+    ensure_session_id()
+    return render_template('index.html')
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def require_profiler_token():
+    token = app.config['PROFILER_TOKEN']
+    if not token or request.args.get('token') != token:
+        abort(404)
+
+@app.route('/debug/profiler', methods=['GET'])
+def profiler_report():
+    """Collapsed stacks sampled since the profiler was last started."""
+    require_profiler_token()
+    return Response(profiler.collapsed(), mimetype='text/plain')
+
+@app.route('/debug/profiler/start', methods=['POST'])
+def profiler_start():
+    require_profiler_token()
+    try:
+        interval = float(request.args.get('interval', 0.005))
+    except ValueError:
+        interval = None
+    if interval is None or not 0 < interval < float('inf'):
+        return jsonify({'running': False, 'error': "interval must be a positive number of seconds"}), 400
+    try:
+        profiler.start(interval)
+    except ValueError as e:
+        # signal handlers can only be installed from the main thread
+        return jsonify({'running': False, 'error': str(e)}), 409
+    return jsonify({'running': True, 'interval': interval})
+
+@app.route('/debug/profiler/stop', methods=['POST'])
+def profiler_stop():
+    require_profiler_token()
+    profiler.stop()
+    return jsonify({'running': False, 'samples': sum(profiler.stacks.values())})
+
+EXPORT_FORMATS = {
+    'text': 'text/plain',
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'iptables-save': 'text/plain',
+}
+RULE_FIELDS = ('chain', 'source', 'destination', 'protocol', 'sport', 'dport',
+               'src_set', 'dst_set', 'ctstate', 'target', 'packets', 'bytes')
+LOG_FIELDS = ('timestamp', 'action', 'source', 'destination', 'protocol', 'port',
+              'rule', 'category', 'warning', 'details', 'count')
+
+def csv_line(values):
+    """Format one CSV record."""
+    buf = io.StringIO()
+    csv.writer(buf).writerow(values)
+    return buf.getvalue()
+
+def rule_to_command(chain, rule):
+    cmd = f"iptables -A {chain}"
+    if rule['source'] != '0.0.0.0/0': cmd += f" -s {rule['source']}"
+    if rule['destination'] != '0.0.0.0/0': cmd += f" -d {rule['destination']}"
+    if rule['protocol'] != 'all': cmd += f" -p {rule['protocol']}"
+    if ',' in (rule['sport'] or '') + (rule['dport'] or ''):
+        cmd += " -m multiport"
+        if rule['sport']: cmd += f" --sports {rule['sport']}"
+        if rule['dport']: cmd += f" --dports {rule['dport']}"
+    else:
+        if rule['sport']: cmd += f" --sport {rule['sport']}"
+        if rule['dport']: cmd += f" --dport {rule['dport']}"
+    for key, direction in (('src_set', 'src'), ('dst_set', 'dst')):
+        if rule.get(key): cmd += f" -m set --match-set {rule[key]} {direction}"
+    if rule.get('ctstate'): cmd += f" -m state --state {rule['ctstate']}"
+    return cmd + f" -j {rule['target']}"
+
+def iter_rules_export(state, fmt='text'):
+    """Yield the session's rules as lines of an export in ``fmt``."""
+    # Copy the rule lists up front so the export is consistent even if the
+    # chains change while it is being streamed
+    chains = [(chain, list(rules), list(state['rule_counters'][chain]))
+              for chain, rules in state['iptables_rules'].items()]
+
+    if fmt == 'iptables-save':
+        yield from iter_iptables_save(state, chains)
+        return
+
+    if fmt == 'text':
+        yield "# Firewall Rules Configuration\n"
+        yield f"# Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+        # Chains are created before any rule can jump to them
+        user_chains = [chain for chain, _, _ in chains if chain not in BUILTIN_CHAINS]
+        if user_chains:
+            yield ''.join(f"iptables -N {chain}\n" for chain in user_chains) + "\n"
+        for chain, rules, _ in chains:
+            yield f"# {chain} Chain\n"
+            if chain in BUILTIN_CHAINS and state['chain_policies'][chain] != 'DROP':
+                yield f"iptables -P {chain} {state['chain_policies'][chain]}\n"
+            for rule in rules:
+                yield rule_to_command(chain, rule) + "\n"
+            yield "\n"
+        return
+
+    if fmt == 'csv':
+        yield csv_line(RULE_FIELDS)
+    for chain, rules, counters in chains:
+        for rule, counter in zip(rules, counters):
+            row = dict(rule, chain=chain, packets=counter['packets'], bytes=counter['bytes'])
+            if fmt == 'csv':
+                yield csv_line([row.get(field) for field in RULE_FIELDS])
+            else:
+                yield json.dumps({field: row.get(field) for field in RULE_FIELDS}) + "\n"
+
+def log_stats(state):
+    """Log totals over the entries the session's logs are read from: the archive if enabled, else the buffer."""
+    if log_archive is not None:
+        return log_archive.stats(current_sid())
+    return state['firewall_logs'].stats()
+
+def iter_logs_export(state, fmt='text'):
+    """Yield the session's logs as lines of an export in ``fmt``."""
+    flush_log_windows(state)
+    if log_archive is not None:
+        records = log_archive.records(session['sid'])
+    else:
+        records = list(state['firewall_logs'])
+
+    if fmt == 'text':
+        warnings = detect_rule_conflicts()
+        stats = log_stats(state)
+        stats['warnings'] += len(warnings)
+        yield '# Firewall Logs Export\n'
+        yield f"# Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+        yield f"# Total Logs: {stats['total']}\n"
+        yield f"# Blocked: {stats['blocked']}\n"
+        yield f"# Allowed: {stats['allowed']}\n"
+        yield f"# Warnings: {stats['warnings']}\n\n"
+        yield '## Log Entries\n\n'
+        for record in records:
+            log = record.to_dict()
+            details = log['details']
+            if log['rule']:
+                details += f" | Rule: {log['rule']}"
+            if log['warning']:
+                details += f" | Warning: {log['warning']}"
+            yield f"[{log['timestamp']}] {log['action']} - {details}\n"
+        return
+
+    if fmt == 'csv':
+        yield csv_line(LOG_FIELDS)
+        for log in records:
+            entry = log.to_dict()
+            yield csv_line([entry[field] for field in LOG_FIELDS])
+    else:
+        for log in records:
+            yield json.dumps(log.to_dict()) + "\n"
+
+def chunked(pieces, size=EXPORT_CHUNK_SIZE):
+    """Join small strings into chunks of roughly ``size`` characters."""
+    buffer, length = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+EXPORTS = {
+    'rules': (iter_rules_export, {'text': 'waf', 'jsonl': 'jsonl', 'csv': 'csv', 'iptables-save': 'rules'}),
+    'logs': (iter_logs_export, {'text': 'txt', 'jsonl': 'jsonl', 'csv': 'csv'}),
+}
+
+def stream_export(kind, data):
+    """Send an export as a sequence of export_chunk messages.
+
+    Every chunk carries the export id and its sequence number; the last one
+    has ``final`` set, so the client can reassemble the file in order.
+    """
+    init_session_if_needed()
+    fmt = (data or {}).get('format', 'text')
+    generate, extensions = EXPORTS[kind]
+    if fmt not in extensions:
+        emit('export_chunk', {'kind': kind, 'error': f"Unknown export format: {fmt}"})
+        return
+    export_id = uuid.uuid4().hex
+    header = {
+        'id': export_id, 'kind': kind, 'format': fmt,
+        'mimetype': EXPORT_FORMATS[fmt], 'extension': extensions[fmt],
+    }
+    seq = 0
+    for chunk in chunked(commit_after_first(generate(get_state(), fmt))):
+        emit('export_chunk', dict(header, seq=seq, data=chunk, final=False))
+        seq += 1
+        socketio.sleep(0)  # let other clients run between chunks
+    emit('export_chunk', dict(header, seq=seq, data='', final=True))
+
+@app.route('/export/<kind>')
+def export_download(kind):
+    """Stream an export of the session's rules or logs as a file download."""
+    fmt = request.args.get('format', 'text')
+    if kind not in EXPORTS or fmt not in EXPORTS[kind][1]:
+        abort(404)
+    init_session_if_needed()
+    generate, extensions = EXPORTS[kind]
+    filename = f"{kind}_{datetime.now().strftime('%Y%m%d%H%M%S')}.{extensions[fmt]}"
+    return Response(
+        stream_with_context(chunked(commit_after_first(generate(get_state(), fmt)))),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
+
+@socketio.on('get_rules')
+def get_rules(data=None):
+    """Stream session-specific rules for download (formats: text, jsonl, csv)"""
+    stream_export('rules', data)
+
+def _filter_values(value):
+    if value is None or value == '':
+        return None
+    return {value} if isinstance(value, str) else set(value)
+
+def _filter_network(value):
+    if not value:
+        return None
+    network = ipaddress.ip_network(value, strict=False)
+    return (network.version, int(network.network_address), int(network.netmask))
+
+def build_log_filter(params):
+    """Build a predicate over LogRecords from get_logs filter parameters.
+
+    Supported keys: ``action`` and ``category`` (a value or list of values),
+    ``source`` and ``destination`` (an address or CIDR) and ``start``/``end``
+    (timestamps in the log's ``YYYY-MM-DD HH:MM:SS`` format, inclusive).
+    Raises ValueError for an invalid address.
+    """
+    actions = _filter_values(params.get('action'))
+    categories = _filter_values(params.get('category'))
+    source = _filter_network(params.get('source'))
+    destination = _filter_network(params.get('destination'))
+    start = params.get('start') or None
+    end = params.get('end') or None
+
+    def matches(record):
+        if actions is not None and record.action not in actions:
+            return False
+        if categories is not None and record.category not in categories:
+            return False
+        if source is not None and not _address_matches(source, record.source, _parse_ip(record.source)):
+            return False
+        if destination is not None and not _address_matches(destination, record.destination, _parse_ip(record.destination)):
+            return False
+        if start is not None and record.timestamp < start:
+            return False
+        if end is not None and record.timestamp > end:
+            return False
+        return True
+
+    return matches
+
+def _log_time(value):
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timestamp()
+
+def archive_conditions(params):
+    """Translate get_logs filters into SQL clauses for the log archive.
+
+    Only the indexable filters are translated (CIDR ranges are left to the
+    build_log_filter predicate, which is still applied to every row).
+    Raises ValueError for a malformed timestamp.
+    """
+    clauses, arguments = [], []
+    for column in ('action', 'category'):
+        values = _filter_values(params.get(column))
+        if values is not None:
+            clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+            arguments.extend(sorted(values))
+    for column in ('source', 'destination'):
+        value = params.get(column)
+        if value and '/' not in value:
+            clauses.append(f"{column} = ?")
+            arguments.append(value)
+    if params.get('start'):
+        clauses.append('created >= ?')
+        arguments.append(_log_time(params['start']))
+    if params.get('end'):
+        # Timestamps have one-second resolution and the end is inclusive
+        clauses.append('created < ?')
+        arguments.append(_log_time(params['end']) + 1)
+    return clauses, arguments
+
+@socketio.on('get_logs')
+def get_logs(data=None):
+    """API endpoint to get session-specific firewall logs.
+
+    Only entries after the ``since`` cursor (a sequence number, 0 for all)
+    that match the optional filters are returned, at most ``limit`` per call.
+    The response's ``cursor`` is passed as ``since`` on the next call;
+    ``has_more`` says another page is waiting. Entries older than ``oldest``
+    have been evicted or cleared and should be dropped by the client.
+    With a log archive, entries are read from it and reach back over the
+    session's whole history.
+    """
+    init_session_if_needed()
+    state = get_state()
+    data = data or {}
+    flush_log_windows(state)
+    buffer = state['firewall_logs']
+
+    try:
+        since = int(data.get('since', 0))
+        limit = max(1, min(int(data.get('limit', LOG_PAGE_SIZE)), MAX_LOGS))
+        matches = build_log_filter(data)
+        conditions = archive_conditions(data) if log_archive is not None else None
+    except (TypeError, ValueError) as e:
+        emit('logs_data', {'error': f"Invalid log query: {e}"})
+        return
+
+    page = []
+    cursor = buffer.next_seq - 1
+    has_more = False
+    if log_archive is not None:
+        records = log_archive.records(session['sid'], since, conditions, page_size=limit + 1)
+        oldest = log_archive.oldest_seq(session['sid']) or buffer.next_seq
+    else:
+        records = buffer.since(since)
+        oldest = buffer.oldest_seq
+    for record in records:
+        if not matches(record):
+            continue
+        if len(page) == limit:
+            # Resume after the last entry sent
+            cursor = page[-1]['seq']
+            has_more = True
+            break
+        page.append(record.to_dict())
+
+    warnings = detect_rule_conflicts()
+    stats = log_stats(state)
+    stats['warnings'] += len(warnings)
+    
+    emit('logs_data', {
+        'logs': page,
+        'cursor': cursor,
+        'has_more': has_more,
+        'oldest': oldest,
+        'warnings': warnings,
+        'stats': stats
+    })
+
+@socketio.on('clear_logs')
+def clear_logs_endpoint():
+    """API endpoint to clear session-specific logs and counters"""
+    init_session_if_needed()
+    state = get_state()
+    state['firewall_logs'].clear()
+    state['log_policy'].clear()
+    if log_archive is not None:
+        log_archive.delete(session['sid'])
+    
+    # Reset rule counters
+    for chain in state['rule_counters']:
+        for counter in state['rule_counters'][chain]:
+            counter['packets'] = 0
+            counter['bytes'] = 0
+            
+    log_firewall_event('INFO', 'N/A', 'N/A', 'N/A', None, "Logs and statistics cleared", 'info')
+    mark_state_modified()
+    
+    # After clearing, immediately send back the new empty log state
+    get_logs()
+
+def rule_port_error(rule):
+    """Error message for a malformed or out-of-range port match, else None."""
+    for key in ('sport', 'dport'):
+        if rule[key] is not None:
+            try:
+                parse_port_spec(rule[key])
+            except ValueError:
+                return f"invalid {key}: {rule[key]}"
+    return None
+
+def validate_rule(rule, sets=()):
+    """Return an error message for a rule with a malformed address or port or
+    an unknown set (``sets`` holds the known set names), else None."""
+    for key in ('source', 'destination'):
+        try:
+            ipaddress.ip_network(rule[key], strict=False)
+        except ValueError:
+            return f"invalid {key} address: {rule[key]}"
+    error = rule_port_error(rule)
+    if error:
+        return error
+    for key in ('src_set', 'dst_set'):
+        if rule.get(key) and rule[key] not in sets:
+            return f"set {rule[key]} does not exist"
+    if rule.get('ctstate') and not set(rule['ctstate'].upper().split(',')) <= CONNTRACK_STATES:
+        return f"invalid state: {rule['ctstate']}"
+    return None
+
+def rule_key(rule):
+    return (rule['source'], rule['destination'], rule['protocol'],
+            rule['sport'], rule['dport'], rule.get('src_set'), rule.get('dst_set'), rule.get('ctstate'),
+            rule['target'])
+
+def parse_rules_script(script, sets=()):
+    """Parse an iptables script in one pass without touching the session.
+
+    Understands ``-A``, ``-I``, ``-F``, ``-D``, ``-P``, ``-N`` and ``-X``
+    lines (``-F`` and ``-X`` without a chain act on all chains); blank
+    lines and ``#`` comments are skipped. Duplicate rules are
+    dropped through a set of rule keys per chain, and jumps are checked
+    against the chains created so far, so no loop can be loaded. Returns
+    ``(rules, policies, report)``, where ``rules`` maps each chain
+    (user-defined ones included) to its new rule list, ``policies`` each
+    built-in chain to its policy, and ``report`` counts loaded and
+    duplicate rules and lists ``{'line', 'text', 'error'}`` for every
+    rejected line.
+    """
+    rules = {chain: [] for chain in BUILTIN_CHAINS}
+    policies = {chain: 'DROP' for chain in rules}
+    seen = {chain: set() for chain in rules}
+    errors = []
+    duplicates = 0
+
+    for number, line in enumerate(script.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split()
+
+        error = None
+        if parts[0].lower() == 'iptables' and len(parts) == 2 and parts[1] == '-F':
+            # Without a chain, -F flushes every chain
+            for chain in rules:
+                rules[chain] = []
+                seen[chain] = set()
+        elif parts[0].lower() == 'iptables' and len(parts) == 2 and parts[1] == '-X':
+            # Without a chain, -X deletes every user-defined chain
+            user_chains = [chain for chain in rules if chain not in BUILTIN_CHAINS]
+            busy = [chain for chain in user_chains if rules[chain] or chain_references(rules, chain)]
+            if busy:
+                error = f"chain {busy[0]} is not empty or still referenced"
+            else:
+                for chain in user_chains:
+                    del rules[chain]
+                    del seen[chain]
+        elif parts[0].lower() != 'iptables' or len(parts) < 3:
+            error = "not an iptables command"
+        elif parts[1] == '-N' and len(parts) == 3:
+            error = chain_name_error(parts[2], rules)
+            if error is None:
+                rules[parts[2]] = []
+                seen[parts[2]] = set()
+        elif parts[2] not in rules:
+            error = f"invalid chain: {parts[2]}"
+        elif parts[1] in ('-A', '-I'):
+            start, position = 3, len(rules[parts[2]])
+            if parts[1] == '-I':
+                start, position = (4, int(parts[3]) - 1) if len(parts) > 3 and parts[3].isdigit() else (3, 0)
+            rule, unknown = parse_rule_spec(parts, start)
+            error = (f"unknown option: {unknown[0]}" if unknown else
+                     validate_rule(rule, sets) or jump_error(rules, parts[2], rule['target']))
+            if error is None and not 0 <= position <= len(rules[parts[2]]):
+                error = f"invalid rule number: {parts[3]}"
+            if error is None:
+                key = rule_key(rule)
+                if key in seen[parts[2]]:
+                    duplicates += 1
+                else:
+                    seen[parts[2]].add(key)
+                    rules[parts[2]].insert(position, rule)
+        elif parts[1] == '-X' and len(parts) == 3:
+            if parts[2] in BUILTIN_CHAINS:
+                error = f"cannot delete built-in chain {parts[2]}"
+            elif rules[parts[2]] or chain_references(rules, parts[2]):
+                error = f"chain {parts[2]} is not empty or still referenced"
+            else:
+                del rules[parts[2]]
+                del seen[parts[2]]
+        elif parts[1] == '-P' and len(parts) == 4 and parts[2] in BUILTIN_CHAINS:
+            if parts[3].upper() in CHAIN_POLICIES:
+                policies[parts[2]] = parts[3].upper()
+            else:
+                error = f"invalid policy: {parts[3]}"
+        elif parts[1] == '-F' and len(parts) == 3:
+            rules[parts[2]] = []
+            seen[parts[2]] = set()
+        elif parts[1] == '-D' and len(parts) == 4 and parts[3].isdigit():
+            chain_rules = rules[parts[2]]
+            index = int(parts[3]) - 1
+            if 0 <= index < len(chain_rules):
+                seen[parts[2]].discard(rule_key(chain_rules.pop(index)))
+            else:
+                error = f"invalid rule number: {parts[3]}"
+        else:
+            error = f"unsupported option: {parts[1]}"
+
+        if error:
+            errors.append({'line': number, 'text': line, 'error': error})
+
+    loaded = sum(len(chain_rules) for chain_rules in rules.values())
+    return rules, policies, {'loaded': loaded, 'duplicates': duplicates, 'errors': errors}
+
+def install_chains(state, rules, counters=None):
+    """Replace every chain of the session with ``rules`` and compile them.
+
+    User-defined chains missing from ``rules`` are removed. ``counters``
+    holds the packet/byte counters per chain (fresh ones when omitted).
+    """
+    ensure_private_rules(state)
+    for chain in [chain for chain in state['iptables_rules'] if chain not in rules]:
+        del state['iptables_rules'][chain]
+        del state['rule_counters'][chain]
+        state['chain_keys'].pop(chain, None)
+    for chain, chain_rules in rules.items():
+        state['iptables_rules'][chain] = chain_rules
+        state['rule_counters'][chain] = (counters[chain] if counters is not None
+                                         else [{'packets': 0, 'bytes': 0} for _ in chain_rules])
+        invalidate_chain(chain)
+        get_compiled_chain(chain)
+
+@socketio.on('load_rules_from_script')
+def load_rules_from_script(data):
+    """Replace the session's rules with those of an iptables script.
+
+    The script is parsed and validated in full before the session is
+    touched; the new chains are then swapped in together and compiled once.
+    With ``strict`` set, any rejected line aborts the whole load. Emits a
+    ``rules_loaded`` report with per-line errors.
+    """
+    init_session_if_needed()
+    state = get_state()
+    rules, policies, report = parse_rules_script(data.get('script', ''), state['ipsets'])
+
+    if data.get('strict') and report['errors']:
+        report['loaded'] = 0
+        report['applied'] = False
+        emit('rules_loaded', report)
+        return
+
+    install_chains(state, rules)
+    state['chain_policies'].update(policies)
+    
+    # Log the event
+    log_firewall_event('INFO', 'N/A', 'N/A', 'N/A', None,
+                       f"Firewall rules loaded from file ({report['loaded']} rules).", 'info')
+    report['applied'] = True
+    emit('rules_loaded', report)
+
+# iptables-save lists the built-in filter chains in this order
+SAVE_CHAIN_ORDER = ('INPUT', 'FORWARD', 'OUTPUT')
+SAVE_COUNTERS = re.compile(r'\[(\d+):(\d+)\]')
+# Matches that are implied by the rule's other options and can be dropped
+# Comments carry no match semantics and are dropped before parsing
+IMPLICIT_MATCHES = {'comment'}
+# Options taking one argument that do not change the simulated verdict: the
+# REJECT reply type, and the ICMP type (every simulated ICMP flow is a ping)
+NO_OP_OPTIONS = {'--reject-with', '--icmp-type'}
+INTERFACE_OPTIONS = {'-i', '-o', '--in-interface', '--out-interface'}
+
+def iter_iptables_save(state, chains):
+    """Yield the filter table in iptables-save format, with counters (as ``iptables-save -c``)."""
+    by_name = {chain: (rules, counters) for chain, rules, counters in chains}
+    order = SAVE_CHAIN_ORDER + tuple(chain for chain in by_name if chain not in SAVE_CHAIN_ORDER)
+    now = datetime.now().strftime('%a %b %d %H:%M:%S %Y')
+    yield f"# Generated by firewall-simulator on {now}\n"
+    yield "*filter\n"
+    for chain in order:
+        if chain in SAVE_CHAIN_ORDER:
+            counter = state['policy_counters'][chain]
+            yield f":{chain} {state['chain_policies'][chain]} [{counter['packets']}:{counter['bytes']}]\n"
+        else:
+            yield f":{chain} - [0:0]\n"
+    for chain in order:
+        rules, counters = by_name[chain]
+        for rule, counter in zip(rules, counters):
+            spec = rule_to_command(chain, rule)[len('iptables '):]
+            if rule['protocol'] in ('tcp', 'udp') and (rule['sport'] or rule['dport']) and ' -m multiport' not in spec:
+                spec = spec.replace(f" -p {rule['protocol']}", f" -p {rule['protocol']} -m {rule['protocol']}", 1)
+            yield f"[{counter['packets']}:{counter['bytes']}] {spec}\n"
+    yield "COMMIT\n"
+    yield f"# Completed on {now}\n"
+
+def _save_rule_tokens(line):
+    if '"' in line or "'" in line:
+        return shlex.split(line)
+    return line.split()
+
+def parse_iptables_save(lines, sets=()):
+    """Incrementally parse iptables-save output.
+
+    ``lines`` can be any iterable of lines (a file, a request stream), so a
+    dump is never held in memory as a whole. Yields events in input order:
+
+    - ``('table', line, name)`` at ``*name``
+    - ``('chain', line, chain, policy, packets, bytes)`` for ``:chain`` headers
+      (policy is None for user-defined chains)
+    - ``('rule', line, chain, rule, packets, bytes)`` for ``-A`` lines
+    - ``('skipped', line, text, reason)`` for loopback rules, which no
+      simulated flow can match
+    - ``('commit', line, name)`` at ``COMMIT``
+    - ``('error', line, text, message)`` for anything that cannot be used
+    """
+    table = None
+    declared = set(SAVE_CHAIN_ORDER)
+    for number, raw in enumerate(lines, 1):
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8', 'replace')
+        line = raw.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        if line.startswith('*'):
+            table = line[1:]
+            declared = set(SAVE_CHAIN_ORDER)
+            yield ('table', number, table)
+            continue
+        if line == 'COMMIT':
+            if table is None:
+                yield ('error', number, line, "COMMIT outside a table")
+            else:
+                yield ('commit', number, table)
+            table = None
+            continue
+        if table is None:
+            yield ('error', number, line, "line outside a table")
+            continue
+        if table != 'filter':
+            # Only the filter table is simulated; other tables are skipped whole
+            continue
+
+        packets = bytes_count = 0
+        counters = SAVE_COUNTERS.match(line)
+        if counters and not line.startswith(':'):
+            packets, bytes_count = int(counters.group(1)), int(counters.group(2))
+            line = line[counters.end():].lstrip()
+
+        if line.startswith(':'):
+            fields = line[1:].split()
+            chain_counters = SAVE_COUNTERS.fullmatch(fields[2]) if len(fields) > 2 else None
+            if len(fields) < 2:
+                yield ('error', number, line, "malformed chain header")
+            elif fields[0] not in SAVE_CHAIN_ORDER:
+                error = chain_name_error(fields[0], declared) if fields[1] == '-' else "user-defined chains have no policy"
+                if error:
+                    yield ('error', number, line, error)
+                else:
+                    declared.add(fields[0])
+                    yield ('chain', number, fields[0], None, 0, 0)
+            elif fields[1] not in CHAIN_POLICIES:
+                yield ('error', number, line, f"invalid policy: {fields[1]}")
+            else:
+                if chain_counters:
+                    packets, bytes_count = int(chain_counters.group(1)), int(chain_counters.group(2))
+                yield ('chain', number, fields[0], fields[1], packets, bytes_count)
+            continue
+
+        try:
+            parts = _save_rule_tokens(line)
+        except ValueError as e:
+            yield ('error', number, line, str(e))
+            continue
+        if len(parts) < 2 or parts[0] != '-A':
+            yield ('error', number, line, f"unsupported command: {parts[0]}")
+            continue
+        if parts[1] not in declared:
+            yield ('error', number, line, f"chain {parts[1]} is not declared")
+            continue
+
+        # Drop implicit matches (-m tcp, -m comment --comment ...) before parsing
+        tokens = []
+        loopback = False
+        i = 2
+        while i < len(parts):
+            if parts[i] == '-m' and i + 1 < len(parts) and parts[i + 1] in IMPLICIT_MATCHES:
+                i += 2
+            elif parts[i] in NO_OP_OPTIONS | {'--comment'} and i + 1 < len(parts):
+                i += 2
+            elif parts[i] in INTERFACE_OPTIONS and i + 1 < len(parts) and parts[i + 1] == 'lo':
+                loopback = True
+                i += 2
+            else:
+                tokens.append(parts[i])
+                i += 1
+        rule, unknown = parse_rule_spec(tokens, 0)
+        error = f"unsupported option: {unknown[0]}" if unknown else validate_rule(rule, sets)
+        if error is None and rule['target'] not in RULE_TARGETS and (
+                rule['target'] not in declared or rule['target'] in SAVE_CHAIN_ORDER):
+            error = f"Unknown target {rule['target']} (not a standard target or user-defined chain)"
+        if error:
+            yield ('error', number, line, error)
+        elif loopback:
+            yield ('skipped', number, line, "loopback traffic is not simulated")
+        else:
+            yield ('rule', number, parts[1], rule, packets, bytes_count)
+
+def restore_iptables(lines, noflush=False):
+    """Apply an iptables-save dump to the current session, like iptables-restore.
+
+    The filter table is staged and only applied at its COMMIT, so a
+    truncated dump, one whose jumps form a loop or one with any line that
+    was not understood changes nothing. Loopback rules are skipped. Unless
+    ``noflush`` is set the restored chains replace the current ones;
+    otherwise rules are appended. Policies and packet/byte counters are
+    kept. Returns a report shaped like the one from load_rules_from_script.
+    """
+    state = get_state()
+    errors = []
+    staged = None
+    loaded = duplicates = skipped = 0
+    applied = False
+
+    for event in parse_iptables_save(lines, state['ipsets']):
+        kind, number = event[0], event[1]
+        if kind == 'error':
+            errors.append({'line': number, 'text': event[2], 'error': event[3]})
+        elif kind == 'skipped':
+            skipped += 1
+        elif kind == 'table' and event[2] == 'filter':
+            table_errors = len(errors)
+            staged = {
+                chain: {
+                    'rules': [] if not noflush else list(state['iptables_rules'][chain]),
+                    'counters': [] if not noflush else list(state['rule_counters'][chain]),
+                    'policy': state['chain_policies'].get(chain, 'DROP') if noflush else 'DROP',
+                    'policy_counter': (dict(state['policy_counters'][chain]) if noflush and chain in SAVE_CHAIN_ORDER
+                                       else {'packets': 0, 'bytes': 0}),
+                }
+                for chain in (state['iptables_rules'] if noflush else SAVE_CHAIN_ORDER)
+            }
+            seen = {chain: {rule_key(rule) for rule in staged[chain]['rules']} for chain in staged}
+        elif kind == 'chain' and staged is not None:
+            _, _, chain, policy, packets, bytes_count = event
+            if policy is None:
+                staged.setdefault(chain, {'rules': [], 'counters': []})
+                seen.setdefault(chain, set())
+                continue
+            staged[chain]['policy'] = policy
+            staged[chain]['policy_counter'] = {'packets': packets, 'bytes': bytes_count}
+        elif kind == 'rule' and staged is not None:
+            _, _, chain, rule, packets, bytes_count = event
+            key = rule_key(rule)
+            if key in seen[chain]:
+                duplicates += 1
+                continue
+            seen[chain].add(key)
+            staged[chain]['rules'].append(rule)
+            staged[chain]['counters'].append({'packets': packets, 'bytes': bytes_count})
+            loaded += 1
+        elif kind == 'commit' and event[2] == 'filter' and staged is not None:
+            if len(errors) > table_errors:
+                errors.append({'line': number, 'text': 'COMMIT',
+                               'error': f"{len(errors) - table_errors} line(s) not understood; nothing applied"})
+                staged = None
+                loaded = 0
+                continue
+            loop = find_chain_loop({chain: table['rules'] for chain, table in staged.items()})
+            if loop is not None:
+                errors.append({'line': number, 'text': 'COMMIT', 'error': f"chain {loop} jumps back into itself; nothing applied"})
+                staged = None
+                loaded = 0
+                continue
+            install_chains(state, {chain: table['rules'] for chain, table in staged.items()},
+                           {chain: table['counters'] for chain, table in staged.items()})
+            for chain in SAVE_CHAIN_ORDER:
+                state['chain_policies'][chain] = staged[chain]['policy']
+                state['policy_counters'][chain] = staged[chain]['policy_counter']
+            staged = None
+            applied = True
+
+    if staged is not None:
+        errors.append({'line': None, 'text': '', 'error': "missing COMMIT for the filter table; nothing applied"})
+        loaded = 0
+    if applied:
+        log_firewall_event('INFO', 'N/A', 'N/A', 'N/A', None,
+                           f"Firewall rules restored from iptables-save ({loaded} rules).", 'info')
+    return {'loaded': loaded, 'duplicates': duplicates, 'skipped': skipped, 'errors': errors, 'applied': applied}
+
+@socketio.on('restore_rules')
+def restore_rules(data):
+    """Load rules from an iptables-save dump (``noflush`` appends instead of replacing)."""
+    init_session_if_needed()
+    script = io.StringIO(data.get('script', ''))
+    emit('rules_loaded', restore_iptables(script, bool(data.get('noflush'))))
+
+@app.route('/import/iptables-save', methods=['POST'])
+def import_iptables_save():
+    """Stream an iptables-save dump from the request body into the session's rules."""
+    init_session_if_needed()
+    noflush = request.args.get('noflush') in ('1', 'true')
+    return jsonify(restore_iptables(request.stream, noflush))
+
+@socketio.on('get_raw_logs')
+def get_raw_logs(data=None):
+    """Stream session-specific logs for download (formats: text, jsonl, csv)."""
+    stream_export('logs', data)
+
+SNAPSHOT_MAGIC = b'FWSN'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<4sH')
+SNAPSHOT_COUNTS = struct.Struct('<IIII')
+# Largest snapshot accepted once decompressed
+MAX_SNAPSHOT_BYTES = 64 * 1024 * 1024
+MAX_SNAPSHOTS = 20
+SNAPSHOT_NAME = re.compile(r'[A-Za-z0-9_.-]{1,64}')
+NETWORK_FIELDS = ('ip', 'netmask', 'gateway', 'network', 'zone')
+NETWORK_TERMINALS = ('insider', 'outsider', 'dmz', 'firewall')
+SNAPSHOT_RULE_FIELDS = ('source', 'destination', 'protocol', 'sport', 'dport',
+                        'src_set', 'dst_set', 'ctstate', 'target')
+SNAPSHOT_LOG_FIELDS = ('action', 'source', 'destination', 'protocol', 'port',
+                       'rule', 'category', 'warning')
+
+def _little_endian(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+class SnapshotWriter:
+    """Encodes a snapshot as packed streams.
+
+    Every distinct string is stored once and referenced by its index
+    (0 stands for None); integers such as rule counters and timestamps go
+    into packed 64-bit arrays. The streams are concatenated and compressed.
+    """
+
+    def __init__(self):
+        self._index = {None: 0}
+        self._strings = []
+        self.refs = array('I')
+        self.ints = array('q')
+        self.floats = array('d')
+
+    def _ref(self, value):
+        ref = self._index.get(value)
+        if ref is None:
+            ref = self._index[value] = len(self._strings) + 1
+            self._strings.append(value)
+        return ref
+
+    def strings(self, values):
+        self.refs.extend(map(self._ref, values))
+
+    def to_bytes(self):
+        encoded = [value.encode() for value in self._strings]
+        lengths = array('I', map(len, encoded))
+        body = b''.join([
+            SNAPSHOT_COUNTS.pack(len(lengths), len(self.refs), len(self.ints), len(self.floats)),
+            _little_endian(lengths), _little_endian(self.refs), _little_endian(self.ints),
+            _little_endian(self.floats), *encoded,
+        ])
+        return SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION) + zlib.compress(body)
+
+class SnapshotReader:
+    """Reads the streams written by SnapshotWriter back in the same order.
+
+    Raises ValueError for data that is not a snapshot of this version.
+    """
+
+    def __init__(self, data):
+        if len(data) < SNAPSHOT_HEADER.size:
+            raise ValueError("not a snapshot")
+        magic, version = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("not a snapshot")
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported snapshot version {version}")
+        try:
+            inflater = zlib.decompressobj()
+            body = inflater.decompress(data[SNAPSHOT_HEADER.size:], MAX_SNAPSHOT_BYTES)
+        except zlib.error:
+            raise ValueError("corrupt snapshot")
+        if inflater.unconsumed_tail:
+            raise ValueError("snapshot too large")
+        if len(body) < SNAPSHOT_COUNTS.size:
+            raise ValueError("truncated snapshot")
+
+        counts = SNAPSHOT_COUNTS.unpack_from(body)
+        offset = SNAPSHOT_COUNTS.size
+        streams = []
+        for typecode, count in zip('IIqd', counts):
+            values = array(typecode)
+            end = offset + count * values.itemsize
+            if end > len(body):
+                raise ValueError("truncated snapshot")
+            values.frombytes(body[offset:end])
+            if sys.byteorder == 'big':
+                values.byteswap()
+            streams.append(values)
+            offset = end
+        lengths, refs, ints, floats = streams
+        self._strings = [None]
+        for length in lengths:
+            self._strings.append(body[offset:offset + length].decode())
+            offset += length
+        self._refs = iter(refs)
+        self._ints = iter(ints)
+        self._floats = iter(floats)
+
+    def strings(self, count):
+        table = self._strings
+        return [table[ref] for ref in itertools.islice(self._refs, count)]
+
+    def string(self):
+        return self._strings[next(self._refs)]
+
+    def ints(self, count):
+        return list(itertools.islice(self._ints, count))
+
+    def int(self):
+        return next(self._ints)
+
+    def floats(self, count):
+        return list(itertools.islice(self._floats, count))
+
+def encode_snapshot(state):
+    """Serialize the network configuration, sets, chains with their counters and the log buffer."""
+    writer = SnapshotWriter()
+    ints = writer.ints
+
+    config = state['network_config']
+    ints.append(len(config))
+    for terminal, settings in config.items():
+        writer.strings([terminal, *(settings[field] for field in NETWORK_FIELDS)])
+
+    sets = state['ipsets']
+    ints.append(len(sets))
+    for name, ipset in sets.items():
+        writer.strings([name, ipset['type']])
+        ints.append(len(ipset['members']))
+        writer.strings(sorted(ipset['members']))
+
+    rules = state['iptables_rules']
+    ints.append(len(rules))
+    for chain, chain_rules in rules.items():
+        policy_counter = state['policy_counters'].get(chain, {'packets': 0, 'bytes': 0})
+        writer.strings([chain, state['chain_policies'].get(chain)])
+        ints.extend((policy_counter['packets'], policy_counter['bytes'], len(chain_rules)))
+        for rule in chain_rules:
+            writer.strings(rule.get(field) for field in SNAPSHOT_RULE_FIELDS)
+        for counter in state['rule_counters'][chain]:
+            ints.extend((counter['packets'], counter['bytes']))
+
+    # Logs are stored column by column, which also compresses best
+    records = list(state['firewall_logs'])
+    ints.append(len(records))
+    writer.floats.extend(record.created for record in records)
+    ints.extend(record.count for record in records)
+    for field in SNAPSHOT_LOG_FIELDS:
+        writer.strings(getattr(record, field) for record in records)
+    return writer.to_bytes()
+
+def network_config_error(terminal, settings):
+    """Error message for a terminal's restored network settings, or None."""
+    if terminal not in NETWORK_TERMINALS:
+        return f"unknown terminal {terminal}"
+    if not settings['zone']:
+        return f"{terminal} has no zone"
+    try:
+        for field in ('ip', 'netmask', 'gateway'):
+            value = settings[field]
+            if value is not None and not (terminal == 'firewall' and field == 'ip' and value == 'FIREWALL'):
+                ipaddress.ip_address(value)
+        if settings['network'] is not None:
+            ipaddress.ip_network(settings['network'], strict=False)
+    except ValueError:
+        return f"{terminal} has an invalid address"
+    return None
+
+def decode_snapshot(data):
+    """Parse and validate a snapshot. Raises ValueError if it cannot be restored."""
+    reader = SnapshotReader(data)
+    try:
+        network_config = {}
+        for _ in range(reader.int()):
+            terminal, *values = reader.strings(1 + len(NETWORK_FIELDS))
+            network_config[terminal] = dict(zip(NETWORK_FIELDS, values))
+
+        ipsets = {}
+        for _ in range(reader.int()):
+            name, set_type = reader.strings(2)
+            ipsets[name] = {'type': set_type, 'members': set(reader.strings(reader.int()))}
+
+        rules, counters, policies, policy_counters = {}, {}, {}, {}
+        for _ in range(reader.int()):
+            chain, policy = reader.strings(2)
+            packets, byte_count, count = reader.ints(3)
+            if chain in BUILTIN_CHAINS:
+                policies[chain] = policy
+                policy_counters[chain] = {'packets': packets, 'bytes': byte_count}
+            rules[chain] = [dict(zip(SNAPSHOT_RULE_FIELDS, reader.strings(len(SNAPSHOT_RULE_FIELDS))))
+                            for _ in range(count)]
+            packed = reader.ints(2 * count)
+            counters[chain] = [{'packets': packed[i], 'bytes': packed[i + 1]} for i in range(0, len(packed), 2)]
+
+        count = reader.int()
+        created = reader.floats(count)
+        packets = reader.ints(count)
+        columns = [reader.strings(count) for _ in SNAPSHOT_LOG_FIELDS]
+    except (StopIteration, IndexError):
+        raise ValueError("truncated snapshot")
+    logs = [LogRecord(created[i], *(column[i] for column in columns), count=packets[i])
+            for i in range(len(created))]
+
+    for terminal, settings in network_config.items():
+        error = network_config_error(terminal, settings)
+        if error:
+            raise ValueError(f"invalid network configuration: {error}")
+    for name, ipset in ipsets.items():
+        if ipset['type'] not in IPSET_TYPES:
+            raise ValueError("snapshot has an unknown set type")
+        try:
+            for member in ipset['members']:
+                normalize_set_entry(ipset['type'], member)
+        except (TypeError, ValueError):
+            raise ValueError(f"set {name} has an invalid member")
+    if set(policies) != set(BUILTIN_CHAINS) or not set(policies.values()) <= set(CHAIN_POLICIES):
+        raise ValueError("snapshot has invalid built-in chains")
+    if any(len(counters[chain]) != len(rules[chain]) or len(logs) != count for chain in rules):
+        raise ValueError("truncated snapshot")
+    for chain, chain_rules in rules.items():
+        if chain not in BUILTIN_CHAINS and chain_name_error(chain, ()):
+            raise ValueError(f"invalid chain name {chain}")
+        for rule in chain_rules:
+            # jump_error also rejects jumps that would form a loop
+            error = validate_rule(rule, ipsets) or jump_error(rules, chain, rule['target'])
+            if error:
+                raise ValueError(f"invalid rule in {chain}: {error}")
+
+    return {'network_config': network_config, 'ipsets': ipsets, 'rules': rules, 'counters': counters,
+            'policies': policies, 'policy_counters': policy_counters, 'logs': logs}
+
+def restore_snapshot(state, snapshot):
+    """Replace the session's configuration, chains, counters and logs with a decoded snapshot.
+
+    Connection tracking starts empty. Restored log entries replace the
+    archived history and get new sequence numbers after the current ones,
+    so client cursors stay valid.
+    """
+    for terminal, settings in snapshot['network_config'].items():
+        if terminal in state['network_config']:
+            state['network_config'][terminal].update(settings)
+    state['topology'].rebuild(state['network_config'])
+    state['ipsets'] = snapshot['ipsets']
+    state['set_keys'] = {}
+    install_chains(state, snapshot['rules'], snapshot['counters'])
+    state['chain_policies'].update(snapshot['policies'])
+    state['policy_counters'].update(snapshot['policy_counters'])
+    state['conntrack'] = ConntrackTable(app.config['CONNTRACK_MAX'])
+    invalidate_verdicts()
+
+    state['log_policy'].clear()
+    state['firewall_logs'].clear()
+    if log_archive is not None:
+        # The restored entries replace the archived history, as clear_logs does
+        log_archive.delete(current_sid())
+    for record in snapshot['logs']:
+        append_log(state, record)
+    mark_state_modified()
+
+    for terminal, settings in state['network_config'].items():
+        if terminal != 'firewall' and settings['ip']:
+            emit_to_session('update_ip_display', {
+                'terminal': terminal,
+                'ip': html.escape(settings['ip']),
+                'network': html.escape(settings['network']) if settings['network'] else None
+            })
+
+class SnapshotStore:
+    """Named snapshots of each session, in SQLite.
+
+    Snapshots expire with their session: every access moves the expiry of
+    all the session's snapshots forward by ``lifetime`` seconds. A session
+    keeps at most ``limit`` snapshots.
+    """
+
+    def __init__(self, path, lifetime, limit=MAX_SNAPSHOTS):
+        self.lifetime = lifetime
+        self.limit = limit
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS snapshots ('
+            ' sid TEXT NOT NULL, name TEXT NOT NULL, created REAL NOT NULL, expires REAL NOT NULL,'
+            ' data BLOB NOT NULL, PRIMARY KEY (sid, name))'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS snapshots_expires ON snapshots (expires)')
+
+    def _touch(self, sid):
+        now = time.time()
+        self._conn.execute('DELETE FROM snapshots WHERE expires <= ?', (now,))
+        self._conn.execute('UPDATE snapshots SET expires = ? WHERE sid = ?', (now + self.lifetime, sid))
+
+    def save(self, sid, name, data):
+        """Store a snapshot, replacing one of the same name. Returns False once the limit is reached."""
+        self._touch(sid)
+        names = {row[0] for row in self._conn.execute('SELECT name FROM snapshots WHERE sid = ?', (sid,))}
+        if name not in names and len(names) >= self.limit:
+            return False
+        now = time.time()
+        self._conn.execute('INSERT OR REPLACE INTO snapshots (sid, name, created, expires, data) VALUES (?, ?, ?, ?, ?)',
+                           (sid, name, now, now + self.lifetime, data))
+        return True
+
+    def load(self, sid, name):
+        self._touch(sid)
+        row = self._conn.execute('SELECT data FROM snapshots WHERE sid = ? AND name = ?', (sid, name)).fetchone()
+        return row[0] if row is not None else None
+
+    def list(self, sid):
+        """``(name, created, size)`` of the session's snapshots, oldest first."""
+        self._touch(sid)
+        return self._conn.execute('SELECT name, created, length(data) FROM snapshots WHERE sid = ? ORDER BY created',
+                                  (sid,)).fetchall()
+
+    def delete(self, sid, name):
+        return self._conn.execute('DELETE FROM snapshots WHERE sid = ? AND name = ?', (sid, name)).rowcount > 0
+
+snapshot_store = SnapshotStore(app.config['SNAPSHOT_PATH'],
+                               app.config['PERMANENT_SESSION_LIFETIME'].total_seconds())
+
+def snapshot_summary(snapshot):
+    rule_count = sum(len(chain_rules) for chain_rules in snapshot['rules'].values())
+    return f"{rule_count} rules, {len(snapshot['ipsets'])} sets, {len(snapshot['logs'])} log entries"
+
+def handle_snapshot_command(terminal, parts):
+    """Handle snapshot commands: save, load, list and delete named checkpoints of the session."""
+    state = get_state()
+    sid = session['sid']
+    option = parts[1] if len(parts) > 1 else 'list'
+    name = parts[2] if len(parts) > 2 else None
+    if name is not None and not SNAPSHOT_NAME.fullmatch(name):
+        raise CommandError(f"snapshot: invalid name {html.escape(name)}\n")
+
+    if option == 'list':
+        snapshots = snapshot_store.list(sid)
+        if not snapshots:
+            return "No snapshots saved\n"
+        output = f"{'NAME':<24} {'CREATED':<20} SIZE\n"
+        for snapshot_name, created, size in snapshots:
+            created = datetime.fromtimestamp(created).strftime("%Y-%m-%d %H:%M:%S")
+            output += f"{snapshot_name:<24} {created:<20} {size / 1024:.1f} KB\n"
+        return output
+
+    elif option == 'save' and name:
+        flush_log_windows(state, everything=True)
+        data = encode_snapshot(state)
+        if not snapshot_store.save(sid, name, data):
+            raise CommandError(f"snapshot: limit of {MAX_SNAPSHOTS} snapshots reached, delete one first\n")
+        return f"Snapshot {name} saved ({len(data) / 1024:.1f} KB)\n"
+
+    elif option == 'load' and name:
+        data = snapshot_store.load(sid, name)
+        if data is None:
+            raise CommandError(f"snapshot: {name} does not exist\n")
+        try:
+            snapshot = decode_snapshot(data)
+        except ValueError as e:
+            raise CommandError(f"snapshot: {html.escape(str(e))}\n")
+        restore_snapshot(state, snapshot)
+        return f"Snapshot {name} restored ({snapshot_summary(snapshot)})\n"
+
+    elif option == 'delete' and name:
+        if not snapshot_store.delete(sid, name):
+            raise CommandError(f"snapshot: {name} does not exist\n")
+        return f"Snapshot {name} deleted\n"
+
+    raise CommandError("Usage: snapshot [list|save <name>|load <name>|delete <name>]\n")
+
+@socketio.on('snapshot_save')
+def snapshot_save(data):
+    """Save a named snapshot of the session. With ``download`` set the binary snapshot is sent back too."""
+    init_session_if_needed()
+    name = str(data.get('name', ''))
+    if not SNAPSHOT_NAME.fullmatch(name):
+        emit('snapshot_saved', {'error': "Invalid snapshot name"})
+        return
+    state = get_state()
+    flush_log_windows(state, everything=True)
+    snapshot = encode_snapshot(state)
+    if not snapshot_store.save(session['sid'], name, snapshot):
+        emit('snapshot_saved', {'error': f"Limit of {MAX_SNAPSHOTS} snapshots reached"})
+        return
+    reply = {'name': name, 'size': len(snapshot)}
+    if data.get('download'):
+        reply['data'] = snapshot
+    emit('snapshot_saved', reply)
+
+@socketio.on('snapshot_load')
+def snapshot_load(data):
+    """Restore a saved snapshot by ``name``, or an uploaded binary snapshot given as ``data``."""
+    init_session_if_needed()
+    if data.get('data') is not None:
+        snapshot = data['data']
+        if not isinstance(snapshot, (bytes, bytearray)):
+            emit('snapshot_loaded', {'error': "Snapshot data must be binary"})
+            return
+    else:
+        snapshot = snapshot_store.load(session['sid'], str(data.get('name', '')))
+        if snapshot is None:
+            emit('snapshot_loaded', {'error': "Snapshot does not exist"})
+            return
+    try:
+        decoded = decode_snapshot(bytes(snapshot))
+    except ValueError as e:
+        emit('snapshot_loaded', {'error': html.escape(str(e))})
+        return
+    restore_snapshot(get_state(), decoded)
+    emit('snapshot_loaded', {
+        'rules': sum(len(chain_rules) for chain_rules in decoded['rules'].values()),
+        'sets': len(decoded['ipsets']),
+        'logs': len(decoded['logs']),
+        'summary': snapshot_summary(decoded),
+    })
+
+@socketio.on('snapshot_list')
+def snapshot_list():
+    """List the session's snapshots."""
+    init_session_if_needed()
+    emit('snapshots', [{'name': name, 'created': created, 'size': size}
+                       for name, created, size in snapshot_store.list(session['sid'])])
+
+class SparseCounters:
+    """Packet/byte counters of a shared chain, created on first use.
+
+    Behaves like the list of counter dicts of a private chain for reading
+    and for updating counters in place, but a session only stores the
+    counters of rules that have matched, so its size does not grow with the
+    ruleset. It becomes a plain list when the session copies the rules.
+    """
+
+    def __init__(self, length):
+        self._length = length
+        self._counters = {}
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        return self._counters.setdefault(index, {'packets': 0, 'bytes': 0})
+
+    def __iter__(self):
+        for index in range(self._length):
+            yield self._counters.get(index) or {'packets': 0, 'bytes': 0}
+
+class PublishedRuleset:
+    """A named, immutable ruleset shared by every session that uses it.
+
+    Rule lists and rule dicts are shared, never modified. Published
+    rulesets are kept in the state store, so every instance sees them;
+    each instance compiles a version's chains once, when it first uses it.
+    Republishing a name creates a new version; subscribed sessions switch
+    to it on their next event.
+    """
+    __slots__ = ('name', 'version', 'rules', 'policies', 'ipsets', 'chain_keys', 'published')
+
+    def __init__(self, name, version, rules, policies, ipsets):
+        self.name = name
+        self.version = version
+        self.rules = rules
+        self.policies = policies
+        self.ipsets = ipsets
+        self.published = time.time()
+        self.chain_keys = {chain: hashlib.sha1(json.dumps(chain_rules, sort_keys=True).encode()).hexdigest()
+                           for chain, chain_rules in rules.items()}
+
+    def pin(self):
+        """Compile the chains and keep them compiled while this version is in use."""
+        for chain, key in self.chain_keys.items():
+            if key not in _pinned_chains:
+                _pinned_chains[key] = CompiledChain(self.rules[chain])
+
+    def summary(self):
+        return {
+            'name': self.name,
+            'version': self.version,
+            'rules': sum(len(chain_rules) for chain_rules in self.rules.values()),
+            'chains': list(self.rules),
+            'subscribers': len(ruleset_subscribers(self.name)),
+            'published': datetime.fromtimestamp(self.published).strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+# Versions of published rulesets this instance has compiled, by name, and
+# the sessions of this instance using each (sid -> time last seen)
+_published_rulesets = {}
+_ruleset_subscribers = {}
+
+def subscribe_ruleset(name, sid):
+    _ruleset_subscribers.setdefault(name, {})[sid] = time.time()
+
+def unsubscribe_ruleset(name, sid):
+    _ruleset_subscribers.get(name, {}).pop(sid, None)
+
+def ruleset_subscribers(name):
+    """Sessions of this instance using a ruleset; those not seen for a session lifetime have expired."""
+    subscribers = _ruleset_subscribers.get(name, {})
+    cutoff = time.time() - state_store.lifetime
+    for sid in [sid for sid, seen in subscribers.items() if seen <= cutoff]:
+        del subscribers[sid]
+    return list(subscribers)
+
+def _cache_ruleset(published):
+    previous = _published_rulesets.get(published.name)
+    published.pin()
+    _published_rulesets[published.name] = published
+    if previous is not None and previous is not published:
+        still_used = {key for other in _published_rulesets.values() for key in other.chain_keys.values()}
+        for key in previous.chain_keys.values():
+            if key not in still_used:
+                _pinned_chains.pop(key, None)
+    return published
+
+def get_published_ruleset(name):
+    """Latest version of a published ruleset, or None if ``name`` was never published."""
+    version = state_store.ruleset_version(name) if name else None
+    if version is None:
+        return None
+    cached = _published_rulesets.get(name)
+    if cached is not None and cached.version == version:
+        return cached
+    published = state_store.load_ruleset(name)
+    return _cache_ruleset(published) if published is not None else None
+
+def list_published_rulesets():
+    return [published for published in map(get_published_ruleset, state_store.ruleset_names())
+            if published is not None]
+
+def publish_ruleset(name, rules, policies, ipsets):
+    """Publish (or republish) a named ruleset and notify the sessions using it."""
+    version = (state_store.ruleset_version(name) or 0) + 1
+    published = _cache_ruleset(PublishedRuleset(name, version, rules, policies, ipsets))
+    state_store.save_ruleset(published)
+    for sid in ruleset_subscribers(name):
+        emit_to_session('ruleset_updated', published.summary(), sid=sid)
+    return published
+
+def attach_ruleset(state, published, sid, keep_sets=False):
+    """Point a session at a published ruleset, replacing its rules, policies and sets.
+
+    With ``keep_sets`` the session's own sets are kept and only the sets it
+    lacks are taken from the ruleset.
+    """
+    previous = state.get('ruleset')
+    if previous is not None and previous['name'] != published.name:
+        unsubscribe_ruleset(previous['name'], sid)
+    sets = copy.deepcopy(published.ipsets)
+    if keep_sets:
+        sets.update(state['ipsets'])
+    state['iptables_rules'] = published.rules
+    state['rule_counters'] = {chain: SparseCounters(len(rules)) for chain, rules in published.rules.items()}
+    state['chain_keys'] = dict(published.chain_keys)
+    state['chain_policies'] = dict(published.policies)
+    state['ipsets'] = sets
+    state['set_keys'] = {}
+    state['ruleset'] = {'name': published.name, 'version': published.version, 'private': False,
+                        'own_sets': keep_sets}
+    subscribe_ruleset(published.name, sid)
+    # Works on ``state`` directly: new sessions are attached before they are current
+    state['ruleset_generation'] += 1
+
+def ensure_private_rules(state):
+    """Copy a shared ruleset into the session before its rules change (copy-on-write).
+
+    Returns the session's (now private) rules by chain.
+    """
+    attached = state.get('ruleset')
+    if attached is not None and not attached['private']:
+        state['iptables_rules'] = {chain: list(rules) for chain, rules in state['iptables_rules'].items()}
+        state['rule_counters'] = {chain: list(counters) for chain, counters in state['rule_counters'].items()}
+        attached['private'] = True
+        unsubscribe_ruleset(attached['name'], current_sid())
+        mark_state_modified()
+    return state['iptables_rules']
+
+def keep_session_sets(state):
+    """Record that the session changed its sets, so a republished ruleset does not replace them."""
+    attached = state.get('ruleset')
+    if attached is not None:
+        attached['own_sets'] = True
+
+def storable_state(state):
+    """The state as written by pickling stores: shared rules are stored by reference."""
+    attached = state.get('ruleset')
+    if attached is not None and not attached['private']:
+        return dict(state, iptables_rules=None)
+    return state
+
+def load_session_state(sid, touch=True):
+    """Load a session's state and bring a shared ruleset reference up to date.
+
+    A session still using a shared ruleset switches to its latest version.
+    Only if the ruleset has been removed from the store does the session
+    fall back to empty chains.
+    """
+    state = state_store.load(sid, touch)
+    attached = state.get('ruleset') if state is not None else None
+    if attached is None or attached['private']:
+        return state
+    published = get_published_ruleset(attached['name'])
+    if published is None:
+        state['iptables_rules'] = {chain: [] for chain in BUILTIN_CHAINS}
+        state['rule_counters'] = {chain: [] for chain in BUILTIN_CHAINS}
+        state['chain_keys'] = {chain: None for chain in BUILTIN_CHAINS}
+        state['ruleset'] = None
+        state['ruleset_generation'] += 1
+        state_store.save(sid, state, touch)
+    elif published.version != attached['version']:
+        attach_ruleset(state, published, sid, keep_sets=attached.get('own_sets', False))
+        state_store.save(sid, state, touch)
+    else:
+        state['iptables_rules'] = published.rules
+        subscribe_ruleset(published.name, sid)
+    return state
+
+def require_admin_token(token):
+    expected = app.config['ADMIN_TOKEN']
+    if not expected or not isinstance(token, str):
+        return False
+    return hmac.compare_digest(token.encode(), expected.encode())
+
+def handle_ruleset_command(terminal, parts):
+    """Handle shared ruleset commands: list, use, status and detach.
+
+    Publishing needs the admin token and is only offered through the
+    publish_ruleset event and the HTTP route, so the token is never typed
+    into a terminal.
+    """
+    state = get_state()
+    option = parts[1] if len(parts) > 1 else 'status'
+    attached = state['ruleset']
+
+    if option == 'list':
+        rulesets = list_published_rulesets()
+        if not rulesets:
+            return "No rulesets published\n"
+        output = f"{'NAME':<20} {'VERSION':<8} {'RULES':<8} {'SESSIONS':<9} PUBLISHED\n"
+        for published in rulesets:
+            info = published.summary()
+            output += (f"{html.escape(info['name']):<20} {info['version']:<8} {info['rules']:<8} "
+                       f"{info['subscribers']:<9} {info['published']}\n")
+        return output
+
+    elif option == 'status':
+        if attached is None:
+            return "Using the session's own rules\n"
+        kind = "modified private copy" if attached['private'] else "shared"
+        return f"Using ruleset {html.escape(attached['name'])} version {attached['version']} ({kind})\n"
+
+    elif option == 'use' and len(parts) > 2:
+        published = get_published_ruleset(parts[2])
+        if published is None:
+            raise CommandError(f"ruleset: {html.escape(parts[2])} is not published\n")
+        attach_ruleset(state, published, session['sid'])
+        mark_state_modified()
+        return f"Using ruleset {html.escape(published.name)} version {published.version}\n"
+
+    elif option == 'detach':
+        if attached is None or attached['private']:
+            raise CommandError("ruleset: the session already has its own rules\n")
+        ensure_private_rules(state)
+        return f"Copied ruleset {html.escape(attached['name'])} into this session\n"
+
+    raise CommandError("Usage: ruleset [list|status|use <name>|detach]\n")
+
+@socketio.on('publish_ruleset')
+def publish_ruleset_event(data):
+    """Publish the session's rules, or an iptables script, as a named shared ruleset (admin only)."""
+    init_session_if_needed()
+    if not require_admin_token(data.get('token')):
+        emit('ruleset_published', {'error': "Permission denied"})
+        return
+    name = str(data.get('name', ''))
+    error = chain_name_error(name, ())
+    if error:
+        emit('ruleset_published', {'error': html.escape(error)})
+        return
+    state = get_state()
+    if 'script' in data:
+        rules, policies, report = parse_rules_script(data['script'], state['ipsets'])
+        if report['errors']:
+            emit('ruleset_published', {'error': "Script rejected", 'errors': report['errors']})
+            return
+    else:
+        rules = {chain: list(chain_rules) for chain, chain_rules in state['iptables_rules'].items()}
+        policies = dict(state['chain_policies'])
+    published = publish_ruleset(name, rules, policies, copy.deepcopy(state['ipsets']))
+    emit('ruleset_published', published.summary())
+
+@socketio.on('use_ruleset')
+def use_ruleset(data):
+    """Point the session at a published ruleset by name."""
+    init_session_if_needed()
+    published = get_published_ruleset(str(data.get('name', '')))
+    if published is None:
+        emit('ruleset_updated', {'error': "Ruleset is not published"})
+        return
+    attach_ruleset(get_state(), published, session['sid'])
+    mark_state_modified()
+    emit('ruleset_updated', published.summary())
+
+@app.route('/rulesets', methods=['GET'])
+def list_rulesets():
+    """Published rulesets with their versions and number of sessions using them."""
+    return jsonify([published.summary() for published in list_published_rulesets()])
+
+@app.route('/rulesets/<name>', methods=['POST'])
+def publish_ruleset_endpoint(name):
+    """Publish an iptables script from the request body as a shared ruleset (needs ?token=)."""
+    if not require_admin_token(request.args.get('token')):
+        abort(404)
+    error = chain_name_error(name, ())
+    if error:
+        return jsonify({'error': error}), 400
+    rules, policies, report = parse_rules_script(request.get_data(as_text=True))
+    if report['errors']:
+        return jsonify({'error': "Script rejected", 'errors': report['errors']}), 400
+    return jsonify(publish_ruleset(name, rules, policies, {}).summary())
+
+def resolve_endpoint(name):
+    """Resolve a terminal or zone name (e.g. 'dmz', 'DMZ-WEBSERVER') to its IP; other values pass through."""
+    for terminal, config in get_state()['network_config'].items():
+        if name in (terminal, config['zone']):
+            return config['ip']
+    return name
+
+def parse_service(service):
+    """Parse a service spec such as 'tcp/80', 'udp/53' or 'icmp' into (protocol, port)."""
+    protocol, _, port = str(service).partition('/')
+    return protocol.lower(), port or None
+
+def batch_input_error(data):
+    """Error message for an evaluate_batch request of the wrong shape, or None."""
+    if not isinstance(data, dict):
+        return "Request must be an object"
+    matrix = data.get('matrix')
+    if matrix:
+        if not isinstance(matrix, dict):
+            return "matrix must be an object"
+        for key in ('sources', 'destinations', 'services'):
+            values = matrix.get(key, [])
+            if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+                return f"matrix {key} must be a list of names"
+        return None
+    flows = data.get('flows', [])
+    if not isinstance(flows, list) or not all(isinstance(flow, dict) for flow in flows):
+        return "flows must be a list of objects"
+    for flow in flows:
+        if not all(isinstance(flow.get(key), (str, type(None))) for key in ('source', 'destination')):
+            return "flow source and destination must be addresses"
+    return None
+
+@socketio.on('evaluate_batch')
+def evaluate_batch(data):
+    """Evaluate a list of flows, or a sources x destinations x services matrix, in one round trip.
+
+    Flows follow their routed path (INPUT, OUTPUT or FORWARD) unless a
+    ``chain`` is given, in which case every flow is evaluated against it.
+    """
+    init_session_if_needed()
+    error = batch_input_error(data)
+    if error:
+        emit('batch_results', {'error': error})
+        return
+    chain = data.get('chain', 'auto')
+    if chain != 'auto' and chain not in BUILTIN_CHAINS:
+        emit('batch_results', {'error': f"Invalid chain: {html.escape(str(chain))}"})
+        return
+
+    matrix = data.get('matrix')
+    if matrix:
+        # Size the matrix before expanding it
+        size = len(matrix.get('sources', [])) * len(matrix.get('destinations', [])) * len(matrix.get('services', []))
+        if size > MAX_BATCH_FLOWS:
+            emit('batch_results', {'error': f"Too many flows ({size}); the limit is {MAX_BATCH_FLOWS}"})
+            return
+        sources = [(name, resolve_endpoint(name)) for name in matrix.get('sources', [])]
+        destinations = [(name, resolve_endpoint(name)) for name in matrix.get('destinations', [])]
+        services = [parse_service(service) for service in matrix.get('services', [])]
+        flows = [
+            (src_ip, dst_ip) + service
+            for src, src_ip in sources
+            for dst, dst_ip in destinations
+            # Skip a zone talking to itself
+            if src != dst and (src_ip is None or src_ip != dst_ip)
+            for service in services
+        ]
     else:
-        return "Usage: ifconfig [set ip <ip_address>]\n"
+        flows = [
+            (flow.get('source'), flow.get('destination'), str(flow.get('protocol', 'tcp')).lower(), flow.get('port'))
+            for flow in data.get('flows', [])
+        ]
 
-def handle_iptables_command(terminal, parts):
-    """Handle iptables commands within the current session."""
-    if len(parts) < 2:
-        return "Usage: iptables [-A|-D|-L|-F] [chain] [options]\n"
-    
-    option = parts[1]
-    
-    # List rules
-    if option == '-L':
-        output = "\n"
-        verbose = '-v' in parts
-        
-        for chain in ['INPUT', 'OUTPUT', 'FORWARD']:
-            output += f"Chain {chain} (policy DROP)\n"
-            if verbose:
-                output += f"{'pkts':<8} {'bytes':<10} {'target':<12} {'prot':<6} {'source':<20} {'destination':<20} {'options'}\n"
-            else:
-                output += f"{'target':<12} {'prot':<6} {'source':<20} {'destination':<20}\n"
-            
-            for idx, rule in enumerate(session['iptables_rules'][chain]):
-                if verbose and idx < len(session['rule_counters'][chain]):
-                    pkts = session['rule_counters'][chain][idx]['packets']
-                    bytes_count = session['rule_counters'][chain][idx]['bytes']
-                    output += f"{pkts:<8} {bytes_count:<10} "
-                
-                # Sanitize rule components for display
-                target = html.escape(rule['target'])
-                protocol = html.escape(rule['protocol'])
-                source = html.escape(rule['source'])
-                destination = html.escape(rule['destination'])
-                
-                output += f"{target:<12} {protocol:<6} {source:<20} {destination:<20}"
-                
-                if rule['dport']:
-                    output += f" dpt:{html.escape(rule['dport'])}"
-                if rule['sport']:
-                    output += f" spt:{html.escape(rule['sport'])}"
-                
-                output += "\n"
-            output += "\n"
-        
-        return output
-    
-    # Flush rules
-    elif option == '-F':
-        chain = parts[2] if len(parts) > 2 else None
-        if chain:
-            if chain in session['iptables_rules']:
-                session['iptables_rules'][chain] = []
-                session['rule_counters'][chain] = []
-                session.modified = True
-                return f"Flushed {chain} chain\n"
-            else:
-                return f"Invalid chain: {chain}\n"
+    if len(flows) > MAX_BATCH_FLOWS:
+        emit('batch_results', {'error': f"Too many flows ({len(flows)}); the limit is {MAX_BATCH_FLOWS}"})
+        return
+
+    # Endpoints without a configured IP cannot send or receive traffic
+    evaluable = [flow for flow in flows if flow[0] and flow[1]]
+    if chain == 'auto':
+        verdicts = iter(evaluate_routed(evaluable))
+    else:
+        verdicts = iter(evaluate_packets(chain, evaluable))
+    topology = get_state()['topology']
+    results = []
+    for source_ip, dest_ip, protocol, port in flows:
+        path = chain
+        if source_ip and dest_ip:
+            allowed, message = next(verdicts)
+            if chain == 'auto':
+                path = topology.resolve(source_ip, dest_ip)[0]
         else:
-            for chain in session['iptables_rules']:
-                session['iptables_rules'][chain] = []
-                session['rule_counters'][chain] = []
-            session.modified = True
-            return "Flushed all chains\n"
-    
-    # Append rule
-    elif option == '-A':
-        if len(parts) < 3:
-            return "Usage: iptables -A <chain> [options]\n"
-        
-        chain = parts[2]
-        if chain not in session['iptables_rules']:
-            return f"Invalid chain: {chain}. Use INPUT, OUTPUT, or FORWARD\n"
-        
-        # Parse rule options
-        rule = {
-            'source': '0.0.0.0/0', 'destination': '0.0.0.0/0', 'protocol': 'all',
-            'sport': None, 'dport': None, 'target': 'DROP'
+            allowed, message = False, "No IP address configured"
+        results.append({
+            'chain': path,
+            'source': html.escape(str(source_ip)),
+            'destination': html.escape(str(dest_ip)),
+            'protocol': html.escape(protocol),
+            'port': html.escape(str(port)) if port is not None else None,
+            'allowed': allowed,
+            'verdict': html.escape(message)
+        })
+
+    emit('batch_results', {
+        'chain': chain,
+        'results': results,
+        'summary': {
+            'total': len(results),
+            'allowed': sum(1 for r in results if r['allowed']),
+            'blocked': sum(1 for r in results if not r['allowed'])
         }
-        
-        i = 3
-        while i < len(parts):
-            if parts[i] == '-s' and i + 1 < len(parts): rule['source'] = parts[i + 1]; i += 2
-            elif parts[i] == '-d' and i + 1 < len(parts): rule['destination'] = parts[i + 1]; i += 2
-            elif parts[i] == '-p' and i + 1 < len(parts): rule['protocol'] = parts[i + 1]; i += 2
-            elif parts[i] == '--sport' and i + 1 < len(parts): rule['sport'] = parts[i + 1]; i += 2
-            elif parts[i] == '--dport' and i + 1 < len(parts): rule['dport'] = parts[i + 1]; i += 2
-            elif parts[i] == '-j' and i + 1 < len(parts): rule['target'] = parts[i + 1]; i += 2
-            else: i += 1
-        
-        # Prevent duplicate rules
-        if rule in session['iptables_rules'][chain]:
-            return "iptables: Rule already exists.\n"
+    })
 
-        session['iptables_rules'][chain].append(rule)
-        session['rule_counters'][chain].append({'packets': 0, 'bytes': 0})
-        session.modified = True
-        
-        return f"Rule added to {chain} chain\n"
-    
-    # Delete rule
-    elif option == '-D':
-        if len(parts) < 4:
-            return "Usage: iptables -D <chain> <rule_number>\n"
-        
-        chain = parts[2]
-        try:
-            rule_num = int(parts[3]) - 1
-            if chain in session['iptables_rules'] and 0 <= rule_num < len(session['iptables_rules'][chain]):
-                del session['iptables_rules'][chain][rule_num]
-                del session['rule_counters'][chain][rule_num]
-                session.modified = True
-                return f"Deleted rule {rule_num + 1} from {chain} chain\n"
-            else:
-                return f"Invalid rule number\n"
-        except ValueError:
-            return "Rule number must be an integer\n"
-    
+TRAFFIC_TICK = 1.0
+DEFAULT_TRAFFIC_RATE = 100
+MAX_TRAFFIC_RATE = MAX_BATCH_FLOWS
+MAX_REPLAY_FLOWS = 100000
+SYNTHETIC_SERVICES = [
+    ('tcp', 80), ('tcp', 443), ('tcp', 22), ('tcp', 25), ('tcp', 3306),
+    ('udp', 53), ('udp', 123), ('icmp', None),
+]
+
+# Running generators by session id (per process)
+_traffic_jobs = {}
+
+@contextmanager
+def session_context(sid):
+    """An application context bound to a session, for background work on its behalf.
+
+    Holds the session's lock; the state is loaded from the store into
+    ``g.sim_state`` (None when the session expired) and written back when
+    the context closes if it was modified. Neither refreshes the session's
+    expiry, so background work alone does not keep a session alive.
+    """
+    with app.app_context(), session_locks.hold(sid):
+        g.sid = sid
+        g.sim_state = load_session_state(sid, touch=False)
+        yield g.sim_state
+        flush_pending_logs()
+        if g.sim_state is not None and g.get('sim_state_dirty'):
+            state_store.save(sid, g.sim_state, touch=False)
+
+def _parse_flow_time(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return datetime.fromisoformat(str(value)).timestamp()
+
+def parse_flow_file(content, fmt):
+    """Parse recorded flows from CSV (with a header row) or JSON Lines.
+
+    Columns/keys: src, dst, proto, port and an optional timestamp (epoch
+    seconds or ISO 8601). Returns ``(offset, flow)`` pairs in time order,
+    offsets in seconds from the first flow, or None for every offset if
+    any flow lacks a timestamp. Raises ValueError on malformed input.
+    """
+    if not isinstance(content, str):
+        raise ValueError("flows must be the text of a CSV or JSON Lines file")
+    if fmt == 'csv':
+        rows = csv.DictReader(io.StringIO(content))
     else:
-        return f"Unknown option: {option}\n"
+        rows = (json.loads(line) for line in content.splitlines() if line.strip())
 
-def handle_nmap_command(terminal, parts):
-    """Handle nmap port scanning within the current session."""
-    if len(parts) < 2:
-        return "Usage: nmap [-p <ports>] <target>\n"
-    
-    ports_to_scan = [80, 443, 22, 21, 23, 25, 53, 3306]
-    target = None
-    
-    i = 1
-    while i < len(parts):
-        if parts[i] == '-p' and i + 1 < len(parts):
-            port_spec = parts[i + 1]; i += 2
-            if ',' in port_spec: ports_to_scan = [int(p) for p in port_spec.split(',')]
-            elif '-' in port_spec: start, end = map(int, port_spec.split('-')); ports_to_scan = list(range(start, end + 1))
-            else: ports_to_scan = [int(port_spec)]
-        else: target = parts[i]; i += 1
-    
-    if not target:
-        return "Error: No target specified\n"
-    
-    source_ip = session['network_config'][terminal]['ip']
-    if not source_ip:
-        return "Error: No IP address configured. Use 'ifconfig set ip <ip>'\n"
-    
-    safe_target = html.escape(target)
-    output = f"\nStarting Nmap scan on {safe_target}\n"
-    output += f"Nmap scan report for {safe_target}\n"
-    output += f"Host is up (0.0010s latency).\n\n"
-    output += f"{'PORT':<10} {'STATE':<12} {'SERVICE'}\n"
-    
-    for port in ports_to_scan:
-        allowed, message = check_iptables_rule('FORWARD', source_ip, target, 'tcp', port)
-        
-        if allowed:
-            state = random.choice(['open', 'open', 'open', 'closed'])
-            service = { 80: 'http', 443: 'https', 22: 'ssh', 21: 'ftp', 23: 'telnet', 25: 'smtp', 53: 'dns', 3306: 'mysql' }.get(port, 'unknown')
-            output += f"{port}/tcp{'':<3} {state:<12} {service}\n"
-        else:
-            output += f"{port}/tcp{'':<3} {'filtered':<12} (blocked by firewall)\n"
-        
-        time.sleep(0.05)
-    
-    output += f"\nNmap done: 1 IP address scanned\n"
-    return output
+    recorded = []
+    for number, row in enumerate(rows, 1):
+        if number > MAX_REPLAY_FLOWS:
+            raise ValueError(f"too many flows; the limit is {MAX_REPLAY_FLOWS}")
+        if not isinstance(row, dict):
+            raise ValueError(f"flow {number}: not an object")
+        source = row.get('src') or row.get('source')
+        destination = row.get('dst') or row.get('destination')
+        if not source or not destination:
+            raise ValueError(f"flow {number}: src and dst are required")
+        source, destination = str(source), str(destination)
+        protocol = str(row.get('proto') or row.get('protocol') or 'tcp').lower()
+        port = normalize_port(row.get('port'))
+        timestamp = row.get('timestamp')
+        recorded.append((_parse_flow_time(timestamp) if timestamp not in (None, '') else None,
+                         (source, destination, protocol, port)))
 
-def handle_ping_command(terminal, target):
-    """Handle ping command with firewall checking within the current session."""
-    source_ip = session['network_config'][terminal]['ip']
-    if not source_ip:
-        return "Error: No IP address configured. Use 'ifconfig set ip <ip>'\n"
-    
-    safe_target = html.escape(target)
-    allowed, message = check_iptables_rule('FORWARD', source_ip, target, 'icmp', None)
-    
-    if not allowed:
-        return f"ping: {safe_target}: {html.escape(message)}\n"
-    
-    output = f"PING {safe_target} 56(84) bytes of data.\n"
-    for i in range(4):
-        ttl = random.randint(50, 64)
-        latency = random.uniform(0.5, 50.0)
-        output += f"64 bytes from {safe_target}: icmp_seq={i+1} ttl={ttl} time={latency:.1f} ms\n"
-        time.sleep(0.1)
-    
-    output += f"\n--- {safe_target} ping statistics ---\n"
-    output += f"4 packets transmitted, 4 received, 0% packet loss\n"
-    return output
+    if not recorded:
+        raise ValueError("no flows found")
+    if any(timestamp is None for timestamp, _ in recorded):
+        return [(None, flow) for _, flow in recorded]
+    recorded.sort(key=lambda item: item[0])
+    start = recorded[0][0]
+    return [(timestamp - start, flow) for timestamp, flow in recorded]
 
-def init_session_if_needed():
-    """Initializes the simulation state if not already in the session."""
-    if 'initialized' not in session:
-        session.permanent = True
-        session.update(get_default_state())
-        session['initialized'] = True
-        lifetime = app.config['PERMANENT_SESSION_LIFETIME'].total_seconds()
-        socketio.emit('session_initialized', {'lifetime': lifetime})
+class TrafficJob:
+    """A background traffic source for one session.
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+    Produces synthetic flows between the configured terminals at ``rate``
+    flows per second, or replays recorded flows: at ``rate`` if one is
+    given, otherwise with their recorded timing. Verdicts are aggregated
+    and pushed to the session once per tick.
+    """
 
-@socketio.on('get_rules')
-def get_rules():
-    """API endpoint to get session-specific rules for download"""
-    init_session_if_needed()
-    rules_text = "# Firewall Rules Configuration\n"
-    rules_text += f"# Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-    
-    for chain in ['INPUT', 'OUTPUT', 'FORWARD']:
-        rules_text += f"# {chain} Chain\n"
-        for rule in session['iptables_rules'][chain]:
-            cmd = f"iptables -A {chain}"
-            if rule['source'] != '0.0.0.0/0': cmd += f" -s {rule['source']}"
-            if rule['destination'] != '0.0.0.0/0': cmd += f" -d {rule['destination']}"
-            if rule['protocol'] != 'all': cmd += f" -p {rule['protocol']}"
-            if rule['sport']: cmd += f" --sport {rule['sport']}"
-            if rule['dport']: cmd += f" --dport {rule['dport']}"
-            cmd += f" -j {rule['target']}"
-            rules_text += cmd + "\n"
-        rules_text += "\n"
-    
-    emit('rules_data', {'rules': rules_text})
+    def __init__(self, sid, rate=None, recorded=None, seed=None):
+        self.sid = sid
+        self.recorded = recorded
+        self.rate = rate if rate or recorded is not None else DEFAULT_TRAFFIC_RATE
+        self.rng = random.Random(seed)
+        self.running = True
+        self.started = time.monotonic()
+        self.position = 0
+        self.flows = 0
+        self.allowed = 0
+        self.verdicts = Counter()
+        self.last_tick = {'flows': 0, 'allowed': 0, 'blocked': 0}
+        self._credit = 0.0
 
-@socketio.on('get_logs')
-def get_logs():
-    """API endpoint to get session-specific firewall logs"""
-    init_session_if_needed()
-    warnings = detect_rule_conflicts()
-    
-    emit('logs_data', {
-        'logs': session['firewall_logs'],
-        'warnings': warnings,
-        'stats': {
-            'total': len(session['firewall_logs']),
-            'blocked': len([l for l in session['firewall_logs'] if l['action'] in ['DROP', 'REJECT']]),
-            'allowed': len([l for l in session['firewall_logs'] if l['action'] == 'ACCEPT']),
-            'warnings': len([l for l in session['firewall_logs'] if l['category'] == 'warning']) + len(warnings)
+    @property
+    def mode(self):
+        return 'synthetic' if self.recorded is None else 'replay'
+
+    def _quota(self, interval):
+        # Carry fractions over so low rates still send flows
+        self._credit += self.rate * interval
+        count = min(int(self._credit), MAX_BATCH_FLOWS)
+        self._credit -= int(self._credit)
+        return count
+
+    def _synthetic_flow(self, endpoints):
+        source, destination = self.rng.sample(endpoints, 2)
+        protocol, port = self.rng.choice(SYNTHETIC_SERVICES)
+        if protocol == 'tcp' and self.rng.random() < 0.1:
+            port = self.rng.randint(1024, 65535)
+        return (source, destination, protocol, port)
+
+    def next_batch(self, network_config, elapsed, interval):
+        """Flows due in this tick, or None once a replay is exhausted."""
+        if self.recorded is None:
+            endpoints = [config['ip'] for terminal, config in network_config.items()
+                         if terminal != 'firewall' and config['ip']]
+            if len(endpoints) < 2:
+                return []
+            return [self._synthetic_flow(endpoints) for _ in range(self._quota(interval))]
+
+        if self.position >= len(self.recorded):
+            return None
+        if self.rate or self.recorded[0][0] is None:
+            end = self.position + self._quota(interval)
+        else:
+            end = bisect.bisect_right(self.recorded, elapsed, lo=self.position, key=lambda item: item[0])
+            end = min(end, self.position + MAX_BATCH_FLOWS)
+        batch = [flow for _, flow in self.recorded[self.position:end]]
+        self.position = end
+        return batch
+
+    def record(self, verdicts):
+        allowed = sum(1 for ok, _ in verdicts if ok)
+        self.flows += len(verdicts)
+        self.allowed += allowed
+        self.verdicts.update(message for _, message in verdicts)
+        self.last_tick = {'flows': len(verdicts), 'allowed': allowed, 'blocked': len(verdicts) - allowed}
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        stats = {
+            'running': self.running,
+            'mode': self.mode,
+            'rate': self.rate,
+            'elapsed': round(elapsed, 1),
+            'flows': self.flows,
+            'allowed': self.allowed,
+            'blocked': self.flows - self.allowed,
+            'flows_per_sec': round(self.flows / elapsed, 1) if elapsed else 0.0,
+            'last_tick': self.last_tick,
+            'top_verdicts': [[html.escape(message), count] for message, count in self.verdicts.most_common(5)],
         }
-    })
+        if self.recorded is not None:
+            stats['replayed'] = self.position
+            stats['total'] = len(self.recorded)
+        return stats
 
-@socketio.on('clear_logs')
-def clear_logs_endpoint():
-    """API endpoint to clear session-specific logs and counters"""
-    init_session_if_needed()
-    session['firewall_logs'] = []
-    
-    # Reset rule counters
-    for chain in session['rule_counters']:
-        for counter in session['rule_counters'][chain]:
-            counter['packets'] = 0
-            counter['bytes'] = 0
-            
-    log_firewall_event('INFO', 'N/A', 'N/A', 'N/A', None, "Logs and statistics cleared", 'info')
-    session.modified = True
-    
-    # After clearing, immediately send back the new empty log state
-    get_logs()
+def run_traffic_job(job):
+    """Background loop: evaluate one batch per tick and push aggregated stats."""
+    last = job.started
+    while job.running:
+        socketio.sleep(TRAFFIC_TICK)
+        if not job.running:
+            break
+        now = time.monotonic()
+        interval, last = now - last, now
+        with session_context(job.sid) as state:
+            if state is None:
+                # The session expired
+                job.running = False
+                break
+            batch = job.next_batch(state['network_config'], now - job.started, interval)
+            if batch is None:
+                job.running = False
+            elif batch:
+                job.record(evaluate_routed(batch))
+            emit_to_session('traffic_stats', job.stats())
+    if _traffic_jobs.get(job.sid) is job:
+        del _traffic_jobs[job.sid]
 
-@socketio.on('load_rules_from_script')
-def load_rules_from_script(data):
-    """Load and execute a script of iptables commands."""
-    init_session_if_needed()
-    script_content = data.get('script', '')
+def start_traffic(job):
+    """Start a job for its session unless one is already running; returns an error or None."""
+    current = _traffic_jobs.get(job.sid)
+    if current is not None and current.running:
+        return "Traffic generator already running (use 'traffic stop' first)"
+    _traffic_jobs[job.sid] = job
+    socketio.start_background_task(run_traffic_job, job)
+    return None
 
-    # First, flush all rules
-    for chain in session['iptables_rules']:
-        session['iptables_rules'][chain] = []
-        session['rule_counters'][chain] = []
-    session.modified = True
+def stop_traffic(sid):
+    """Stop the session's job; returns it, or None if none was running."""
+    job = _traffic_jobs.pop(sid, None)
+    if job is not None:
+        job.running = False
+    return job
 
-    # Process each line in the script
-    for line in script_content.splitlines():
-        line = line.strip()
-        if line and line.lower().startswith('iptables'):
-            parts = line.split()
-            handle_iptables_command('firewall', parts)
-    
-    # Log the event
-    log_firewall_event('INFO', 'N/A', 'N/A', 'N/A', None, "Firewall rules loaded from file.", 'info')
+def parse_traffic_rate(value):
+    try:
+        rate = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("rate must be a number of flows/s")
+    if not 0 < rate <= MAX_TRAFFIC_RATE:
+        raise ValueError(f"rate must be between 0 and {MAX_TRAFFIC_RATE} flows/s")
+    return rate
 
-@socketio.on('get_raw_logs')
-def get_raw_logs():
-    """Generate and send raw text for log file download."""
+def handle_traffic_command(terminal, parts):
+    """Handle traffic generator commands (start, stop, rate, status) for the current session."""
+    sid = ensure_session_id()
+    option = parts[1] if len(parts) > 1 else 'status'
+    job = _traffic_jobs.get(sid)
+
+    if option == 'start':
+        try:
+            rate = parse_traffic_rate(parts[2]) if len(parts) > 2 else DEFAULT_TRAFFIC_RATE
+        except ValueError as e:
+            raise CommandError(f"traffic: {html.escape(str(e))}\n")
+        error = start_traffic(TrafficJob(sid, rate))
+        if error:
+            raise CommandError(f"traffic: {error}\n")
+        return f"Synthetic traffic started at {rate:g} flows/s\n"
+
+    elif option == 'stop':
+        job = stop_traffic(sid)
+        if job is None:
+            raise CommandError("traffic: generator is not running\n")
+        stats = job.stats()
+        return f"Traffic stopped: {stats['flows']} flows, {stats['allowed']} allowed, {stats['blocked']} blocked\n"
+
+    elif option == 'rate':
+        if job is None:
+            raise CommandError("traffic: generator is not running\n")
+        try:
+            job.rate = parse_traffic_rate(parts[2]) if len(parts) > 2 else None
+        except ValueError as e:
+            raise CommandError(f"traffic: {html.escape(str(e))}\n")
+        if job.rate is None:
+            raise CommandError("Usage: traffic rate <flows/s>\n")
+        return f"Traffic rate set to {job.rate:g} flows/s\n"
+
+    elif option == 'status':
+        if job is None:
+            return "Traffic generator is not running\n"
+        stats = job.stats()
+        output = (f"Traffic generator ({stats['mode']}): {stats['flows']} flows in {stats['elapsed']}s "
+                  f"({stats['flows_per_sec']}/s), {stats['allowed']} allowed, {stats['blocked']} blocked\n")
+        for message, count in stats['top_verdicts']:
+            output += f"  {count:>8}  {message}\n"
+        return output
+
+    raise CommandError("Usage: traffic [start [rate]|stop|rate <flows/s>|status]\n")
+
+@socketio.on('traffic_start')
+def traffic_start(data):
+    """Start synthetic traffic or replay a recorded flow file (CSV or JSON Lines)."""
     init_session_if_needed()
-    warnings = detect_rule_conflicts()
-    
-    stats = {
-        'total': len(session['firewall_logs']),
-        'blocked': len([l for l in session['firewall_logs'] if l['action'] in ['DROP', 'REJECT']]),
-        'allowed': len([l for l in session['firewall_logs'] if l['action'] == 'ACCEPT']),
-        'warnings': len([l for l in session['firewall_logs'] if l['category'] == 'warning']) + len(warnings)
-    }
+    sid = ensure_session_id()
+    try:
+        rate = parse_traffic_rate(data['rate']) if data.get('rate') else None
+        recorded = None
+        if data.get('mode') == 'replay':
+            recorded = parse_flow_file(data.get('flows', ''), data.get('format', 'csv'))
+    except (TypeError, ValueError, KeyError) as e:
+        emit('traffic_stats', {'running': False, 'error': html.escape(str(e))})
+        return
+    job = TrafficJob(sid, rate, recorded, data.get('seed'))
+    error = start_traffic(job)
+    emit('traffic_stats', {'running': False, 'error': error} if error else job.stats())
 
-    content = '# Firewall Logs Export\n'
-    content += f"# Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-    content += f"# Total Logs: {stats['total']}\n"
-    content += f"# Blocked: {stats['blocked']}\n"
-    content += f"# Allowed: {stats['allowed']}\n"
-    content += f"# Warnings: {stats['warnings']}\n\n"
-    content += '## Log Entries\n\n'
-    
-    for log in session.get('firewall_logs', []):
-        content += f"[{log['timestamp']}] {log['action']} - "
-        details = log.get('details', '')
-        if log.get('rule'):
-            details += f" | Rule: {log['rule']}"
-        if log.get('warning'):
-            details += f" | Warning: {log['warning']}"
-        content += details + '\n'
-
-    emit('raw_logs_data', {'logs': content})
+@socketio.on('traffic_stop')
+def traffic_stop():
+    job = stop_traffic(ensure_session_id())
+    emit('traffic_stats', job.stats() if job else {'running': False})
+
+@socketio.on('traffic_rate')
+def traffic_rate(data):
+    job = _traffic_jobs.get(ensure_session_id())
+    if job is None:
+        emit('traffic_stats', {'running': False, 'error': "Traffic generator is not running"})
+        return
+    try:
+        job.rate = parse_traffic_rate(data.get('rate'))
+    except (TypeError, ValueError) as e:
+        emit('traffic_stats', dict(job.stats(), error=html.escape(str(e))))
+        return
+    emit('traffic_stats', job.stats())
 
 @socketio.on('connect')
 def handle_connect():
     """Handle new client connection and initialize their session."""
+    join_room(session_room(ensure_session_id()))
+    CONNECTED_CLIENTS.inc()
     init_session_if_needed()
     print('Client connected')
     emit('connected', {'data': 'Connected to firewall simulator'})
 
 @socketio.on('disconnect')
 def handle_disconnect():
+    CONNECTED_CLIENTS.inc(-1)
+    sid = session.get('sid')
+    if sid is not None:
+        # Stop the session's traffic generator once its last connection is gone
+        others = [other for other, _ in socketio.server.manager.get_participants('/', session_room(sid))
+                  if other != request.sid]
+        if not others:
+            stop_traffic(sid)
     print('Client disconnected')
 
-@socketio.on('command')
-def handle_command(data):
-    """Handle terminal commands from clients for the current session."""
-    init_session_if_needed()
-    terminal = data.get('terminal', 'insider')
-    command = data.get('command', '').strip()
-    
-    if not command:
-        return
-    
-    parts = command.split()
-    cmd = parts[0].lower()
-    
-    output = ""
-    
-    try:
-        if cmd == 'help':
-            output = """
+HELP_TEXT = """
 Available commands:
 
 Network Configuration:
   ifconfig                    - Show network configuration
   ifconfig set ip <ip>        - Set IP address for this terminal
+  route                       - Show the routing table between the zones
 
 Firewall Management:
-  iptables -L [-v]            - List all firewall rules (-v for verbose)
+  iptables -L [chain] [-v]    - List firewall rules (-v for verbose)
   iptables -A <chain> [opts]  - Append rule to chain
     Options: -s <source> -d <dest> -p <protocol> --dport <port> -j <target>
-    Chains: INPUT, OUTPUT, FORWARD
-    Targets: ACCEPT, DROP, REJECT, LOG
+             --dport 1024:65535, -m multiport --dports 22,80,443
+             -m set --match-set <set> src|dst
+             -m state --state ESTABLISHED,RELATED
+    Chains: INPUT, OUTPUT, FORWARD and chains created with -N
+    Targets: ACCEPT, DROP, REJECT, LOG, RETURN or a user-defined chain
+  iptables -I <chain> [num] [opts] - Insert rule at position (default 1)
+  iptables -R <chain> <num> [opts] - Replace rule number in chain
   iptables -D <chain> <num>   - Delete rule number from chain
   iptables -F [chain]         - Flush all rules (or specific chain)
+  iptables -P <chain> <pol>   - Set chain policy (ACCEPT or DROP)
+  iptables -N <chain>         - Create a user-defined chain
+  iptables -X [chain]         - Delete an empty, unreferenced user-defined chain
+  ruleset list|status         - Show published rulesets / the one in use
+  ruleset use <name>|detach   - Use a shared ruleset / make it a private copy
+  snapshot save|load <name>   - Checkpoint / restore configuration, rules, counters and logs
+  snapshot list|delete <name> - Show / remove saved snapshots
+  ipset create <set> <type>   - Create a set (hash:ip, hash:net, bitmap:port)
+  ipset add|del <set> <entry> - Add or remove an address, network or port(-range)
+  ipset list [set]            - Show sets and their members
+  ipset flush|destroy <set>   - Empty or remove a set
+  conntrack -L|-C|-F          - List, count or flush tracked connections
+  traffic start [rate]        - Generate synthetic traffic between the zones
+  traffic rate <n>|stop|status - Change the rate, stop, or show statistics
+  logging window|sample|limit - Aggregate, sample or rate limit log entries
 
 Network Testing:
   ping <target>               - Test ICMP connectivity
@@ -609,107 +4664,221 @@ Examples:
   nmap -p 80,443 192.168.30.10
   iptables -L -v
 """
-        
-        elif cmd == 'ifconfig':
-            output = handle_ifconfig_command(terminal, parts)
-        
-        elif cmd == 'iptables':
-            output = handle_iptables_command(terminal, parts)
-        
-        elif cmd == 'nmap':
-            output = handle_nmap_command(terminal, parts)
-        
-        elif cmd == 'ping':
-            if len(parts) < 2:
-                output = "Usage: ping <target>\n"
-            else:
-                output = handle_ping_command(terminal, parts[1])
-        
-        elif cmd == 'whoami':
-            config = session['network_config'][terminal]
-            output = f"Terminal: {terminal}\n"
-            output += f"Zone: {config['zone']}\n"
-            output += f"Network: {config['network']}\n"
-            output += f"IP: {config['ip'] or 'Not configured'}\n"
-        
-        elif cmd == 'clear':
-            emit('clear', {'terminal': terminal})
-            return
-        
-        elif cmd == 'traceroute':
-            if len(parts) < 2:
-                output = "Usage: traceroute <target>\n"
-            else:
-                target = parts[1]
-                safe_target = html.escape(target)
-                output = f"traceroute to {safe_target}, 30 hops max, 60 byte packets\n"
-                for i in range(1, random.randint(5, 12) + 1):
-                    ip = f"{random.randint(1,255)}.{random.randint(1,255)}.{random.randint(1,255)}.{random.randint(1,255)}"
-                    latency = random.uniform(1.0, 50.0) * i
-                    output += f" {i}  {ip}  {latency:.3f} ms\n"
-                    time.sleep(0.05)
-        
-        elif cmd == 'nslookup':
-            if len(parts) < 2:
-                output = "Usage: nslookup <domain>\n"
-            else:
-                domain = parts[1]
-                safe_domain = html.escape(domain)
-                ip = f"{random.randint(1,255)}.{random.randint(1,255)}.{random.randint(1,255)}.{random.randint(1,255)}"
-                output = f"Server:  8.8.8.8\nAddress: 8.8.8.8#53\n\n"
-                output += f"Name: {safe_domain}\nAddress: {ip}\n"
-        
-        elif cmd == 'nc':
-            if len(parts) < 3:
-                output = "Usage: nc <target> <port>\n"
-            else:
-                source_ip = session['network_config'][terminal]['ip']
-                if not source_ip:
-                    output = "Error: No IP address configured\n"
-                else:
-                    target, port = parts[1], parts[2]
-                    safe_target = html.escape(target)
-                    safe_port = html.escape(port)
-                    allowed, message = check_iptables_rule('FORWARD', source_ip, target, 'tcp', port)
-                    if allowed:
-                        output = f"Connection to {safe_target} {safe_port} port [tcp/*] succeeded!\n"
-                    else:
-                        output = f"nc: connect to {safe_target} port {safe_port} (tcp) failed: {html.escape(message)}\n"
-        
-        elif cmd == 'curl':
-            if len(parts) < 2:
-                output = "Usage: curl <url>\n"
-            else:
-                source_ip = session['network_config'][terminal]['ip']
-                if not source_ip:
-                    output = "Error: No IP address configured\n"
-                else:
-                    url = parts[1]
-                    safe_url = html.escape(url)
-                    # Extract target IP from URL (simplified)
-                    if '192.168.' in url:
-                        target = url.split('/')[2] if '/' in url else url
-                    else:
-                        target = '8.8.8.8'
-                    
-                    port = '443' if 'https' in url else '80'
-                    allowed, message = check_iptables_rule('FORWARD', source_ip, target, 'tcp', port)
-                    if allowed:
-                        output = f"HTTP/1.1 200 OK\nContent-Type: text/html\n\n<html><body>Response from {safe_url}</body></html>\n"
-                    else:
-                        output = f"curl: (7) Failed to connect: {html.escape(message)}\n"
-        
-        else:
-            output = f"bash: {cmd}: command not found\nType 'help' for available commands\n"
+
+def handle_help_command(terminal, parts):
+    return HELP_TEXT
+
+def handle_whoami_command(terminal, parts):
+    config = get_state()['network_config'][terminal]
+    output = f"Terminal: {terminal}\n"
+    output += f"Zone: {config['zone']}\n"
+    output += f"Network: {config['network']}\n"
+    output += f"IP: {config['ip'] or 'Not configured'}\n"
+    return output
+
+def handle_clear_command(terminal, parts):
+    emit('clear', {'terminal': terminal})
+    return None
+
+def handle_nslookup_command(terminal, parts):
+    if len(parts) < 2:
+        raise CommandError("Usage: nslookup <domain>\n")
+    domain = parts[1]
+    safe_domain = html.escape(domain)
+    ip = f"{random.randint(1,255)}.{random.randint(1,255)}.{random.randint(1,255)}.{random.randint(1,255)}"
+    output = f"Server:  8.8.8.8\nAddress: 8.8.8.8#53\n\n"
+    output += f"Name: {safe_domain}\nAddress: {ip}\n"
+    return output
+
+def handle_nc_command(terminal, parts):
+    if len(parts) < 3:
+        raise CommandError("Usage: nc <target> <port>\n")
+    source_ip = get_state()['network_config'][terminal]['ip']
+    if not source_ip:
+        raise CommandError("Error: No IP address configured\n")
+    target, port = parts[1], parts[2]
+    safe_target = html.escape(target)
+    safe_port = html.escape(port)
+    allowed, message = check_routed(source_ip, target, 'tcp', port)
+    if allowed:
+        return f"Connection to {safe_target} {safe_port} port [tcp/*] succeeded!\n"
+    raise CommandError(f"nc: connect to {safe_target} port {safe_port} (tcp) failed: {html.escape(message)}\n")
+
+def handle_curl_command(terminal, parts):
+    if len(parts) < 2:
+        raise CommandError("Usage: curl <url>\n")
+    source_ip = get_state()['network_config'][terminal]['ip']
+    if not source_ip:
+        raise CommandError("Error: No IP address configured\n")
+    url = parts[1]
+    safe_url = html.escape(url)
+    # Extract target IP from URL (simplified)
+    if '192.168.' in url:
+        target = url.split('/')[2] if '/' in url else url
+    else:
+        target = '8.8.8.8'
     
+    port = '443' if 'https' in url else '80'
+    allowed, message = check_routed(source_ip, target, 'tcp', port)
+    if allowed:
+        return f"HTTP/1.1 200 OK\nContent-Type: text/html\n\n<html><body>Response from {safe_url}</body></html>\n"
+    raise CommandError(f"curl: (7) Failed to connect: {html.escape(message)}\n")
+
+def handle_ping(terminal, parts):
+    if len(parts) < 2:
+        raise CommandError("Usage: ping <target>\n")
+    return handle_ping_command(terminal, parts[1])
+
+def handle_traceroute(terminal, parts):
+    if len(parts) < 2:
+        raise CommandError("Usage: traceroute <target>\n")
+    return handle_traceroute_command(terminal, parts[1])
+
+class CommandError(Exception):
+    """A terminal command failed; the message is the command's output."""
+
+# Terminal commands by name. Each handler takes (terminal, parts) and returns
+# the output text, a generator of output chunks (streamed), or None. Handlers
+# raise CommandError to fail, streaming ones before yielding any output.
+COMMANDS = {
+    'help': handle_help_command,
+    'ifconfig': handle_ifconfig_command,
+    'iptables': handle_iptables_command,
+    'ipset': handle_ipset_command,
+    'conntrack': handle_conntrack_command,
+    'traffic': handle_traffic_command,
+    'logging': handle_logging_command,
+    'route': handle_route_command,
+    'ruleset': handle_ruleset_command,
+    'snapshot': handle_snapshot_command,
+    'nmap': handle_nmap_command,
+    'ping': handle_ping,
+    'whoami': handle_whoami_command,
+    'clear': handle_clear_command,
+    'traceroute': handle_traceroute,
+    'nslookup': handle_nslookup_command,
+    'nc': handle_nc_command,
+    'curl': handle_curl_command,
+}
+
+MAX_BATCH_COMMANDS = 1000
+
+def run_command(terminal, command, stream=True):
+    """Run one terminal command in the current session.
+
+    Returns ``(output, succeeded)``; output is None for commands without
+    any. Streaming output is sent to the client chunk by chunk with
+    ``stream``, and collected into the returned text otherwise.
+    """
+    parts = command.split()
+    cmd = parts[0].lower()
+    handler = COMMANDS.get(cmd)
+    started = time.perf_counter()
+    succeeded = False
+    try:
+        if handler is None:
+            raise CommandError(f"bash: {cmd}: command not found\nType 'help' for available commands\n")
+        output = handler(terminal, parts)
+        # Streaming commands return a generator of output chunks
+        if output is not None and not isinstance(output, str):
+            output = stream_output(terminal, output) if stream else ''.join(output)
+        succeeded = True
+    except CommandError as e:
+        output = str(e)
     except Exception as e:
         output = f"Error: {str(e)}\n"
     
+    # Unknown commands share one label to keep metric cardinality bounded
+    COMMAND_DURATION.observe(time.perf_counter() - started,
+                             command=cmd if handler is not None else 'unknown')
+    return output, succeeded
+
+@socketio.on('command')
+def handle_command(data):
+    """Handle terminal commands from clients for the current session."""
+    init_session_if_needed()
+    terminal = data.get('terminal', 'insider')
+    command = data.get('command', '').strip()
+    
+    if not command:
+        return
+    
+    output, _ = run_command(terminal, command)
+    if output is None:
+        return
     emit('output', {
         'terminal': terminal,
         'output': output
     })
 
+def parse_command_script(script):
+    """Split a shell-like script into ``(command, operator)`` pairs.
+
+    Commands are separated by ``;``, ``&&`` or newlines; ``operator`` is
+    ``'&&'`` when the command only runs if the previous one succeeded (a
+    line may end with ``&&``). Blank commands and ``#`` comment lines are
+    skipped.
+    """
+    script = '\n'.join(line for line in script.splitlines() if not line.lstrip().startswith('#'))
+    steps = []
+    operator = ';'
+    for token in re.split(r'(&&|;|\n)', script):
+        token = token.strip()
+        if token == '&&':
+            operator = '&&'
+        elif token == ';':
+            operator = ';'
+        elif token:
+            steps.append((token, operator))
+            operator = ';'
+    return steps
+
+@socketio.on('command_batch')
+def command_batch(data):
+    """Run many commands of one terminal in a single event.
+
+    Takes ``commands`` (a list) or ``script`` (commands separated by ``;``,
+    ``&&`` or newlines). The session state is loaded once and written back
+    once at the end, and logs are sent as one ``new_logs`` message. Each
+    command's output is sent in order as a ``batch_output`` event with its
+    status (ok, failed or skipped after a failed ``&&``) and run time,
+    followed by ``batch_done``.
+    """
+    init_session_if_needed()
+    terminal = data.get('terminal', 'insider')
+    if data.get('commands') is not None:
+        if not isinstance(data['commands'], list):
+            emit('batch_done', {'error': "commands must be a list"})
+            return
+        steps = [(str(command).strip(), ';') for command in data['commands']]
+        steps = [step for step in steps if step[0]]
+    else:
+        steps = parse_command_script(str(data.get('script', '')))
+    if len(steps) > MAX_BATCH_COMMANDS:
+        emit('batch_done', {'error': f"At most {MAX_BATCH_COMMANDS} commands per batch"})
+        return
+
+    g.batch_logs = True
+    started = time.perf_counter()
+    succeeded = True
+    totals = Counter()
+    for index, (command, operator) in enumerate(steps):
+        if operator == '&&' and not succeeded:
+            totals['skipped'] += 1
+            emit('batch_output', {'terminal': terminal, 'index': index, 'command': html.escape(command),
+                                  'status': 'skipped', 'output': '', 'ms': 0.0})
+            continue
+        command_started = time.perf_counter()
+        output, succeeded = run_command(terminal, command, stream=False)
+        status = 'ok' if succeeded else 'failed'
+        totals[status] += 1
+        emit('batch_output', {'terminal': terminal, 'index': index, 'command': html.escape(command),
+                              'status': status, 'output': output or '',
+                              'ms': round((time.perf_counter() - command_started) * 1000, 3)})
+    emit('batch_done', {'terminal': terminal, 'commands': len(steps), 'ok': totals['ok'],
+                        'failed': totals['failed'], 'skipped': totals['skipped'],
+                        'ms': round((time.perf_counter() - started) * 1000, 3)})
+
 if __name__ == '__main__':
     debug_mode = os.environ.get('FLASK_ENV') == 'development'
     port = int(os.environ.get('PORT', 5000))
@@ -719,6 +4888,7 @@ if __name__ == '__main__':
     print(f"  Mode: {'Development' if debug_mode else 'Production'}")
     print("="*60)
     print(f"Server starting at: http://localhost:{port}")
+    print("  (development server; use 'gunicorn -c gunicorn.conf.py app:app' in production)")
     print("\nExample commands:")
     print("  ifconfig set ip 192.168.10.10")
     print("  iptables -A OUTPUT -p tcp --dport 80 -j ACCEPT")
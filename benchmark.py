@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""Benchmark the Socket.IO command handlers of the firewall simulator.
+
+Drives ``command``, ``load_rules_from_script``, ``get_logs`` and
+``get_raw_logs`` through the Flask-SocketIO test client and reports p50/p99
+latency, events per second and memory per session. Runs fully offline and
+is reproducible: the RNG is seeded and simulated network delays are off.
+
+Usage:
+    python benchmark.py --rules 200 --log-depth 1000 --clients 10
+    python benchmark.py --json > baseline.json
+    python benchmark.py --baseline baseline.json   # exit 1 on regressions
+"""
+
+import os
+
+# Must be set before the app is imported
+os.environ.setdefault('SIM_TIME_SCALE', '0')
+os.environ['STATE_BACKEND'] = 'memory'
+os.environ.pop('SOCKETIO_MESSAGE_QUEUE', None)  # the test client cannot use a queue
+
+import argparse
+import contextlib
+import json
+import math
+import pickle
+import random
+import sys
+import time
+import tracemalloc
+
+import eventlet
+
+import app as simulator
+
+TERMINAL_IPS = {
+    'insider': '192.168.10.10',
+    'outsider': '192.168.20.10',
+    'dmz': '192.168.30.10',
+}
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def generate_ruleset(count, rng):
+    """Build an iptables script of ``count`` FORWARD rules over the simulator's zones."""
+    lines = []
+    for _ in range(count):
+        parts = ['iptables -A FORWARD']
+        if rng.random() < 0.7:
+            parts.append(f"-s 192.168.{rng.choice([10, 20, 30])}.{rng.randrange(0, 256, 16)}/28")
+        if rng.random() < 0.5:
+            parts.append(f"-d 192.168.{rng.choice([10, 20, 30])}.0/24")
+        parts.append(f"-p {rng.choice(['tcp', 'tcp', 'udp', 'icmp'])}")
+        if rng.random() < 0.8:
+            parts.append(f"--dport {rng.randint(1, 1024)}")
+        parts.append(f"-j {rng.choice(['ACCEPT', 'DROP', 'REJECT', 'LOG'])}")
+        lines.append(' '.join(parts))
+    return '\n'.join(lines)
+
+def command_mix(rng):
+    """An endless, seeded stream of (terminal, command) pairs resembling a lab session."""
+    while True:
+        terminal = rng.choice(list(TERMINAL_IPS))
+        target = rng.choice([ip for t, ip in TERMINAL_IPS.items() if t != terminal])
+        yield rng.choice([
+            (terminal, f"nc {target} {rng.randint(1, 1024)}"),
+            (terminal, f"curl http://{target}/"),
+            (terminal, f"ping {target}"),
+            (terminal, f"nmap -p 1-100 {target}"),
+            ('firewall', 'iptables -L -v'),
+        ])
+
+class Recorder:
+    """Collects per-operation latency samples."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def timed(self, name, func, *args):
+        start = time.perf_counter()
+        func(*args)
+        self.samples.setdefault(name, []).append(time.perf_counter() - start)
+
+    def report(self, elapsed):
+        results = {}
+        for name, samples in sorted(self.samples.items()):
+            results[name] = {
+                'count': len(samples),
+                'p50_ms': percentile(samples, 50) * 1000,
+                'p99_ms': percentile(samples, 99) * 1000,
+                'events_per_sec': len(samples) / elapsed if elapsed else 0.0,
+            }
+        return results
+
+def connect_client():
+    """Connect a test client with its own cookie jar, i.e. its own session."""
+    http_client = simulator.app.test_client()
+    http_client.get('/')
+    client = simulator.socketio.test_client(simulator.app, flask_test_client=http_client)
+    client.get_received()
+    return client
+
+def setup_session(client, script, log_depth, recorder):
+    for terminal, ip in TERMINAL_IPS.items():
+        client.emit('command', {'terminal': terminal, 'command': f"ifconfig set ip {ip}"})
+    recorder.timed('load_rules_from_script', client.emit, 'load_rules_from_script', {'script': script})
+
+    # Fill the log buffer: every flow has its own destination, so each one is logged separately
+    flows = [
+        {'source': TERMINAL_IPS['outsider'], 'destination': f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}",
+         'protocol': 'tcp', 'port': 80}
+        for i in range(log_depth)
+    ]
+    for start in range(0, len(flows), simulator.MAX_BATCH_FLOWS):
+        client.emit('evaluate_batch', {'flows': flows[start:start + simulator.MAX_BATCH_FLOWS]})
+    client.get_received()
+
+def run_client(client, commands, iterations, recorder):
+    for i in range(iterations):
+        terminal, command = next(commands)
+        recorder.timed(f"command:{command.split()[0]}", client.emit, 'command',
+                       {'terminal': terminal, 'command': command})
+        if i % 10 == 0:
+            recorder.timed('get_logs', client.emit, 'get_logs')
+        if i % 50 == 0:
+            recorder.timed('get_raw_logs', client.emit, 'get_raw_logs')
+        client.get_received()
+        eventlet.sleep(0)  # let the other clients run
+
+def run(args):
+    random.seed(args.seed)
+    rng = random.Random(args.seed)
+    script = generate_ruleset(args.rules, rng)
+    recorder = Recorder()
+
+    tracemalloc.start()
+    baseline_memory = tracemalloc.get_traced_memory()[0]
+    clients = [connect_client() for _ in range(args.clients)]
+    for client in clients:
+        setup_session(client, script, args.log_depth, recorder)
+    session_memory = (tracemalloc.get_traced_memory()[0] - baseline_memory) / args.clients
+    tracemalloc.stop()
+
+    state_sizes = [len(pickle.dumps(state)) for _, state in simulator.state_store._entries.values()]
+
+    pool = eventlet.GreenPool(args.clients)
+    start = time.perf_counter()
+    for index, client in enumerate(clients):
+        commands = command_mix(random.Random(args.seed + index))
+        pool.spawn(run_client, client, commands, args.iterations, recorder)
+    pool.waitall()
+    elapsed = time.perf_counter() - start
+
+    for client in clients:
+        client.disconnect()
+
+    return {
+        'config': vars(args),
+        'elapsed_sec': elapsed,
+        'events_per_sec': sum(len(s) for s in recorder.samples.values()) / elapsed,
+        'memory_per_session_kb': session_memory / 1024,
+        'state_size_per_session_kb': sum(state_sizes) / len(state_sizes) / 1024 if state_sizes else 0.0,
+        'operations': recorder.report(elapsed),
+    }
+
+def print_report(result):
+    config = result['config']
+    print(f"rules={config['rules']} log_depth={config['log_depth']} "
+          f"clients={config['clients']} iterations={config['iterations']} seed={config['seed']}")
+    print(f"{'operation':<28} {'count':>7} {'p50 ms':>9} {'p99 ms':>9} {'events/s':>10}")
+    for name, op in result['operations'].items():
+        print(f"{name:<28} {op['count']:>7} {op['p50_ms']:>9.2f} {op['p99_ms']:>9.2f} {op['events_per_sec']:>10.1f}")
+    print(f"\nTotal: {result['events_per_sec']:.1f} events/s over {result['elapsed_sec']:.2f}s")
+    print(f"Memory per session: {result['memory_per_session_kb']:.1f} KB "
+          f"(serialized state {result['state_size_per_session_kb']:.1f} KB)")
+
+def find_regressions(result, baseline, tolerance):
+    """Operations whose p50 latency grew by more than ``tolerance`` over the baseline."""
+    regressions = []
+    for name, op in result['operations'].items():
+        previous = baseline.get('operations', {}).get(name)
+        if previous and op['p50_ms'] > previous['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {previous['p50_ms']:.2f}ms -> {op['p50_ms']:.2f}ms")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rules', type=int, default=200, help='FORWARD rules loaded per session')
+    parser.add_argument('--log-depth', type=int, default=simulator.MAX_LOGS, help='log entries per session before the run')
+    parser.add_argument('--clients', type=int, default=5, help='concurrent client sessions')
+    parser.add_argument('--iterations', type=int, default=100, help='commands sent per client')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed p50 slowdown against the baseline (0.5 = 50%%)')
+    args = parser.parse_args()
+
+    # Keep the app's connection messages out of the report
+    with contextlib.redirect_stdout(sys.stderr):
+        result = run(args)
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(result)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
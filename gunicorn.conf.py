@@ -0,0 +1,18 @@
+# gunicorn.conf.py
+# Production server configuration: gunicorn -c gunicorn.conf.py app:app
+#
+# Socket.IO needs sticky sessions, which gunicorn's own load balancing does
+# not provide, so each gunicorn instance runs a single eventlet worker. To
+# scale out, run several instances (processes or containers) behind a sticky
+# load balancer and set SOCKETIO_MESSAGE_QUEUE and STATE_BACKEND so they
+# share emits and session state. See DOCKER.md ("Scaling Out").
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+worker_class = 'eventlet'
+workers = 1
+# Concurrent connections handled by the eventlet worker
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+timeout = 60
+accesslog = '-'
@@ -193,8 +193,10 @@ socket.on('output', (data) => {
             }
         });
         
-        // Show prompt
-        term.write(`\x1b[1;36m${data.terminal}@firewall\x1b[0m:\x1b[1;34m~\x1b[0m$ `);
+        // Streamed chunks are followed by more output; only show the prompt at the end
+        if (!data.partial) {
+            term.write(`\x1b[1;36m${data.terminal}@firewall\x1b[0m:\x1b[1;34m~\x1b[0m$ `);
+        }
     }
 });
 
@@ -230,35 +232,47 @@ socket.on('update_ip_display', (data) => {
     }
 });
 
-socket.on('new_log', (log) => {
-    // Apply current filter before adding
-    const shouldDisplay = currentLogFilter === 'all' || 
+function matchesLogFilter(log) {
+    return currentLogFilter === 'all' || 
         (currentLogFilter === 'blocked' && ['DROP', 'REJECT'].includes(log.action)) ||
         (currentLogFilter === 'allowed' && log.action === 'ACCEPT') ||
         (currentLogFilter === 'warnings' && (log.category === 'warning' || log.action === 'WARNING'));
-    
-    if (shouldDisplay) {
-        addLogEntry(log);
+}
+
+// Logs received so far, oldest first, and the sequence number of the newest one.
+// get_logs only sends entries after the cursor, so each poll is incremental.
+let logCache = [];
+let logCursor = 0;
+
+function syncLogs() {
+    socket.emit('get_logs', { since: logCursor });
+}
+
+function appendLogs(logs) {
+    const fresh = logs.filter(log => log.seq > logCursor);
+    if (fresh.length === 0) return;
+    logCursor = fresh[fresh.length - 1].seq;
+    logCache.push(...fresh);
+
+    const matching = fresh.filter(matchesLogFilter);
+    const logsContent = document.getElementById('logs-content');
+    if (logsContent && matching.length > 0 && logsContent.querySelector('.no-logs')) {
+        logsContent.innerHTML = '';
     }
-    
-    // Update stats by getting latest log data
-    socket.emit('get_logs');
-});
+    matching.forEach(addLogEntry);
+}
 
-socket.on('logs_data', (data) => {
+function renderLogs() {
     const logsContent = document.getElementById('logs-content');
     if (!logsContent) return;
     logsContent.innerHTML = '';
-    
-    updateLogStats(data.stats);
-    
-    const logsToDisplay = data.logs || [];
-    if (logsToDisplay.length === 0) {
+
+    if (logCache.length === 0) {
         logsContent.innerHTML = '<div class="no-logs">No firewall logs yet.</div>';
         return;
     }
     
-    const filteredLogs = filterLogsByCategory(logsToDisplay, currentLogFilter);
+    const filteredLogs = filterLogsByCategory(logCache, currentLogFilter);
     
     if (filteredLogs.length === 0) {
         logsContent.innerHTML = `<div class="no-logs">No logs in "${currentLogFilter}" category.</div>`;
@@ -268,21 +282,80 @@ socket.on('logs_data', (data) => {
     filteredLogs.forEach(log => {
         addLogEntry(log);
     });
+}
+
+socket.on('new_log', (log) => {
+    appendLogs([log]);
+    // Update stats; the entry itself is already here, so nothing is resent
+    syncLogs();
 });
 
-socket.on('rules_data', (data) => {
-    const blob = new Blob([data.rules], { type: 'text/plain' });
+// Batched mode: all logs produced by one command arrive in a single message
+socket.on('new_logs', (data) => {
+    appendLogs(data.logs);
+    syncLogs();
+});
+
+socket.on('logs_data', (data) => {
+    if (data.error) {
+        console.error(data.error);
+        return;
+    }
+    updateLogStats(data.stats);
+
+    // A fresh session (expired or server restarted) numbers its logs from 1 again
+    if (data.cursor < logCursor) {
+        logCache = [];
+        logCursor = 0;
+        renderLogs();
+        syncLogs();
+        return;
+    }
+
+    // Drop entries the server has evicted or cleared
+    if (logCache.length > 0 && logCache[0].seq < data.oldest) {
+        logCache = logCache.filter(log => log.seq >= data.oldest);
+        renderLogs();
+    }
+    appendLogs(data.logs);
+    logCursor = Math.max(logCursor, data.cursor);
+    if (logCache.length === 0) renderLogs();
+
+    if (data.has_more) syncLogs();
+});
+
+// Exports arrive as sequenced export_chunk messages and are reassembled here
+const pendingExports = {};
+
+function exportFilename(kind, extension) {
+    const d = new Date();
+    if (kind === 'rules') {
+        // Timestamped filename e.g., 20251130094500.waf
+        const timestamp = `${d.getFullYear()}${(d.getMonth()+1).toString().padStart(2, '0')}${d.getDate().toString().padStart(2, '0')}` +
+                        `${d.getHours().toString().padStart(2, '0')}${d.getMinutes().toString().padStart(2, '0')}${d.getSeconds().toString().padStart(2, '0')}`;
+        return `${timestamp}.${extension}`;
+    }
+    return `firewall_logs_${Date.now()}.${extension}`;
+}
+
+socket.on('export_chunk', (chunk) => {
+    if (chunk.error) {
+        alert(chunk.error);
+        return;
+    }
+    const parts = pendingExports[chunk.id] || (pendingExports[chunk.id] = []);
+    parts[chunk.seq] = chunk.data;
+    if (!chunk.final) return;
+
+    delete pendingExports[chunk.id];
+    const blob = new Blob(parts, { type: chunk.mimetype });
     const url = URL.createObjectURL(blob);
     const a = document.createElement('a');
     a.href = url;
-    
-    // Create timestamped filename e.g., 20251130094500.waf
-    const d = new Date();
-    const timestamp = `${d.getFullYear()}${(d.getMonth()+1).toString().padStart(2, '0')}${d.getDate().toString().padStart(2, '0')}` +
-                    `${d.getHours().toString().padStart(2, '0')}${d.getMinutes().toString().padStart(2, '0')}${d.getSeconds().toString().padStart(2, '0')}`;
-    a.download = `${timestamp}.waf`;
-    
+    a.download = exportFilename(chunk.kind, chunk.extension);
+    document.body.appendChild(a);
     a.click();
+    document.body.removeChild(a);
     URL.revokeObjectURL(url);
 });
 
@@ -312,9 +385,66 @@ socket.on('reconnect', () => {
     });
 });
 
-// Download rules functionality
-function downloadRules() {
-    socket.emit('get_rules');
+// Test every zone pair against common services in one round trip
+function testTrafficMatrix() {
+    socket.emit('evaluate_batch', {
+        matrix: {
+            sources: ['insider', 'outsider', 'dmz'],
+            destinations: ['insider', 'outsider', 'dmz'],
+            services: ['icmp', 'tcp/22', 'tcp/80', 'tcp/443', 'tcp/3306']
+        }
+    });
+}
+
+socket.on('batch_results', (data) => {
+    const term = terminals.firewall;
+    if (!term) return;
+
+    term.writeln('');
+    if (data.error) {
+        term.writeln(`\x1b[1;31m${data.error}\x1b[0m`);
+    } else {
+        const path = data.chain === 'auto' ? 'routed paths' : `${data.chain} chain`;
+        term.writeln(`\x1b[1;33mTraffic matrix (${path})\x1b[0m`);
+        data.results.forEach(r => {
+            const service = r.port ? `${r.protocol}/${r.port}` : r.protocol;
+            const color = r.allowed ? '32' : '31';
+            const chain = r.chain || 'local';
+            term.writeln(`  ${r.source.padEnd(16)} -> ${r.destination.padEnd(16)} ${service.padEnd(10)} ${chain.padEnd(8)} \x1b[${color}m${r.verdict}\x1b[0m`);
+        });
+        term.writeln(`  ${data.summary.allowed} allowed, ${data.summary.blocked} blocked (${data.summary.total} flows)`);
+    }
+    term.write(`\x1b[1;36mfirewall@firewall\x1b[0m:\x1b[1;34m~\x1b[0m$ `);
+});
+
+// Background traffic generator: synthetic flows between the zones, stats pushed once per second
+let trafficRunning = false;
+
+function toggleTraffic() {
+    if (trafficRunning) {
+        socket.emit('traffic_stop');
+    } else {
+        socket.emit('traffic_start', { mode: 'synthetic', rate: 100 });
+    }
+}
+
+socket.on('traffic_stats', (stats) => {
+    const status = document.getElementById('traffic-status');
+    trafficRunning = stats.running;
+    document.getElementById('traffic-btn').textContent = trafficRunning ? '🚦 Stop Traffic' : '🚦 Start Traffic';
+    if (stats.error) {
+        status.textContent = stats.error;
+    } else if (stats.flows !== undefined) {
+        const progress = stats.total ? ` (${stats.replayed}/${stats.total} replayed)` : '';
+        status.innerHTML = `${stats.mode} traffic: ${stats.flows} flows in ${stats.elapsed}s, ${stats.flows_per_sec} flows/s${progress} - ` +
+            `<span class="allowed">${stats.allowed} allowed</span>, <span class="blocked">${stats.blocked} blocked</span>`;
+    }
+    status.style.display = stats.error || stats.flows !== undefined ? 'block' : 'none';
+});
+
+// Download rules functionality (format: 'text', 'jsonl' or 'csv')
+function downloadRules(format = 'text') {
+    socket.emit('get_rules', { format });
 }
 
 // Upload rules functionality
@@ -329,21 +459,19 @@ function setupUploadListener() {
         if (!file) {
             return;
         }
-        if (!file.name.endsWith('.waf')) {
-            alert("Invalid file type. Please select a .waf file.");
+        if (!['.waf', '.rules', '.v4'].some(ext => file.name.endsWith(ext))) {
+            alert("Invalid file type. Please select a .waf script or an iptables-save dump (.rules, .v4).");
             return;
         }
 
         const reader = new FileReader();
         reader.onload = (e) => {
             const content = e.target.result;
-            socket.emit('load_rules_from_script', { script: content });
-            // Add a visual confirmation
-            const firewallTerminal = terminals['firewall'];
-            if(firewallTerminal) {
-                firewallTerminal.writeln('');
-                firewallTerminal.writeln('\x1b[1;32mRules loaded from file. Run "iptables -L" to see them.\x1b[0m');
-                firewallTerminal.write(`\x1b[1;36mfirewall@firewall\x1b[0m:\x1b[1;34m~\x1b[0m$ `);
+            // The server answers with a rules_loaded report
+            if (/^\*filter/m.test(content)) {
+                socket.emit('restore_rules', { script: content });
+            } else {
+                socket.emit('load_rules_from_script', { script: content });
             }
         };
         reader.readAsText(file);
@@ -353,6 +481,43 @@ function setupUploadListener() {
     });
 }
 
+socket.on('ruleset_updated', (data) => {
+    const term = terminals['firewall'];
+    if (!term) return;
+    if (data.error) {
+        term.writeln(`\r\n\x1b[1;31mruleset: ${data.error}\x1b[0m`);
+    } else {
+        term.writeln(`\r\n\x1b[1;33mUsing ruleset ${data.name} version ${data.version} (${data.rules} rules)\x1b[0m`);
+    }
+});
+
+socket.on('snapshot_loaded', (data) => {
+    const term = terminals['firewall'];
+    if (!term) return;
+    if (data.error) {
+        term.writeln(`\r\n\x1b[1;31msnapshot: ${data.error}\x1b[0m`);
+    } else {
+        term.writeln(`\r\n\x1b[1;32mSnapshot restored (${data.summary})\x1b[0m`);
+    }
+});
+
+socket.on('rules_loaded', (report) => {
+    const term = terminals['firewall'];
+    if (!term) return;
+    term.writeln('');
+    if (report.applied) {
+        const duplicates = report.duplicates ? `, ${report.duplicates} duplicates skipped` : '';
+        const loopback = report.skipped ? `, ${report.skipped} loopback rules skipped` : '';
+        term.writeln(`\x1b[1;32mLoaded ${report.loaded} rules from file${duplicates}${loopback}. Run "iptables -L" to see them.\x1b[0m`);
+    } else {
+        term.writeln('\x1b[1;31mRules file rejected; the current rules were kept.\x1b[0m');
+    }
+    report.errors.forEach(e => {
+        term.writeln(`\x1b[1;33m  line ${e.line}: ${e.error}\x1b[0m`);
+    });
+    term.write(`\x1b[1;36mfirewall@firewall\x1b[0m:\x1b[1;34m~\x1b[0m$ `);
+});
+
 // Toggle logs panel
 function toggleLogs() {
     const logsPanel = document.getElementById('logs-panel');
@@ -368,7 +533,8 @@ let currentLogFilter = 'all';
 
 // Load logs from server
 function loadLogs() {
-    socket.emit('get_logs');
+    renderLogs();
+    syncLogs();
 }
 
 function updateLogStats(stats) {
@@ -393,24 +559,12 @@ function filterLogs(category) {
     document.querySelectorAll('.filter-btn').forEach(btn => btn.classList.remove('active'));
     event.target.classList.add('active');
     
-    // Reload logs with filter
-    loadLogs();
+    // Re-render the cached logs with the new filter
+    renderLogs();
 }
 
-socket.on('raw_logs_data', (data) => {
-    const blob = new Blob([data.logs], { type: 'text/plain' });
-    const url = URL.createObjectURL(blob);
-    const a = document.createElement('a');
-    a.href = url;
-    a.download = `firewall_logs_${Date.now()}.txt`;
-    document.body.appendChild(a);
-    a.click();
-    document.body.removeChild(a);
-    URL.revokeObjectURL(url);
-});
-
-function downloadLogs() {
-    socket.emit('get_raw_logs');
+function downloadLogs(format = 'text') {
+    socket.emit('get_raw_logs', { format });
 }
 
 // Add log entry to display
@@ -450,9 +604,12 @@ function addLogEntry(log) {
         `;
     }
     
+    // Grouped entries stand for several packets
+    const countHtml = log.count > 1 ? ` <span class="log-count">×${log.count}</span>` : '';
+    
     logEntry.innerHTML = `
         <div class="log-time">${timestamp}</div>
-        <div class="log-action ${action}">${log.action}</div>
+        <div class="log-action ${action}">${log.action}${countHtml}</div>
         ${detailsHtml}
     `;
     